@@ -0,0 +1,91 @@
+"""
+Microbenchmarks for encoding and decoding MQTT-SN messages.
+
+Covers MessageFactory.from_bytes and to_bytes for every implemented message type, with both the 1 and the 3 octet
+length encoding and PUBLISH payloads from 10 B to 64 KB, and a datagram with several encapsulated messages.
+
+    python benchmarks/codec.py run
+    python benchmarks/codec.py run --output benchmarks/codec-baseline.json
+    python benchmarks/codec.py compare --threshold 10
+
+"""
+import os
+from typing import *
+
+from mqtt_sn_gateway import messages
+
+import harness
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "codec-baseline.json")
+
+PUBLISH_PAYLOAD_SIZES = [10, 100, 240, 1_000, 10_000, 65_526]
+MSG_ID = b"\xc7\x92"
+ENCAPSULATED_FRAMES = 8
+
+
+def sample_messages() -> Dict[str, Any]:
+    samples = {
+        "connect": messages.Connect(
+            flags=messages.Flags(qos=0, clean_session=True), duration=3600, client_id=b"94193A04010020B8"
+        ),
+        "connack": messages.Connack(return_code=messages.ReturnCode.ACCEPTED),
+        "register/short": messages.Register(
+            msg_id=MSG_ID, topic_name="mr/94193A04010020B8/standard/json", topic_id=None
+        ),
+        "register/long": messages.Register(
+            msg_id=MSG_ID, topic_name="mr/94193A04010020B8/" + "x" * 300, topic_id=None
+        ),
+        "regack": messages.Regack(topic_id=1, msg_id=MSG_ID, return_code=messages.ReturnCode.ACCEPTED),
+        "puback": messages.Puback(topic_id=1, msg_id=MSG_ID, return_code=messages.ReturnCode.ACCEPTED),
+        "pingreq": messages.Pingreq(client_id=None),
+        "pingreq/client_id": messages.Pingreq(client_id=b"94193A04010020B8"),
+        "pingresp": messages.Pingresp(),
+        "disconnect": messages.Disconnect(),
+        "disconnect/duration": messages.Disconnect(duration=10),
+        "searchgw": messages.Searchgw(radius=1),
+        "gwinfo": messages.Gwinfo(gw_id=7),
+        "gwinfo/address": messages.Gwinfo(gw_id=7, gw_address=b"\x0a\x00\x00\x01\x07\x5b"),
+        "advertise": messages.Advertise(gw_id=7, duration=900),
+        "subscribe/name": messages.Subscribe(
+            flags=messages.Flags(qos=1), msg_id=MSG_ID, topic_name="mr/94193A04010020B8/commands"
+        ),
+        "subscribe/id": messages.Subscribe(
+            flags=messages.Flags(qos=1, topic_type=messages.TopicType.PREDEFINED), msg_id=MSG_ID, topic_id=1
+        ),
+        "suback": messages.Suback(
+            flags=messages.Flags(qos=1), topic_id=1, msg_id=MSG_ID, return_code=messages.ReturnCode.ACCEPTED
+        ),
+        "unsubscribe": messages.Unsubscribe(
+            flags=messages.Flags(qos=1), msg_id=MSG_ID, topic_name="mr/94193A04010020B8/commands"
+        ),
+        "unsuback": messages.Unsuback(msg_id=MSG_ID),
+    }
+    encapsulated_publish = messages.Publish(
+        flags=messages.Flags(qos=1), topic_id=1, msg_id=MSG_ID, data=os.urandom(100)
+    ).to_bytes()
+    samples["encapsulated"] = messages.Encapsulated(
+        ctrl=0, wireless_node_id=b"94193A04010020B8", data=encapsulated_publish
+    )
+    for size in PUBLISH_PAYLOAD_SIZES:
+        samples[f"publish/{size}B"] = messages.Publish(
+            flags=messages.Flags(qos=1), topic_id=1, msg_id=MSG_ID, data=os.urandom(size)
+        )
+    return samples
+
+
+def benchmarks() -> Dict[str, harness.Benchmark]:
+    cases = {}
+    for name, message in sample_messages().items():
+        data = message.to_bytes()
+        cases[f"to_bytes/{name}"] = message.to_bytes
+        cases[f"from_bytes/{name}"] = lambda data=data: messages.MessageFactory.from_bytes(data)
+    # A forwarder may put several encapsulated messages in one datagram, those are split by parse_encapsulated.
+    frames = messages.EncapsulatedFrames(frames=[sample_messages()["encapsulated"]] * ENCAPSULATED_FRAMES)
+    data = frames.to_bytes()
+    cases["to_bytes/encapsulated/frames"] = frames.to_bytes
+    cases["parse_encapsulated/frames"] = lambda: messages.parse_encapsulated(data)
+    return cases
+
+
+if __name__ == "__main__":
+    harness.cli(benchmarks, default_baseline=BASELINE)()
@@ -0,0 +1,85 @@
+"""
+Benchmarks for handling a datagram in MqttSnGateway, with in-memory stores and forwarder so only the gateway is
+measured.
+
+dispatch/* sends datagrams through one long-lived gateway, as the server does. per_datagram_objects builds the object
+graph the request handler used to build for every datagram, stores, kombu Connection and Exchange, AmqpForwarder and
+gateway, to show what sharing the gateway saves per datagram.
+
+    python benchmarks/gateway.py run
+    python benchmarks/gateway.py run --output benchmarks/gateway-baseline.json
+    python benchmarks/gateway.py compare --threshold 10
+
+"""
+import logging
+import os
+from typing import *
+
+import structlog
+import valkey
+from kombu import Connection, Exchange
+
+from mqtt_sn_gateway import client_store, gateway, memory, messages, topic_store
+from mqtt_sn_gateway.forward import AmqpForwarder
+
+import harness
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gateway-baseline.json")
+
+ADDRESS = ("10.0.0.1", 1000)
+CLIENT_ID = b"BENCHMARK-CLIENT"
+MSG_ID = b"\xc7\x92"
+
+
+def build_gateway() -> gateway.MqttSnGateway:
+    gw = gateway.MqttSnGateway(
+        client_store=memory.MemoryClientStore(use_port_number=True),
+        topic_store=memory.MemoryTopicStore(),
+        forwarder=memory.MemoryForwarder(),
+        extend_store_ttl_on_publish=False,
+    )
+    gw.client_store.add_client(CLIENT_ID, ADDRESS)
+    gw.topic_store.add_topic_for_client(CLIENT_ID, "mr/1/standard")
+    return gw
+
+
+def per_datagram_objects(valkey_client: valkey.Valkey) -> Callable[[], gateway.MqttSnGateway]:
+    def build() -> gateway.MqttSnGateway:
+        return gateway.MqttSnGateway(
+            client_store=client_store.ValKeyClientStore(valkey=valkey_client, use_port_number=True),
+            topic_store=topic_store.ValKeyTopicStore(valkey=valkey_client),
+            forwarder=AmqpForwarder(
+                exchange=Exchange("mqtt-sn", type="topic"), connection=Connection("amqp://localhost")
+            ),
+        )
+
+    return build
+
+
+def datagrams() -> Dict[str, bytes]:
+    return {
+        "connect": messages.Connect(flags=messages.Flags(), duration=60, client_id=CLIENT_ID).to_bytes(),
+        "register": messages.Register(topic_id=None, msg_id=MSG_ID, topic_name="mr/1/standard").to_bytes(),
+        "publish_qos0": messages.Publish(
+            flags=messages.Flags(qos=0), topic_id=1, msg_id=MSG_ID, data=b"x" * 100
+        ).to_bytes(),
+        "publish_qos1": messages.Publish(
+            flags=messages.Flags(qos=1), topic_id=1, msg_id=MSG_ID, data=b"x" * 100
+        ).to_bytes(),
+        "pingreq": messages.Pingreq(client_id=None).to_bytes(),
+    }
+
+
+def benchmarks() -> Dict[str, harness.Benchmark]:
+    # The gateway logs every message at INFO, which would be most of what is measured.
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+    gw = build_gateway()
+    cases = {}
+    for name, data in datagrams().items():
+        cases[f"dispatch/{name}"] = lambda data=data: gw.dispatch(data, ADDRESS)
+    cases["per_datagram_objects"] = per_datagram_objects(valkey.Valkey())
+    return cases
+
+
+if __name__ == "__main__":
+    harness.cli(benchmarks, default_baseline=BASELINE)()
@@ -0,0 +1,169 @@
+"""
+Small benchmark harness shared by the benchmark scripts in this directory.
+
+A benchmark is a named zero-argument callable. Each one is measured for:
+
+* ns_per_op: best mean time per call over a number of repeats.
+* alloc_blocks_per_op: memory blocks still allocated by one call, measured with tracemalloc. The result of the call
+  is kept alive so this counts the objects the call returns.
+* peak_bytes_per_op: peak memory traced by tracemalloc during one call, including temporary objects.
+
+Results are written as JSON so they can be committed as a baseline and compared against later runs.
+"""
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import *
+
+import click
+
+Benchmark = Callable[[], Any]
+
+DEFAULT_THRESHOLD = 10.0  # percent
+
+
+def calibrate(fn: Benchmark, min_time: float) -> int:
+    """Number of calls needed for one repeat to run at least min_time seconds."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return number
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+
+
+def time_per_op(fn: Benchmark, min_time: float, repeat: int) -> float:
+    number = calibrate(fn, min_time)
+    best = None
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            for _ in range(number):
+                fn()
+            elapsed = (time.perf_counter_ns() - start) / number
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return best
+
+
+def allocations_per_op(fn: Benchmark, number: int = 100) -> Tuple[float, float]:
+    fn()  # Warm up caches so they are not counted.
+    results = [None] * number
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for index in range(number):
+            results[index] = fn()
+        after = tracemalloc.take_snapshot()
+        blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(blocks, 0) / number, max(peak - baseline, 0)
+
+
+def run(benchmarks: Dict[str, Benchmark], min_time: float, repeat: int) -> Dict[str, Any]:
+    results = {}
+    for name, fn in benchmarks.items():
+        ns = time_per_op(fn, min_time=min_time, repeat=repeat)
+        blocks, peak = allocations_per_op(fn)
+        results[name] = {
+            "ns_per_op": round(ns, 1),
+            "alloc_blocks_per_op": round(blocks, 2),
+            "peak_bytes_per_op": peak,
+        }
+        click.echo(f"{name:<48} {ns:>12.1f} ns/op {blocks:>8.2f} blocks/op {peak:>9} peak B/op")
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Returns a description of each benchmark that is slower than the baseline by more than threshold percent or that
+    allocates more blocks per op than the baseline.
+    """
+    regressions = []
+    for name, base in baseline["results"].items():
+        result = current["results"].get(name)
+        if result is None:
+            continue
+        change = (result["ns_per_op"] - base["ns_per_op"]) / base["ns_per_op"] * 100
+        flag = ""
+        if change > threshold:
+            flag = "REGRESSION"
+            regressions.append(f"{name}: {change:+.1f} % ns/op")
+        if result["alloc_blocks_per_op"] > base["alloc_blocks_per_op"] + 0.5:
+            flag = "REGRESSION"
+            regressions.append(
+                f"{name}: {base['alloc_blocks_per_op']} -> {result['alloc_blocks_per_op']} blocks/op"
+            )
+        click.echo(
+            f"{name:<48} {base['ns_per_op']:>12.1f} -> {result['ns_per_op']:>12.1f} ns/op {change:+7.1f} % {flag}"
+        )
+    return regressions
+
+
+def cli(benchmarks: Callable[[], Dict[str, Benchmark]], default_baseline: str) -> click.Group:
+    """Builds a click group with `run` and `compare` commands for a set of benchmarks."""
+
+    @click.group()
+    def group():
+        pass
+
+    @group.command("run")
+    @click.option("--output", default=None, help="Write results as JSON to this file")
+    @click.option("--filter", "name_filter", default="", help="Only run benchmarks whose name contains this")
+    @click.option("--min-time", default=0.1, help="Minimum seconds per repeat")
+    @click.option("--repeat", default=5, help="Number of repeats, the best is reported")
+    def run_command(output, name_filter, min_time, repeat):
+        """Run the benchmarks"""
+        selected = {name: fn for name, fn in benchmarks().items() if name_filter in name}
+        results = run(selected, min_time=min_time, repeat=repeat)
+        if output:
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            click.echo(f"Wrote results to {output}")
+
+    @group.command("compare")
+    @click.option("--baseline", default=default_baseline, help="Baseline results file")
+    @click.option("--current", default=None, help="Results file to compare. Runs the benchmarks if not given")
+    @click.option("--threshold", default=DEFAULT_THRESHOLD, help="Allowed slowdown in percent")
+    @click.option("--min-time", default=0.1, help="Minimum seconds per repeat")
+    @click.option("--repeat", default=5, help="Number of repeats, the best is reported")
+    def compare_command(baseline, current, threshold, min_time, repeat):
+        """Compare results against a baseline. Exits with 1 on regressions"""
+        with open(baseline) as f:
+            baseline_results = json.load(f)
+        if current:
+            with open(current) as f:
+                current_results = json.load(f)
+        else:
+            current_results = run(benchmarks(), min_time=min_time, repeat=repeat)
+        click.echo()
+        regressions = compare(baseline_results, current_results, threshold)
+        if regressions:
+            click.echo(f"\n{len(regressions)} regression(s) over {threshold} %:")
+            for regression in regressions:
+                click.echo(f"  {regression}")
+            sys.exit(1)
+        click.echo("\nNo regressions")
+
+    return group
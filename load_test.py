@@ -1,66 +1,309 @@
-from asyncio.transports import DatagramTransport
+"""
+Load generator for the MQTT-SN Gateway.
+
+Simulates a number of devices, each with its own UDP source port. Every device runs CONNECT -> REGISTER and then
+PUBLISH periodically at QoS 0 or 1 and retransmits requests that are not answered within the retransmit timeout.
+When done it reports throughput, PUBACK latency percentiles and loss.
+
+With --in-process the gateway is started in this process with in-memory stand-ins for Valkey and AMQP so results can
+be reproduced without any external services. Their latency and faults are set with MQTTSN_SIMULATED_STORES and
+MQTTSN_SIMULATED_FORWARDER, see memory.FaultProfile:
+
+    python load_test.py --in-process --devices 500 --duration 30 --publish-interval 1
+    MQTTSN_SIMULATED_STORES=latency=0.001,jitter=0.0005,distribution=lognormal python load_test.py --in-process
+
+"""
 import asyncio
+import logging
+import os
+import random
+import threading
 import time
+from typing import *
 
-HOST, PORT = "localhost", 9999
-import socket
+import click
+import structlog
+from attrs import define, field
 
+from mqtt_sn_gateway import messages
+from mqtt_sn_gateway.config import Config
+from mqtt_sn_gateway.server import MqttSnRequestHandler, ThreadingUdpServer
 
-class EchoClientProtocol:
-    def __init__(self, message, on_con_lost):
-        self.message = message
-        self.on_con_lost = on_con_lost
-        self.transport = None
+PAYLOAD_TEMPLATE = b'{"TS":"2021-07-05T18:00:00Z","ID":224396,"E":184,"U":"kWh","V":6580,"VU":"l"}'
 
 
+def percentile(sorted_values: List[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
 
 
-def connection_made(self, transport):
-    self.transport = transport
+@define
+class Stats:
+    connects: int = field(default=0)
+    connect_failures: int = field(default=0)
+    registers: int = field(default=0)
+    register_failures: int = field(default=0)
+    publishes: int = field(default=0)
+    acked: int = field(default=0)
+    rejected: int = field(default=0)
+    lost: int = field(default=0)
+    disconnects: int = field(default=0)
+    retransmits: int = field(default=0)
+    datagrams_sent: int = field(default=0)
+    datagrams_received: int = field(default=0)
+    unexpected: int = field(default=0)
+    puback_latencies: List[float] = field(factory=list)
 
-    # print('Send:', self.message)
-    self.transport.sendto(self.message)
-    self.transport.close()
+    def report(self, duration: float):
+        latencies = sorted(self.puback_latencies)
+        expected_acks = self.acked + self.rejected + self.lost
+        loss = (self.lost / expected_acks * 100) if expected_acks else 0.0
+        click.echo(f"Duration:            {duration:.2f} s")
+        click.echo(f"Datagrams sent:      {self.datagrams_sent} ({self.datagrams_sent / duration:.1f}/s)")
+        click.echo(f"Datagrams received:  {self.datagrams_received} ({self.datagrams_received / duration:.1f}/s)")
+        click.echo(f"Connects:            {self.connects} ok, {self.connect_failures} failed")
+        click.echo(f"Registers:           {self.registers} ok, {self.register_failures} failed")
+        click.echo(f"Publishes:           {self.publishes} ({self.publishes / duration:.1f}/s)")
+        click.echo(f"PUBACK accepted:     {self.acked} ({self.acked / duration:.1f}/s)")
+        click.echo(f"PUBACK rejected:     {self.rejected}")
+        click.echo(f"Lost:                {self.lost} ({loss:.2f} %)")
+        click.echo(f"Retransmits:         {self.retransmits}")
+        click.echo(f"DISCONNECT received: {self.disconnects}")
+        click.echo(f"Unexpected replies:  {self.unexpected}")
+        if latencies:
+            click.echo(
+                "PUBACK latency ms:   "
+                f"p50={percentile(latencies, 50) * 1000:.2f} "
+                f"p90={percentile(latencies, 90) * 1000:.2f} "
+                f"p99={percentile(latencies, 99) * 1000:.2f} "
+                f"max={latencies[-1] * 1000:.2f}"
+            )
 
 
-def connection_lost(self, exc):
-    # print("Connection closed")
-    self.on_con_lost.set_result(True)
+class RequestTimeout(Exception):
+    """No response after all retransmits"""
 
 
-async def push_data():
-    # writer = DatagramTransport()
-    # writer.sendto(b"testetste", ("localhost", 9999))
-    loop = asyncio.get_running_loop()
-    on_con_lost = loop.create_future()
-    transport, protocol = await loop.create_datagram_endpoint(
-        lambda: EchoClientProtocol(
-            b'\x16\x04\x04\x01\xfd 94193A04010020B8', on_con_lost),
-        remote_addr=('127.0.0.1', 1883))
-    # s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # s.sendto(b'\x0f\x04\x00\x00dtestclient', (HOST, PORT))
-    return on_con_lost
-
-
-async def async_main():
-    start = time.time()
-    tasks = []
-    errors = 0
-    for _ in range(0, 10000):
-        tasks.append(asyncio.create_task(push_data()))
-
-    done, pending = await asyncio.wait(tasks)
-    for task in done:
+class Device(asyncio.DatagramProtocol):
+    """
+    A simulated device. Responses are matched to outstanding requests by message type and msg_id.
+    """
+
+    def __init__(self, client_id: bytes, stats: Stats, retransmit_timeout: float, max_retries: int):
+        self.client_id = client_id
+        self.stats = stats
+        self.retransmit_timeout = retransmit_timeout
+        self.max_retries = max_retries
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.pending: Dict[Tuple[messages.MessageType, bytes], asyncio.Future] = {}
+        self.next_msg_id = random.randint(1, 0xFFFF)
+        self.topic_id: Optional[int] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.stats.datagrams_received += 1
         try:
-            task.result()
-        except Exception:
-            errors = +1
+            message = messages.MessageFactory.from_bytes(data)
+        except messages.ParsingError:
+            self.stats.unexpected += 1
+            return
+        if isinstance(message, messages.Disconnect):
+            self.stats.disconnects += 1
+            self.topic_id = None
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result(message)
+            return
+        msg_id = getattr(message, "msg_id", b"")
+        future = self.pending.get((message.msg_type, msg_id))
+        if future is None or future.done():
+            # Reply to a request we already gave up on or a duplicate reply to a retransmit.
+            self.stats.unexpected += 1
+            return
+        future.set_result(message)
+
+    def error_received(self, exc):
+        pass
+
+    def msg_id(self) -> bytes:
+        self.next_msg_id = self.next_msg_id % 0xFFFF + 1
+        return self.next_msg_id.to_bytes(2, "big")
+
+    def send(self, data: bytes):
+        self.stats.datagrams_sent += 1
+        self.transport.sendto(data)
+
+    async def request(
+        self, message, response_type: messages.MessageType, msg_id: bytes = b""
+    ) -> Tuple[Any, float]:
+        """
+        Sends the message and waits for the response. Retransmits on timeout.
+        Returns the response and the time since the first transmission.
+
+        :raises RequestTimeout:
+        """
+        key = (response_type, msg_id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    self.stats.retransmits += 1
+                    if isinstance(message, messages.Publish):
+                        message.flags.dup = True
+                self.send(message.to_bytes())
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(future), self.retransmit_timeout)
+                    return response, time.perf_counter() - start
+                except asyncio.TimeoutError:
+                    continue
+            raise RequestTimeout()
+        finally:
+            self.pending.pop(key, None)
+
+    async def connect(self) -> bool:
+        message = messages.Connect(
+            flags=messages.Flags(qos=0, clean_session=True), duration=60 * 60, client_id=self.client_id
+        )
+        try:
+            response, _ = await self.request(message, messages.MessageType.CONNACK)
+        except RequestTimeout:
+            self.stats.connect_failures += 1
+            return False
+        if isinstance(response, messages.Connack) and response.return_code == messages.ReturnCode.ACCEPTED:
+            self.stats.connects += 1
+            return True
+        self.stats.connect_failures += 1
+        return False
+
+    async def register(self) -> bool:
+        msg_id = self.msg_id()
+        message = messages.Register(
+            msg_id=msg_id, topic_name=f"mr/{self.client_id.decode()}/standard/json", topic_id=None
+        )
+        try:
+            response, _ = await self.request(message, messages.MessageType.REGACK, msg_id)
+        except RequestTimeout:
+            self.stats.register_failures += 1
+            return False
+        if isinstance(response, messages.Regack) and response.return_code == messages.ReturnCode.ACCEPTED:
+            self.stats.registers += 1
+            self.topic_id = response.topic_id
+            return True
+        self.stats.register_failures += 1
+        return False
+
+    async def publish(self, payload: bytes, qos: int):
+        msg_id = self.msg_id()
+        message = messages.Publish(
+            flags=messages.Flags(qos=qos), topic_id=self.topic_id, msg_id=msg_id, data=payload
+        )
+        self.stats.publishes += 1
+        if qos == 0:
+            self.send(message.to_bytes())
+            return
+        try:
+            response, latency = await self.request(message, messages.MessageType.PUBACK, msg_id)
+        except RequestTimeout:
+            self.stats.lost += 1
+            return
+        if isinstance(response, messages.Puback) and response.return_code == messages.ReturnCode.ACCEPTED:
+            self.stats.acked += 1
+            self.stats.puback_latencies.append(latency)
+        else:
+            self.stats.rejected += 1
+
+    async def run(self, stop_at: float, publish_interval: float, payload: bytes, qos: int):
+        # Spread the devices over the first interval so they don't all send at the same time.
+        await asyncio.sleep(random.uniform(0, publish_interval))
+        next_publish = time.perf_counter()
+        while time.perf_counter() < stop_at:
+            if self.topic_id is None:
+                if not await self.connect() or not await self.register():
+                    await asyncio.sleep(self.retransmit_timeout)
+                    continue
+            await self.publish(payload, qos)
+            next_publish += publish_interval
+            await asyncio.sleep(max(0.0, next_publish - time.perf_counter()))
+
+
+def start_in_process_gateway() -> ThreadingUdpServer:
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+    # Other MQTTSN_ settings in the environment, like rate limiting, apply to the in-process gateway as well.
+    os.environ.update(
+        {"MQTTSN_HOST": "127.0.0.1", "MQTTSN_PORT": "0", "MQTTSN_USE_PORT_NUMBER_IN_CLIENT_STORE": "true"}
+    )
+    # Without latency or faults unless set in the environment.
+    os.environ.setdefault("MQTTSN_SIMULATED_STORES", "")
+    os.environ.setdefault("MQTTSN_SIMULATED_FORWARDER", "")
+    config = Config(no_env_files=True)
+    server = ThreadingUdpServer((config.HOST, config.PORT), MqttSnRequestHandler, config=config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run_load(
+    host: str, port: int, devices: int, duration: float, publish_interval: float, payload_size: int, qos: int,
+    retransmit_timeout: float, max_retries: int
+) -> Stats:
+    loop = asyncio.get_running_loop()
+    stats = Stats()
+    payload = (PAYLOAD_TEMPLATE * (payload_size // len(PAYLOAD_TEMPLATE) + 1))[:payload_size]
+    transports = []
+    runs = []
+    stop_at = time.perf_counter() + duration
+    for _ in range(devices):
+        client_id = os.urandom(8).hex().upper().encode()
+        transport, device = await loop.create_datagram_endpoint(
+            lambda: Device(client_id, stats, retransmit_timeout, max_retries), remote_addr=(host, port)
+        )
+        transports.append(transport)
+        runs.append(device.run(stop_at, publish_interval, payload, qos))
+    try:
+        await asyncio.gather(*runs)
+    finally:
+        for transport in transports:
+            transport.close()
+    return stats
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="Target host for MQTT-SN gateway")
+@click.option("--port", default=1884, help="Target port for MQTT-SN gateway")
+@click.option("--in-process", is_flag=True, help="Run against an in-process gateway with in-memory stores")
+@click.option("--devices", default=100, help="Number of simulated devices")
+@click.option("--duration", default=30.0, help="Seconds to run")
+@click.option("--publish-interval", default=5.0, help="Seconds between publishes from each device")
+@click.option("--payload-size", default=200, help="Size of the PUBLISH payload in bytes")
+@click.option("--qos", default=1, type=click.IntRange(0, 1), help="QoS of the publishes")
+@click.option("--retransmit-timeout", default=2.0, help="Seconds to wait for a response before retransmitting")
+@click.option("--max-retries", default=3, help="Number of retransmits before a request is considered lost")
+def main(host, port, in_process, devices, duration, publish_interval, payload_size, qos, retransmit_timeout,
+         max_retries):
+    """Simulate devices sending CONNECT, REGISTER and PUBLISH to a MQTT-SN gateway"""
+    server = None
+    if in_process:
+        server = start_in_process_gateway()
+        host, port = server.server_address
+        click.echo(f"Started in-process gateway on {host}:{port}")
+
+    start = time.perf_counter()
+    stats = asyncio.run(
+        run_load(host, port, devices, duration, publish_interval, payload_size, qos, retransmit_timeout,
+                 max_retries)
+    )
+    stats.report(time.perf_counter() - start)
 
-    stop = time.time()
-    duration = stop - start
-    print(duration)
-    print(errors)
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        click.echo(f"Forwarded by in-process gateway: {server.simulated_forwarder.forwarder.published}")
 
 
 if __name__ == "__main__":
-    asyncio.run(async_main())
+    main()
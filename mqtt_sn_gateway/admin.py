@@ -0,0 +1,106 @@
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+from urllib.parse import parse_qs, urlparse
+
+import structlog
+
+from mqtt_sn_gateway import profiling
+from mqtt_sn_gateway.metrics import MetricsRegistry
+
+LOG = structlog.get_logger(__name__)
+
+# The profiler runs one profile at a time, so a long one would lock out every later request.
+MAX_PROFILE_SECONDS = 600.0
+
+
+class AdminRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /metrics                  All registered metrics.
+    GET  /ready                    200 when the gateway is ready for traffic, 503 while it starts.
+    GET  /stages                   Stage timings recorded since they were enabled.
+    POST /stages/enable            Start recording stage timings.
+    POST /stages/disable           Stop recording stage timings and return them.
+    POST /profile?seconds=N        Run the sampling profiler for N seconds, 0 < N <= MAX_PROFILE_SECONDS.
+    """
+
+    server: "AdminServer"
+
+    def log_message(self, format, *args):
+        LOG.debug("Admin request", request=format % args)
+
+    def send_json(self, status: int, body: Any):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self.send_json(200, self.server.metrics.snapshot())
+        elif path == "/ready":
+            ready = self.server.ready is None or self.server.ready.is_set()
+            self.send_json(200 if ready else 503, {"ready": ready})
+        elif path == "/stages":
+            timings = profiling.stage_timings
+            self.send_json(200, timings.snapshot() if timings is not None else {"enabled": False})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path == "/stages/enable":
+            profiling.enable_stage_timings()
+            self.send_json(200, {"enabled": True})
+        elif url.path == "/stages/disable":
+            self.send_json(200, profiling.disable_stage_timings() or {"enabled": False})
+        elif url.path == "/profile":
+            query = parse_qs(url.query)
+            try:
+                seconds = float(query.get("seconds", [self.server.profile_seconds])[0])
+            except ValueError:
+                self.send_json(400, {"error": "seconds must be a number"})
+                return
+            if not math.isfinite(seconds) or not 0 < seconds <= MAX_PROFILE_SECONDS:
+                self.send_json(400, {"error": f"seconds must be above 0 and at most {MAX_PROFILE_SECONDS:g}"})
+                return
+            output_path = profiling.profile_path(self.server.profile_dir)
+            if self.server.profiler.start(seconds, output_path):
+                self.send_json(202, {"seconds": seconds, "output_path": output_path})
+            else:
+                self.send_json(409, {"error": "A profile is already running"})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+
+class AdminServer(ThreadingHTTPServer):
+    """
+    Small HTTP server for operating a running gateway. It should only be reachable from trusted networks.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        server_address: Tuple[str, int],
+        metrics: MetricsRegistry,
+        profiler: profiling.SamplingProfiler,
+        profile_dir: str,
+        profile_seconds: float,
+        ready: Optional[threading.Event] = None,
+    ):
+        self.metrics = metrics
+        self.ready = ready
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.profile_seconds = profile_seconds
+        super().__init__(server_address, AdminRequestHandler)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="admin-server", daemon=True).start()
+        LOG.info("Started admin server", host=self.server_address[0], port=self.server_address[1])
@@ -0,0 +1,213 @@
+import struct
+import threading
+import time
+from collections import deque
+from enum import Enum
+from typing import *
+
+from attrs import define, field
+import structlog
+
+from mqtt_sn_gateway import forward
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_WINDOW = 0.05  # seconds
+DEFAULT_MAX_MESSAGES = 100
+DEFAULT_MAX_BYTES = 64 * 1024
+DEFAULT_FLUSH_TIMEOUT = 5.0  # seconds a QoS 1 publish waits for its batch
+LENGTH_PREFIX = struct.Struct("!I")
+
+
+class BatchFormat(str, Enum):
+    NDJSON = "ndjson"
+    LENGTH_PREFIXED = "length_prefixed"
+
+
+class BatchFlushError(Exception):
+    """The batch the payload was in could not be forwarded, in time or at all"""
+
+
+def frame(payloads: List[bytes], batch_format: BatchFormat) -> bytes:
+    """
+    NDJSON: every payload followed by a newline.
+    LENGTH_PREFIXED: every payload preceded by its length as a 4 octet unsigned big endian integer.
+    """
+    if batch_format is BatchFormat.NDJSON:
+        return b"".join(payload + b"\n" for payload in payloads)
+    return b"".join(LENGTH_PREFIX.pack(len(payload)) + payload for payload in payloads)
+
+
+def unframe(data: bytes, batch_format: BatchFormat) -> List[bytes]:
+    """Splits a batch message back into its payloads. For consumers and tests."""
+    if batch_format is BatchFormat.NDJSON:
+        return data.split(b"\n")[:-1]
+    payloads = []
+    offset = 0
+    while offset < len(data):
+        (length,) = LENGTH_PREFIX.unpack_from(data, offset)
+        offset += LENGTH_PREFIX.size
+        payloads.append(data[offset:offset + length])
+        offset += length
+    return payloads
+
+
+@define
+class PendingBatch:
+    topic: bytes
+    created: float
+    payloads: List[bytes] = field(factory=list)
+    size: int = field(default=0)
+    done: threading.Event = field(factory=threading.Event)
+    error: Optional[BaseException] = field(default=None)
+    # A payload that can not be framed, forwarded as it is.
+    unframed: bool = field(default=False)
+
+
+@define
+class AggregatingForwarder:
+    """
+    Collects payloads for the same topic for up to window seconds, max_messages or max_bytes, and forwards them as
+    one message in batch_format. Consumers then get one broker message per batch instead of per payload.
+
+    A QoS 1 publish only returns when its batch has been forwarded, so the PUBACK is not sent before that, and it
+    raises BatchFlushError if the batch could not be forwarded within flush_timeout. QoS 0 publishes return right
+    away. Once stopped, publishes are refused with BatchFlushError.
+
+    Batches are forwarded by one thread in the order they were closed, so payloads for a topic stay in order. With
+    NDJSON a payload containing a newline would break the framing, so it closes the pending batch of its topic and is
+    forwarded on its own after it.
+    """
+
+    forwarder: forward.MqttSnForwarder
+    window: float = field(default=DEFAULT_WINDOW)
+    max_messages: int = field(default=DEFAULT_MAX_MESSAGES)
+    max_bytes: int = field(default=DEFAULT_MAX_BYTES)
+    batch_format: BatchFormat = field(default=BatchFormat.NDJSON, converter=BatchFormat)
+    flush_timeout: float = field(default=DEFAULT_FLUSH_TIMEOUT)
+    pending: Dict[bytes, PendingBatch] = field(factory=dict)
+    ready: Deque[PendingBatch] = field(factory=deque)
+    condition: threading.Condition = field(factory=threading.Condition)
+    stopping: bool = field(default=False)
+    thread: Optional[threading.Thread] = field(default=None)
+    batches: int = field(default=0)
+    messages: int = field(default=0)
+    errors: int = field(default=0)
+    timeouts: int = field(default=0)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="aggregating-forwarder", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Forwards what is pending and stops."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def add(self, topic: bytes, payload: bytes) -> PendingBatch:
+        """
+        :raises BatchFlushError: When stopped
+        """
+        unframed = self.batch_format is BatchFormat.NDJSON and b"\n" in payload
+        with self.condition:
+            if self.stopping:
+                raise BatchFlushError("Aggregating forwarder is stopped")
+            batch = self.pending.get(topic)
+            if unframed:
+                # After what is pending for the topic, to keep the order.
+                if batch is not None:
+                    del self.pending[topic]
+                    self.ready.append(batch)
+                batch = PendingBatch(topic=topic, created=time.monotonic(), payloads=[payload], unframed=True)
+                self.ready.append(batch)
+                self.condition.notify()
+                return batch
+            if batch is None:
+                batch = PendingBatch(topic=topic, created=time.monotonic())
+                self.pending[topic] = batch
+            batch.payloads.append(payload)
+            batch.size += len(payload)
+            if len(batch.payloads) >= self.max_messages or batch.size >= self.max_bytes:
+                del self.pending[topic]
+                self.ready.append(batch)
+            self.condition.notify()
+        return batch
+
+    def forward_publish(self, topic: bytes, payload: bytes, qos: int) -> None:
+        batch = self.add(topic, payload)
+        if qos > 0:
+            self.wait(batch)
+
+    def forward_publishes(self, publishes: List[Tuple[bytes, bytes, int]]) -> None:
+        waiting = []
+        for topic, payload, qos in publishes:
+            batch = self.add(topic, payload)
+            if qos > 0:
+                waiting.append(batch)
+        deadline = time.monotonic() + self.flush_timeout
+        for batch in waiting:
+            self.wait(batch, deadline - time.monotonic())
+
+    def wait(self, batch: PendingBatch, timeout: Optional[float] = None):
+        """
+        :raises BatchFlushError: If the batch was not forwarded within timeout, flush_timeout by default
+        """
+        if timeout is None:
+            timeout = self.flush_timeout
+        if not batch.done.wait(max(timeout, 0)):
+            with self.condition:
+                self.timeouts += 1
+            raise BatchFlushError("Timed out waiting for batch to be forwarded")
+        if batch.error is not None:
+            raise BatchFlushError("Unable to forward batch") from batch.error
+
+    def run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                for batch in list(self.pending.values()):
+                    if self.stopping or batch.created + self.window <= now:
+                        del self.pending[batch.topic]
+                        self.ready.append(batch)
+                if not self.ready:
+                    if self.stopping:
+                        return
+                    timeout = None
+                    if self.pending:
+                        timeout = min(batch.created for batch in self.pending.values()) + self.window - now
+                    self.condition.wait(timeout)
+                    continue
+                batches = list(self.ready)
+                self.ready.clear()
+            for batch in batches:
+                self.flush(batch)
+
+    def flush(self, batch: PendingBatch):
+        try:
+            if batch.unframed:
+                payload = batch.payloads[0]
+            else:
+                payload = frame(batch.payloads, self.batch_format)
+            self.forwarder.forward_publish(topic=batch.topic, payload=payload, qos=1)
+            self.batches += 1
+            self.messages += len(batch.payloads)
+        except Exception as e:
+            self.errors += 1
+            batch.error = e
+            LOG.exception("Unable to forward batch", topic=batch.topic, count=len(batch.payloads))
+        finally:
+            batch.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "format": self.batch_format.value,
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": round(self.messages / self.batches, 2) if self.batches else None,
+            "pending": len(self.pending),
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+        }
@@ -0,0 +1,128 @@
+"""
+Stand-ins for the stores and the forwarder used while a batch of datagrams is handled.
+
+The lookups for the whole batch are done up front, with one client store call and one topic store call, and the
+handlers then read from these instead of the store. Writes go through to the store and update what was looked up, so
+a CONNECT followed by a PUBLISH in the same batch behaves as if they arrived one at a time.
+"""
+from typing import *
+
+from attrs import define, field
+
+from mqtt_sn_gateway import client_store, topic_store, forward
+
+
+@define
+class PrefetchedClientStore:
+    store: client_store.ClientStore
+    clients: Dict[Hashable, Optional[bytes]] = field(factory=dict)
+
+    @property
+    def use_port_number(self) -> bool:
+        return self.store.use_port_number
+
+    def key(self, remote_addr: Tuple[str, int]) -> Hashable:
+        if self.use_port_number:
+            return remote_addr[0], remote_addr[1]
+        return remote_addr[0]
+
+    def prefetch(self, remote_addrs: List[Tuple[str, int]]) -> None:
+        """
+        :raises ClientStoreConnectionError: Unable to connect to client store.
+        """
+        remote_addrs = list({self.key(remote_addr): remote_addr for remote_addr in remote_addrs}.values())
+        if not remote_addrs:
+            return
+        for remote_addr, client_id in zip(remote_addrs, self.store.get_clients(remote_addrs)):
+            self.clients[self.key(remote_addr)] = client_id
+
+    def add_client(self, client_id: bytes, remote_addr: Tuple[str, int]) -> None:
+        self.store.add_client(client_id, remote_addr)
+        self.clients[self.key(remote_addr)] = client_id
+
+    def get_client(self, remote_addr: Tuple[str, int]) -> bytes:
+        key = self.key(remote_addr)
+        if key not in self.clients:
+            return self.store.get_client(remote_addr)
+        client_id = self.clients[key]
+        if client_id is None:
+            raise client_store.ClientDoesNotExist("No such client")
+        return client_id
+
+    def get_clients(self, remote_addrs: List[Tuple[str, int]]) -> List[Optional[bytes]]:
+        return self.store.get_clients(remote_addrs)
+
+    def delete_client(self, remote_addr: Tuple[str, int]) -> None:
+        self.store.delete_client(remote_addr)
+        self.clients[self.key(remote_addr)] = None
+
+    def extend_client_ttl(self, remote_addr: Tuple[str, int]) -> None:
+        self.store.extend_client_ttl(remote_addr)
+
+
+@define
+class PrefetchedTopicStore:
+    store: topic_store.TopicStore
+    topics: Dict[Tuple[bytes, int], Optional[bytes]] = field(factory=dict)
+
+    def prefetch(self, lookups: List[Tuple[bytes, int]]) -> None:
+        """
+        :raises TopicStoreConnectionError: Incase unable to connect to topic store
+        """
+        lookups = list(dict.fromkeys(lookups))
+        if not lookups:
+            return
+        self.topics.update(zip(lookups, self.store.get_topics(lookups)))
+
+    def forget(self, client_id: bytes) -> None:
+        for lookup in [lookup for lookup in self.topics if lookup[0] == client_id]:
+            del self.topics[lookup]
+
+    def add_topic_for_client(self, client_id: bytes, topic_name: str) -> int:
+        topic_id = self.store.add_topic_for_client(client_id=client_id, topic_name=topic_name)
+        self.forget(client_id)
+        return topic_id
+
+    def get_topic_for_client(self, client_id: bytes, topic_id: int) -> bytes:
+        lookup = (client_id, topic_id)
+        if lookup not in self.topics:
+            return self.store.get_topic_for_client(client_id, topic_id=topic_id)
+        topic = self.topics[lookup]
+        if topic is None:
+            raise topic_store.TopicDoesNotExist()
+        return topic
+
+    def get_topics(self, lookups: List[Tuple[bytes, int]]) -> List[Optional[bytes]]:
+        return self.store.get_topics(lookups)
+
+    def delete_all_topics(self, client_id: bytes) -> None:
+        self.store.delete_all_topics(client_id)
+        self.forget(client_id)
+
+    def extend_topic_ttl(self, client_id: bytes) -> None:
+        self.store.extend_topic_ttl(client_id)
+
+
+@define
+class DeferredForwarder:
+    """
+    Collects publishes to forward them together when the batch has been handled. index is the position in the batch
+    of the message being handled, so a failed forward can be traced back to its PUBLISH.
+    """
+
+    forwarder: forward.MqttSnForwarder
+    index: int = field(default=0)
+    publishes: List[Tuple[str, bytes, int]] = field(factory=list)
+    indexes: List[int] = field(factory=list)
+
+    def forward_publish(self, topic: str, payload: bytes, qos: int) -> None:
+        self.publishes.append((topic, payload, qos))
+        self.indexes.append(self.index)
+
+    def forward_publishes(self, publishes: List[Tuple[str, bytes, int]]) -> None:
+        for topic, payload, qos in publishes:
+            self.forward_publish(topic, payload, qos)
+
+    def flush(self) -> None:
+        if self.publishes:
+            self.forwarder.forward_publishes(self.publishes)
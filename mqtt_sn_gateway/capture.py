@@ -0,0 +1,173 @@
+import os
+import queue
+import socket
+import struct
+import threading
+from enum import IntEnum
+from typing import *
+
+from attrs import define, field
+import structlog
+
+LOG = structlog.get_logger(__name__)
+
+MAGIC = b"MQSNCAP1"
+
+# direction, unix timestamp, length of the packed ip address
+RECORD_HEAD = struct.Struct("!BdB")
+# port, length of datagram
+RECORD_TAIL = struct.Struct("!HH")
+
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_QUEUE_SIZE = 100_000
+
+
+class Direction(IntEnum):
+    IN = 0
+    OUT = 1
+
+
+class CaptureFormatError(Exception):
+    """File is not a valid capture file"""
+
+
+@define
+class CaptureRecord:
+    direction: Direction
+    timestamp: float
+    remote_addr: Tuple[str, int]
+    data: bytes
+
+
+def pack_record(direction: Direction, timestamp: float, remote_addr: Tuple[str, int], data: bytes) -> bytes:
+    """
+    A record is: direction (1), unix timestamp as double (8), ip length (1), packed ip (4 or 16), port (2),
+    datagram length (2), datagram.
+    """
+    ip, port = remote_addr[0], remote_addr[1]
+    family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+    packed_ip = socket.inet_pton(family, ip)
+    return b"".join(
+        (
+            RECORD_HEAD.pack(direction, timestamp, len(packed_ip)),
+            packed_ip,
+            RECORD_TAIL.pack(port, len(data)),
+            data,
+        )
+    )
+
+
+def read_capture(path: str) -> Iterator[CaptureRecord]:
+    """
+    :raises CaptureFormatError: If the file does not start with the capture header.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise CaptureFormatError(f"{path} is not a capture file")
+        while True:
+            head = f.read(RECORD_HEAD.size)
+            if len(head) < RECORD_HEAD.size:
+                return
+            direction, timestamp, ip_length = RECORD_HEAD.unpack(head)
+            packed_ip = f.read(ip_length)
+            tail = f.read(RECORD_TAIL.size)
+            if len(tail) < RECORD_TAIL.size:
+                # Truncated last record, the gateway was stopped while writing.
+                return
+            port, length = RECORD_TAIL.unpack(tail)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            family = socket.AF_INET6 if ip_length == 16 else socket.AF_INET
+            yield CaptureRecord(
+                direction=Direction(direction),
+                timestamp=timestamp,
+                remote_addr=(socket.inet_ntop(family, packed_ip), port),
+                data=data,
+            )
+
+
+@define
+class CaptureWriter:
+    """
+    Streams datagrams to a rotating capture file.
+
+    Recording only puts a tuple on a queue so the request handlers are not slowed down by disk IO. A background thread
+    packs the records and writes them. When the file grows past max_bytes it is rotated like a
+    logging.handlers.RotatingFileHandler: path.1, path.2 ... up to backup_count files are kept.
+
+    If the writer thread falls behind and the queue is full, records are dropped and counted.
+    """
+
+    path: str
+    max_bytes: int = field(default=DEFAULT_MAX_BYTES)
+    backup_count: int = field(default=DEFAULT_BACKUP_COUNT)
+    queue_size: int = field(default=DEFAULT_QUEUE_SIZE)
+    dropped: int = field(default=0)
+    _queue: queue.Queue = field(init=False)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+    _file: Optional[BinaryIO] = field(init=False, default=None)
+    _size: int = field(init=False, default=0)
+    _lock: threading.Lock = field(init=False, factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self._queue = queue.Queue(maxsize=self.queue_size)
+
+    def start(self):
+        self._open()
+        self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+        self._thread.start()
+        LOG.info("Capturing datagrams", path=self.path, max_bytes=self.max_bytes, backup_count=self.backup_count)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        self._file = None
+
+    def record(self, direction: Direction, timestamp: float, remote_addr: Tuple[str, int], data: bytes):
+        try:
+            self._queue.put_nowait((direction, timestamp, remote_addr, data))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _open(self):
+        self._file = open(self.path, "ab", buffering=64 * 1024)
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._file.write(MAGIC)
+            self._size = len(MAGIC)
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f"{self.path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._file.flush()
+                return
+            try:
+                record = pack_record(*item)
+                if self._size + len(record) > self.max_bytes and self._size > len(MAGIC):
+                    self._rotate()
+                self._file.write(record)
+                self._size += len(record)
+                if self._queue.empty():
+                    self._file.flush()
+            except Exception:
+                LOG.exception("Unable to write capture record", path=self.path)
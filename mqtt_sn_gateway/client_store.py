@@ -1,12 +1,24 @@
-from typing import Tuple, Protocol
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Hashable, List, Optional, Tuple, Protocol
 
-from attrs import define
+from attrs import define, field
 import valkey
 import structlog
 
+from mqtt_sn_gateway.valkey_client import UNAVAILABLE_ERRORS, mget
+
+if TYPE_CHECKING:
+    # Only used when configured, see server.ThreadingUdpServer.
+    from mqtt_sn_gateway.nearcache import NearCache
+    from mqtt_sn_gateway.replicas import ReplicaRouter
+
 LOG = structlog.get_logger(__name__)
 
 CLIENT_TTL = 60 * 60 * 24 * 7  # 7 days in seconds
+UNKNOWN_CLIENT_TTL = 5  # seconds
+UNKNOWN_CLIENT_MAX_SIZE = 100_000
 
 
 class ClientDoesNotExist(Exception):
@@ -32,6 +44,13 @@ class ClientStore(Protocol):
         """
         ...
 
+    def get_clients(self, remote_addrs: List[Tuple[str, int]]) -> List[Optional[bytes]]:
+        """
+        Looks up many clients in one call. Clients that do not exist are None.
+        :raises ClientStoreConnectionError: Unable to connect to client store.
+        """
+        ...
+
     def delete_client(self, remote_addr: Tuple[str, int]) -> None:
         """
         :raises ClientStoreConnectionError: Unable to connect to client store.
@@ -51,22 +70,36 @@ class ValKeyClientStore:
 
     Keyname for data is "client:ip_address:port",
 
+    With replicas, lookups are routed to read replicas and writes stay on the primary.
+
+    With a near cache, lookups are served from process memory and misses are read from the primary.
+
     """
     valkey: valkey.Valkey
     use_port_number: bool
+    replicas: Optional["ReplicaRouter"] = field(default=None)
+    near_cache: Optional["NearCache"] = field(default=None)
+
+    def written(self, key: str):
+        if self.replicas is not None:
+            self.replicas.written(key)
+        if self.near_cache is not None:
+            self.near_cache.written(key)
 
     def key_from_remote_addr(self, remote_addr: Tuple[str, int]) -> str:
         if self.use_port_number:
-            return f"client:{remote_addr[0]}:{remote_addr[1]}"
+            address = f"{remote_addr[0]}:{remote_addr[1]}"
         else:
-            return f"client:{remote_addr[0]}"
+            address = remote_addr[0]
+        return f"client:{address}"
 
     def add_client(self, client_id: bytes, remote_addr: Tuple[str, int]) -> None:
         try:
             key = self.key_from_remote_addr(remote_addr)
             LOG.debug(f"Adding client", client_id=client_id, remote_addr=remote_addr, key=key, ttl=CLIENT_TTL)
             self.valkey.set(name=key, value=client_id, ex=CLIENT_TTL)
-        except valkey.exceptions.ConnectionError as e:
+            self.written(key)
+        except UNAVAILABLE_ERRORS as e:
             LOG.error(f"Connection error when adding client", client_id=client_id, remote_addr=remote_addr)
             raise ConnectionError("Unable to connect to client store") from e
 
@@ -75,23 +108,46 @@ class ValKeyClientStore:
         :raises ClientDoesNotExist: Client does not exist in store
         """
         try:
-
-            client_id = self.valkey.get(name=self.key_from_remote_addr(remote_addr))
+            key = self.key_from_remote_addr(remote_addr)
+            if self.near_cache is not None:
+                client_id = self.near_cache.read_through(key, "GET", lambda: self.valkey.get(name=key))
+            elif self.replicas is not None:
+                client_id = self.replicas.read(key, lambda vk: vk.get(name=key))
+            else:
+                client_id = self.valkey.get(name=key)
             if client_id is None:
                 LOG.error(f"Client does not exist in store", remote_addr=remote_addr)
                 raise ClientDoesNotExist(f"No such client")
             return client_id
 
-        except valkey.exceptions.ConnectionError as e:
+        except UNAVAILABLE_ERRORS as e:
             LOG.error(f"Connection error to client store when getting client data", remote_addr=remote_addr, store=self)
             raise ConnectionError("Unable to connect to client store") from e
 
+    def get_clients(self, remote_addrs: List[Tuple[str, int]]) -> List[Optional[bytes]]:
+        """
+        Uses one MGET for all addresses, or for those not in the near cache.
+        """
+        try:
+            keys = [self.key_from_remote_addr(remote_addr) for remote_addr in remote_addrs]
+            if self.near_cache is not None:
+                return self.near_cache.read_many(
+                    [(key, "GET") for key in keys], lambda indexes: mget(self.valkey, [keys[i] for i in indexes])
+                )
+            if self.replicas is not None:
+                return self.replicas.read_many(keys, lambda vk, indexes: mget(vk, [keys[i] for i in indexes]))
+            return mget(self.valkey, keys)
+        except UNAVAILABLE_ERRORS as e:
+            LOG.error(f"Connection error to client store when getting clients", count=len(remote_addrs), store=self)
+            raise ConnectionError("Unable to connect to client store") from e
 
     def delete_client(self, remote_addr: Tuple[str, int]) -> None:
         try:
             LOG.debug(f"Deleting client", remote_addr=remote_addr)
-            self.valkey.delete(self.key_from_remote_addr(remote_addr))
-        except valkey.exceptions.ConnectionError as e:
+            key = self.key_from_remote_addr(remote_addr)
+            self.valkey.delete(key)
+            self.written(key)
+        except UNAVAILABLE_ERRORS as e:
             LOG.error(f"Connection error to client store when deleting client", remote_addr=remote_addr, store=self)
             raise ConnectionError("Unable to connect to client store") from e
 
@@ -99,6 +155,57 @@ class ValKeyClientStore:
         try:
             LOG.debug(f"Extending client TTL", remote_addr=remote_addr)
             self.valkey.expire(name=self.key_from_remote_addr(remote_addr), time=CLIENT_TTL)
-        except valkey.exceptions.ConnectionError as e:
+        except UNAVAILABLE_ERRORS as e:
             LOG.error(f"Connection error to client store when extending client", remote_addr=remote_addr, store=self)
             raise ConnectionError("Unable to connect to client store") from e
+
+
+@define
+class UnknownClientCache:
+    """
+    Remembers remote addresses that were not found in the client store for a short time. Devices that were not
+    reconnected after the store was flushed keep publishing, and without this every publish is a store lookup and
+    error logs before the DISCONNECT.
+
+    An address is removed when it sends CONNECT on this gateway. On other gateway instances it stays until it expires,
+    so the ttl should be short.
+    """
+
+    use_port_number: bool
+    ttl: float = field(default=UNKNOWN_CLIENT_TTL)
+    max_size: int = field(default=UNKNOWN_CLIENT_MAX_SIZE)
+    expires: "OrderedDict[Hashable, float]" = field(factory=OrderedDict)
+    hits: int = field(default=0)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def key(self, remote_addr: Tuple[str, int]) -> Hashable:
+        if self.use_port_number:
+            return remote_addr[0], remote_addr[1]
+        return remote_addr[0]
+
+    def add(self, remote_addr: Tuple[str, int]) -> None:
+        key = self.key(remote_addr)
+        with self.lock:
+            self.expires[key] = time.monotonic() + self.ttl
+            self.expires.move_to_end(key)
+            while len(self.expires) > self.max_size:
+                self.expires.popitem(last=False)
+
+    def discard(self, remote_addr: Tuple[str, int]) -> None:
+        with self.lock:
+            self.expires.pop(self.key(remote_addr), None)
+
+    def contains(self, remote_addr: Tuple[str, int]) -> bool:
+        key = self.key(remote_addr)
+        with self.lock:
+            expires = self.expires.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.expires[key]
+                return False
+            self.hits += 1
+            return True
+
+    def stats(self) -> dict:
+        return {"size": len(self.expires), "hits": self.hits}
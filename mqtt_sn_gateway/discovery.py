@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import *
+
+from attrs import define, field
+import structlog
+
+from mqtt_sn_gateway import messages
+
+LOG = structlog.get_logger(__name__)
+
+LATENCY_SMOOTHING = 0.05
+SESSION_WINDOW = 300.0  # seconds a remote address counts as a session after its last datagram
+MAX_TRACKED_SESSIONS = 1_000_000
+MAX_SCHEDULED_ANSWERS = 10_000
+
+
+@define
+class LoadMonitor:
+    """
+    Tracks the load of this gateway from requests in flight, smoothed request latency and the number of remote
+    addresses heard from in the last session_window seconds.
+
+    load() is the highest of the three relative to their capacity, so 1.0 means at least one of them is at capacity.
+    """
+
+    max_in_flight: int
+    target_latency: float
+    max_sessions: int
+    session_window: float = field(default=SESSION_WINDOW)
+    in_flight: int = field(default=0)
+    latency: float = field(default=0.0)
+    sessions: "OrderedDict[Tuple[str, int], float]" = field(factory=OrderedDict)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def request_started(self, remote_addr: Tuple[str, int]):
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight += 1
+            self.sessions[remote_addr] = now
+            self.sessions.move_to_end(remote_addr)
+            while self.sessions:
+                oldest, seen = next(iter(self.sessions.items()))
+                if now - seen < self.session_window and len(self.sessions) <= MAX_TRACKED_SESSIONS:
+                    break
+                del self.sessions[oldest]
+
+    def request_done(self, seconds: float, count: int = 1):
+        with self.lock:
+            self.in_flight -= count
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+    def load(self) -> float:
+        return max(
+            self.in_flight / self.max_in_flight,
+            self.latency / self.target_latency,
+            len(self.sessions) / self.max_sessions,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "load": round(self.load(), 3),
+            "in_flight": self.in_flight,
+            "latency_ms": round(self.latency * 1000, 3),
+            "sessions": len(self.sessions),
+        }
+
+
+@define
+class Discovery:
+    """
+    Answers SEARCHGW and sends ADVERTISE depending on load, so devices looking for a gateway find the less loaded
+    ones.
+
+    A SEARCHGW is answered right away when idle and later the higher the load, up to max_answer_delay, so when several
+    gateways hear it the least loaded answers first. At or above full load it is not answered at all. ADVERTISE is
+    sent every advertise_interval seconds, and skipped at full load.
+
+    Delayed answers are sent by one scheduler thread, in the order they are due. When many devices search at once at
+    most max_scheduled answers wait, later ones are dropped and the devices search again.
+    """
+
+    gw_id: int
+    monitor: LoadMonitor
+    max_answer_delay: float
+    advertise_address: Optional[Tuple[str, int]] = field(default=None)
+    advertise_interval: float = field(default=0.0)
+    sock: Optional[socket.socket] = field(default=None)
+    max_scheduled: int = field(default=MAX_SCHEDULED_ANSWERS)
+    scheduled: List[Tuple[float, int, Tuple[str, int], Any]] = field(factory=list)
+    sequence: Iterator[int] = field(factory=itertools.count)
+    condition: threading.Condition = field(factory=threading.Condition)
+    scheduler: Optional[threading.Thread] = field(default=None)
+    answered: int = field(default=0)
+    declined: int = field(default=0)
+    dropped: int = field(default=0)
+    advertised: int = field(default=0)
+    stop_event: threading.Event = field(factory=threading.Event)
+
+    def answer_delay(self) -> Optional[float]:
+        """Seconds to wait before answering a SEARCHGW, or None to not answer."""
+        load = self.monitor.load()
+        with self.condition:
+            if load >= 1.0:
+                self.declined += 1
+                return None
+            self.answered += 1
+        return load * self.max_answer_delay
+
+    def gwinfo(self) -> messages.Gwinfo:
+        return messages.Gwinfo(gw_id=self.gw_id)
+
+    def send_later(self, remote_addr: Tuple[str, int], message: Any, delay: float) -> bool:
+        """Schedules the message. Returns False if it was dropped since max_scheduled are waiting."""
+        with self.condition:
+            if len(self.scheduled) >= self.max_scheduled:
+                self.dropped += 1
+                return False
+            heapq.heappush(self.scheduled, (time.monotonic() + delay, next(self.sequence), remote_addr, message))
+            if self.scheduler is None:
+                self.scheduler = threading.Thread(target=self.send_scheduled, name="searchgw-answers", daemon=True)
+                self.scheduler.start()
+            self.condition.notify()
+        return True
+
+    def send_scheduled(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stop_event.is_set():
+                        return
+                    now = time.monotonic()
+                    if self.scheduled and self.scheduled[0][0] <= now:
+                        _, _, remote_addr, message = heapq.heappop(self.scheduled)
+                        break
+                    self.condition.wait(self.scheduled[0][0] - now if self.scheduled else None)
+            self.send(remote_addr, message)
+
+    def send(self, remote_addr: Tuple[str, int], message: Any):
+        try:
+            self.sock.sendto(message.to_bytes(), remote_addr)
+        except OSError:
+            LOG.exception("Unable to send discovery message", remote_addr=remote_addr, message=message)
+
+    def start_advertising(self):
+        if not self.advertise_interval or self.advertise_address is None:
+            return
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        threading.Thread(target=self.advertise_forever, name="advertise", daemon=True).start()
+        LOG.info("Advertising gateway", gw_id=self.gw_id, address=self.advertise_address,
+                 interval=self.advertise_interval)
+
+    def advertise_forever(self):
+        while True:
+            if self.monitor.load() >= 1.0:
+                LOG.debug("Not advertising, gateway is at full load", **self.monitor.stats())
+            else:
+                self.send(self.advertise_address, messages.Advertise(
+                    gw_id=self.gw_id, duration=min(int(self.advertise_interval), 0xFFFF)
+                ))
+                self.advertised += 1
+            if self.stop_event.wait(self.advertise_interval):
+                return
+
+    def stop(self):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.monitor.stats(),
+            "searchgw_answered": self.answered,
+            "searchgw_declined": self.declined,
+            "searchgw_dropped": self.dropped,
+            "searchgw_scheduled": len(self.scheduled),
+            "advertised": self.advertised,
+        }
@@ -0,0 +1,196 @@
+import socket
+import threading
+import time
+import uuid
+from typing import *
+
+from attrs import define, field
+from kombu import Connection, Exchange, Queue
+import structlog
+
+from mqtt_sn_gateway import messages, topic_store
+from mqtt_sn_gateway.subscriptions import Subscription, SubscriptionIndex, has_wildcards
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+POLL_TIMEOUT = 1.0  # seconds, how often the consumer checks if it should stop
+RECONNECT_DELAY = 1.0  # seconds
+DOWNLINK_FLAGS = messages.Flags(qos=0)
+NO_MSG_ID = b"\x00\x00"
+
+
+def format_mqtt_topic(routing_key: str) -> str:
+    """The reverse of AmqpForwarder.format_amqp_topic."""
+    return routing_key.replace(".", "/").replace("*", "+")
+
+
+def destination(remote_address: Tuple[str, int], data: bytes) -> Tuple[bytes, Tuple[str, int]]:
+    """
+    Devices behind a forwarder have a node address, see gateway.node_address. Their datagrams are encapsulated and
+    sent to the forwarder.
+    """
+    node, at, host = remote_address[0].partition("@")
+    if not at:
+        return data, remote_address
+    encapsulated = messages.Encapsulated(ctrl=0, wireless_node_id=bytes.fromhex(node), data=data)
+    return encapsulated.to_bytes(), (host, remote_address[1])
+
+
+@define
+class DownlinkSender:
+    """
+    Sends a downlink message as QoS 0 PUBLISH to every device with a matching subscription.
+
+    The PUBLISH is encoded once per topic id, not per device. Datagrams are sent batch_size at a time with
+    batch_interval seconds in between, so a message to many devices does not overflow the socket buffer or the radio
+    network behind it.
+
+    For subscriptions with wildcards the topic is registered in the topic store the first time, and a REGISTER is sent
+    to the device before the PUBLISH. The REGACK from the device is handled by the gateway, see
+    SubscriptionIndex.acknowledge.
+    """
+
+    subscriptions: SubscriptionIndex
+    topic_store: topic_store.TopicStore
+    batch_size: int = field(default=DEFAULT_BATCH_SIZE)
+    batch_interval: float = field(default=0.0)
+    sock: Optional[socket.socket] = field(default=None)
+    next_msg_id: int = field(default=0)
+    received: int = field(default=0)
+    sent: int = field(default=0)
+    registers: int = field(default=0)
+    errors: int = field(default=0)
+
+    def msg_id(self) -> bytes:
+        # 0 is not a valid message id.
+        self.next_msg_id = self.next_msg_id % 0xFFFF + 1
+        return self.next_msg_id.to_bytes(2, "big")
+
+    def fan_out(self, topic: str, payload: bytes) -> int:
+        """Returns the number of devices the message was sent to."""
+        self.received += 1
+        matched = self.subscriptions.match(topic)
+        if not matched:
+            LOG.debug("No subscriptions for downlink message", topic=topic)
+            return 0
+        publishes: Dict[int, bytes] = {}
+        datagrams: List[Tuple[bytes, Tuple[str, int]]] = []
+        for subscription in matched:
+            try:
+                topic_id = self.topic_id(subscription, topic, datagrams)
+            except topic_store.ConnectionError:
+                self.errors += 1
+                LOG.error("Unable to connect to topic store. Not sending downlink message",
+                          remote_address=subscription.remote_address, topic=topic)
+                continue
+            data = publishes.get(topic_id)
+            if data is None:
+                data = messages.Publish(flags=DOWNLINK_FLAGS, topic_id=topic_id, msg_id=NO_MSG_ID,
+                                        data=payload).to_bytes()
+                publishes[topic_id] = data
+            datagrams.append(destination(subscription.remote_address, data))
+        LOG.info("Sending downlink message", topic=topic, devices=len(matched))
+        self.send(datagrams)
+        return len(matched)
+
+    def topic_id(
+        self, subscription: Subscription, topic: str, datagrams: List[Tuple[bytes, Tuple[str, int]]]
+    ) -> int:
+        """
+        :raises TopicStoreConnectionError: Incase unable to connect to topic store
+        """
+        if not has_wildcards(subscription.topic_filter):
+            return subscription.topic_id
+        topic_id = subscription.registered.get(topic)
+        if topic_id is None:
+            topic_id = self.topic_store.add_topic_for_client(client_id=subscription.client_id, topic_name=topic)
+            msg_id = self.msg_id()
+            self.subscriptions.registering(subscription, topic, topic_id, msg_id)
+            register = messages.Register(msg_id=msg_id, topic_name=topic, topic_id=topic_id)
+            datagrams.append(destination(subscription.remote_address, register.to_bytes()))
+            self.registers += 1
+        return topic_id
+
+    def send(self, datagrams: List[Tuple[bytes, Tuple[str, int]]]) -> None:
+        for start in range(0, len(datagrams), self.batch_size):
+            if start and self.batch_interval:
+                time.sleep(self.batch_interval)
+            for data, address in datagrams[start:start + self.batch_size]:
+                try:
+                    self.sock.sendto(data, address)
+                    self.sent += 1
+                except OSError:
+                    self.errors += 1
+                    LOG.debug("Unable to send downlink datagram", remote_address=address)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.subscriptions.stats(),
+            "received": self.received,
+            "sent": self.sent,
+            "registers": self.registers,
+            "errors": self.errors,
+        }
+
+
+@define
+class DownlinkConsumer:
+    """
+    Consumes downlink messages from an AMQP topic exchange and hands them to the sender. The routing key is the topic,
+    in the same format the forwarder uses for uplink.
+
+    Every gateway instance has its own exclusive queue bound with binding_key, since devices are only reachable through
+    the instance they subscribed on. Messages are acknowledged once sent, or failed to send, so a broken message is not
+    redelivered forever.
+    """
+
+    url: str
+    exchange: Exchange
+    sender: DownlinkSender
+    binding_key: str = field(default="#")
+    queue_name: str = field(factory=lambda: f"mqtt-sn-downlink-{uuid.uuid4().hex}")
+    stop_event: threading.Event = field(factory=threading.Event)
+    thread: Optional[threading.Thread] = field(default=None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="downlink-consumer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.consume()
+            except Exception:
+                LOG.exception("Error in downlink consumer, reconnecting", exchange=self.exchange.name)
+                self.stop_event.wait(RECONNECT_DELAY)
+
+    def consume(self):
+        queue = Queue(
+            self.queue_name, exchange=self.exchange, routing_key=self.binding_key, exclusive=True, auto_delete=True
+        )
+        with Connection(self.url) as connection:
+            with connection.Consumer(queue, callbacks=[self.on_message]):
+                LOG.info("Consuming downlink messages", exchange=self.exchange.name, binding_key=self.binding_key)
+                while not self.stop_event.is_set():
+                    try:
+                        connection.drain_events(timeout=POLL_TIMEOUT)
+                    except socket.timeout:
+                        pass
+
+    def on_message(self, body: Any, message: Any):
+        try:
+            payload = message.body
+            if isinstance(payload, str):
+                payload = payload.encode()
+            self.sender.fan_out(format_mqtt_topic(message.delivery_info["routing_key"]), payload)
+        except Exception:
+            self.sender.errors += 1
+            LOG.exception("Unable to send downlink message")
+        finally:
+            message.ack()
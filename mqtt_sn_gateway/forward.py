@@ -1,15 +1,30 @@
-from typing import Protocol
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Protocol, Tuple
 
-from attrs import define
+from attrs import define, field
 
-from kombu import Connection, Exchange
+from kombu import Connection, Exchange, Producer
 from kombu.pools import producers
 
 import structlog
 from kombu.transport.virtual import exchange
 
+from mqtt_sn_gateway import profiling, routing
+
 LOG = structlog.get_logger(__name__)
 
+DEFAULT_SHARD_RETRY_AFTER = 5.0  # seconds a failing shard is skipped
+
+
+class ShardPublishError(Exception):
+    """Publishing on a shard failed after the first `sent` publishes were written to it"""
+
+    def __init__(self, message: str, sent: int):
+        super().__init__(message)
+        self.sent = sent
+
 
 class MqttSnForwarder(Protocol):
     """
@@ -19,6 +34,12 @@ class MqttSnForwarder(Protocol):
     def forward_publish(self, topic: str, payload: bytes, qos: int) -> None:
         ...
 
+    def forward_publishes(self, publishes: List[Tuple[str, bytes, int]]) -> None:
+        """
+        Forwards many (topic, payload, qos) at once. If it raises, any of them may not have been forwarded.
+        """
+        ...
+
 
 @define
 class AmqpForwarder:
@@ -31,10 +52,26 @@ class AmqpForwarder:
     Topic names needs to be rewritten to work with AMQP.
     See more here: https://www.rabbitmq.com/docs/mqtt#topic-level-separator-and-wildcards
 
+    With routes, the exchange, delivery mode and priority are chosen per topic. exchange is used for topics no rule
+    matches.
     """
 
     exchange: Exchange
     connection: Connection
+    routes: Optional[routing.RoutingTable] = field(default=None)
+
+    def __attrs_post_init__(self):
+        if self.routes is None:
+            self.routes = routing.RoutingTable(rules=[], default=routing.Route(exchange=self.exchange))
+
+    def route(self, topic: str) -> routing.Route:
+        return self.routes.route(topic)
+
+    def warm_up(self) -> None:
+        """Connects a producer in the pool and declares the exchanges, so the first publish does not have to."""
+        with producers[self.connection].acquire(block=True) as producer:
+            for exchange in self.routes.exchanges():
+                producer.maybe_declare(exchange)
 
     @staticmethod
     def format_amqp_topic(mqtt_topic: bytes) -> str:
@@ -43,12 +80,215 @@ class AmqpForwarder:
 
     def forward_publish(self, topic: str, payload: bytes, qos: int) -> None:
         amqp_topic = self.format_amqp_topic(topic)
-        LOG.info(f"Forwarding data to AMQP", exchange=self.exchange.name, amqp_topic=amqp_topic,
+        route = self.route(topic)
+        LOG.info(f"Forwarding data to AMQP", exchange=route.exchange.name, amqp_topic=amqp_topic,
                  broker_host=self.connection.hostname, broker_port=self.connection.port)
+        timings = profiling.stage_timings
+        if timings is not None:
+            start = time.perf_counter()
         with producers[self.connection].acquire(block=True) as producer:
+            if timings is not None:
+                acquired = time.perf_counter()
+                timings.record("forward.acquire", acquired - start)
             producer.publish(
                 payload,
-                exchange=self.exchange,
+                exchange=route.exchange,
                 routing_key=amqp_topic,
-                declare=[self.exchange]
+                declare=[route.exchange],
+                **route.properties
             )
+            if timings is not None:
+                timings.record("forward.publish", time.perf_counter() - acquired)
+
+    def forward_publishes(self, publishes: List[Tuple[str, bytes, int]]) -> None:
+        """
+        Forwards all publishes with one producer from the pool, so the pool is only acquired once.
+        """
+        routes = [self.route(topic) for topic, _, _ in publishes]
+        LOG.info(f"Forwarding batch to AMQP", exchanges=sorted({route.exchange.name for route in routes}),
+                 count=len(publishes), broker_host=self.connection.hostname, broker_port=self.connection.port)
+        with producers[self.connection].acquire(block=True) as producer:
+            for (topic, payload, qos), route in zip(publishes, routes):
+                producer.publish(
+                    payload,
+                    exchange=route.exchange,
+                    routing_key=self.format_amqp_topic(topic),
+                    declare=[route.exchange],
+                    **route.properties
+                )
+
+
+@define
+class AmqpShard:
+    """
+    One connection and channel to the broker. Publishes on a shard are serialized, so messages for a routing key keep
+    their order.
+    """
+
+    name: str
+    connection: Connection
+    exchange: Exchange
+    producer: Optional[Producer] = field(default=None)
+    down_until: float = field(default=0.0)
+    published: int = field(default=0)
+    errors: int = field(default=0)
+    failovers_in: int = field(default=0)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def connect(self, exchanges: List[Exchange]) -> None:
+        with self.lock:
+            if self.producer is None:
+                self.producer = Producer(self.connection.channel(), exchange=self.exchange)
+            for exchange in exchanges:
+                self.producer.maybe_declare(exchange)
+
+    def publish(self, publishes: List[Tuple[str, bytes, routing.Route]], retry_after: float) -> None:
+        """
+        :raises ShardPublishError: With the number of publishes written before the failure.
+        """
+        timings = profiling.stage_timings
+        if timings is not None:
+            start = time.perf_counter()
+        sent = 0
+        with self.lock:
+            if timings is not None:
+                acquired = time.perf_counter()
+                timings.record("forward.acquire", acquired - start)
+            try:
+                if self.producer is None:
+                    # Declares the exchange on the new channel.
+                    self.producer = Producer(self.connection.channel(), exchange=self.exchange)
+                for routing_key, payload, route in publishes:
+                    if route.exchange is self.exchange:
+                        self.producer.publish(payload, routing_key=routing_key, **route.properties)
+                    else:
+                        # Declared once per channel, kombu remembers what it declared.
+                        self.producer.publish(payload, routing_key=routing_key, exchange=route.exchange,
+                                              declare=[route.exchange], **route.properties)
+                    sent += 1
+            except Exception as e:
+                self.published += sent
+                self.errors += 1
+                self.down_until = time.monotonic() + retry_after
+                self.reset()
+                raise ShardPublishError(f"Unable to publish on AMQP shard {self.name}", sent=sent) from e
+            self.published += sent
+            if timings is not None:
+                timings.record("forward.publish", time.perf_counter() - acquired)
+
+    def reset(self) -> None:
+        self.producer = None
+        try:
+            self.connection.close()
+        except Exception:
+            LOG.debug("Error when closing AMQP connection", shard=self.name)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "published": self.published,
+            "errors": self.errors,
+            "failovers_in": self.failovers_in,
+            "down": self.down_until > time.monotonic(),
+        }
+
+
+@define
+class ShardedAmqpForwarder:
+    """
+    Spreads publishes over several AMQP connections, and optionally several broker nodes, since one connection and
+    channel can only publish so fast.
+
+    The shard is chosen by a hash of the routing key, so all messages for a topic go through the same shard and keep
+    their order. A shard that fails is skipped for retry_after seconds and its publishes go to the next shard, so
+    ordering for its topics is only kept while it is healthy. The forwarder is long lived and shared by all requests.
+
+    Delivery is at least once. Publishes written to a shard before it failed are not sent again on the next shard,
+    but the one that failed is, and it may have reached the broker.
+    """
+
+    shards: List[AmqpShard]
+    retry_after: float = field(default=DEFAULT_SHARD_RETRY_AFTER)
+    routes: Optional[routing.RoutingTable] = field(default=None)
+
+    def __attrs_post_init__(self):
+        if self.routes is None and self.shards:
+            self.routes = routing.RoutingTable(rules=[], default=routing.Route(exchange=self.shards[0].exchange))
+
+    @classmethod
+    def from_urls(
+        cls, urls: List[str], exchange: Exchange, connections_per_url: int = 1, **kwargs
+    ) -> "ShardedAmqpForwarder":
+        shards = []
+        for url in urls:
+            for number in range(connections_per_url):
+                connection = Connection(url)
+                shards.append(AmqpShard(
+                    name=f"{connection.hostname}:{connection.port}/{number}", connection=connection, exchange=exchange
+                ))
+        return cls(shards=shards, **kwargs)
+
+    def warm_up(self) -> None:
+        """
+        Connects every shard.
+
+        :raises ConnectionError: No shard could connect.
+        """
+        connected = 0
+        for shard in self.shards:
+            try:
+                shard.connect(self.routes.exchanges())
+                connected += 1
+            except Exception:
+                LOG.warning("Unable to connect AMQP shard", shard=shard.name)
+                with shard.lock:
+                    shard.reset()
+        if not connected:
+            raise ConnectionError("Unable to connect any AMQP shard")
+
+    def shard_index(self, routing_key: str) -> int:
+        # crc32 instead of hash() so the mapping is the same in every process.
+        return zlib.crc32(routing_key.encode()) % len(self.shards)
+
+    def forward_publish(self, topic: str, payload: bytes, qos: int) -> None:
+        routing_key = AmqpForwarder.format_amqp_topic(topic)
+        self.publish(self.shard_index(routing_key), [(routing_key, payload, self.routes.route(topic))])
+
+    def forward_publishes(self, publishes: List[Tuple[str, bytes, int]]) -> None:
+        by_shard: Dict[int, List[Tuple[str, bytes, routing.Route]]] = {}
+        for topic, payload, qos in publishes:
+            routing_key = AmqpForwarder.format_amqp_topic(topic)
+            by_shard.setdefault(self.shard_index(routing_key), []).append(
+                (routing_key, payload, self.routes.route(topic))
+            )
+        for index, shard_publishes in by_shard.items():
+            self.publish(index, shard_publishes)
+
+    def publish(self, index: int, publishes: List[Tuple[str, bytes, routing.Route]]) -> None:
+        """
+        Publishes on the shard at index, or the next available shard if it is down or fails. Only what a failed shard
+        did not write goes to the next one.
+        """
+        now = time.monotonic()
+        count = len(self.shards)
+        candidates = [self.shards[(index + offset) % count] for offset in range(count)]
+        available = [shard for shard in candidates if shard.down_until <= now]
+        # With every shard down, try the own shard anyway in case the broker is back.
+        for shard in available or candidates[:1]:
+            try:
+                shard.publish(publishes, self.retry_after)
+            except ShardPublishError as e:
+                LOG.exception("Unable to publish on AMQP shard", shard=shard.name, count=len(publishes), sent=e.sent)
+                publishes = publishes[e.sent:]
+                continue
+            if shard is not candidates[0]:
+                shard.failovers_in += 1
+            return
+        raise ConnectionError("Unable to publish on any AMQP shard")
+
+    def close(self) -> None:
+        for shard in self.shards:
+            with shard.lock:
+                shard.reset()
+
+    def stats(self) -> Dict[str, Any]:
+        return {shard.name: shard.stats() for shard in self.shards}
@@ -0,0 +1,104 @@
+import threading
+from collections import deque
+from enum import Enum
+from typing import *
+
+from attrs import define, field
+import structlog
+
+from mqtt_sn_gateway import forward
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_MAX_SIZE = 10_000
+DEFAULT_WORKERS = 2
+MAX_BULK = 100  # publishes a worker takes from the queue at a time
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+
+
+@define
+class QueuedForwarder:
+    """
+    Puts publishes on a bounded in-memory queue that worker threads forward, so the request does not wait for the
+    broker. Used for QoS 0 where the device does not expect an acknowledgement.
+
+    When the queue is full a publish is dropped, either the oldest one in the queue or the new one. With more than one
+    worker publishes on the same topic may be forwarded out of order.
+    """
+
+    forwarder: forward.MqttSnForwarder
+    max_size: int = field(default=DEFAULT_MAX_SIZE)
+    workers: int = field(default=DEFAULT_WORKERS)
+    policy: OverflowPolicy = field(default=OverflowPolicy.DROP_OLDEST, converter=OverflowPolicy)
+    queue: Deque[Tuple[bytes, bytes, int]] = field(factory=deque)
+    condition: threading.Condition = field(factory=threading.Condition)
+    stopping: bool = field(default=False)
+    threads: List[threading.Thread] = field(factory=list)
+    enqueued: int = field(default=0)
+    forwarded: int = field(default=0)
+    dropped: int = field(default=0)
+    errors: int = field(default=0)
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f"forward-queue-{number}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Forwards what is queued and stops the workers."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def forward_publish(self, topic: bytes, payload: bytes, qos: int) -> None:
+        with self.condition:
+            if len(self.queue) >= self.max_size:
+                self.dropped += 1
+                if self.policy is OverflowPolicy.DROP_NEWEST:
+                    LOG.debug("Forward queue full, dropping publish", topic=topic)
+                    return
+                self.queue.popleft()
+                LOG.debug("Forward queue full, dropping oldest publish")
+            self.queue.append((topic, payload, qos))
+            self.enqueued += 1
+            self.condition.notify()
+
+    def forward_publishes(self, publishes: List[Tuple[bytes, bytes, int]]) -> None:
+        for topic, payload, qos in publishes:
+            self.forward_publish(topic, payload, qos)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                publishes = [self.queue.popleft() for _ in range(min(MAX_BULK, len(self.queue)))]
+            try:
+                self.forwarder.forward_publishes(publishes)
+            except Exception:
+                with self.condition:
+                    self.errors += 1
+                LOG.exception("Unable to forward queued publishes", count=len(publishes))
+            else:
+                with self.condition:
+                    self.forwarded += len(publishes)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy.value,
+            "size": len(self.queue),
+            "max_size": self.max_size,
+            "enqueued": self.enqueued,
+            "forwarded": self.forwarded,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
@@ -1,12 +1,36 @@
-from typing import Tuple
+import time
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
+import attrs
 from attrs import define, field
 
-from mqtt_sn_gateway import messages, forward, client_store, topic_store
+from mqtt_sn_gateway import messages, forward, client_store, topic_store, profiling, tracing
 import structlog
 
+if TYPE_CHECKING:
+    # Optional features, imported and created by server.ThreadingUdpServer only when configured.
+    from mqtt_sn_gateway import batch, discovery, ratelimit, subscriptions, traffic
+
 LOG = structlog.get_logger(__name__)
 
+# Sent to devices the client store does not know. Shared since it never changes.
+UNKNOWN_CLIENT_RESPONSE = messages.Disconnect()
+# Messages that look up the client and add unknown addresses to the unknown client cache. Compared by type, since
+# Unsubscribe is a Subscribe and does not look up the client.
+UNKNOWN_CLIENT_MESSAGES = frozenset({messages.Register, messages.Publish, messages.Subscribe})
+
+
+def node_address(remote_address: Tuple[str, int], wireless_node_id: bytes) -> Tuple[str, int]:
+    """
+    Address used as the session key of a device behind a forwarder. Wireless node ids are only unique per forwarder,
+    so the forwarder address is part of it.
+    """
+    return f"{wireless_node_id.hex()}@{remote_address[0]}", remote_address[1]
+
+
+def is_node_address(remote_address: Tuple[str, int]) -> bool:
+    return "@" in remote_address[0]
+
 
 class MessageError(Exception):
     """"""
@@ -18,39 +42,241 @@ class ForwardingError(Exception):
 
 @define
 class MqttSnGateway:
-    remote_address: Tuple[str, int]
+    """
+    Handles MQTT-SN messages. Created once and shared by all requests, so it must not keep per-request state: the
+    remote address of a message is passed with it, and the stores and forwarders are thread safe.
+    """
+
     topic_store: topic_store.TopicStore
     client_store: client_store.ClientStore
     forwarder: forward.MqttSnForwarder
     extend_store_ttl_on_publish: bool = field(default=True)
+    rate_limiter: Optional["ratelimit.RateLimiter"] = field(default=None)
+    unknown_clients: Optional[client_store.UnknownClientCache] = field(default=None)
+    # QoS 0 publishes go here instead of to the forwarder when set, usually a queue so they are not waited on.
+    qos0_forwarder: Optional[forward.MqttSnForwarder] = field(default=None)
+    discovery: Optional["discovery.Discovery"] = field(default=None)
+    # Downlink subscriptions. SUBSCRIBE is answered with NOT_SUPPORTED when not set.
+    subscriptions: Optional["subscriptions.SubscriptionIndex"] = field(default=None)
+    # Publishes and bytes per topic and client id, see traffic.TrafficStats.
+    traffic: Optional["traffic.TrafficStats"] = field(default=None)
 
     def forward(self, topic: str, payload: bytes, qos: int):
+        forwarder = self.forwarder
+        if qos == 0 and self.qos0_forwarder is not None:
+            forwarder = self.qos0_forwarder
         try:
-            self.forwarder.forward_publish(topic=topic, payload=payload, qos=qos)
+            with tracing.stage("forward"):
+                forwarder.forward_publish(topic=topic, payload=payload, qos=qos)
         except Exception:
             LOG.exception("Error when forwarding message")
             raise ForwardingError
 
-    def dispatch(self, data: bytes):
+    def parse(self, data: bytes) -> messages.MqttSnMessage:
+        timings = profiling.stage_timings
+        if timings is not None:
+            start = time.perf_counter()
         try:
-            message = messages.MessageFactory.from_bytes(data)
-            LOG.info(f"Received MQTT-SN message", message=message)
-            if isinstance(message, messages.Connect):
-                response = self.handle_connect(message)
-            elif isinstance(message, messages.Register):
-                response = self.handle_register(message)
-
-            elif isinstance(message, messages.Publish):
-                response = self.handle_publish(message)
-            elif isinstance(message, messages.Pingreq):
-                response = self.handle_ping(message)
-            else:
-                raise MessageError(f"Gateway cannot handle message")
-            LOG.info(f"Returning MQTT-SN message", message=response)
-            return response
+            with tracing.stage("parse"):
+                message = messages.MessageFactory.from_bytes(data)
         except messages.ParsingError:
             LOG.exception("MQTT-SN Parsing Error", data=data)
             raise MessageError("MQTT-SN Parsing")
+        if timings is not None:
+            timings.record("dispatch.parse", time.perf_counter() - start)
+        return message
+
+    def dispatch(self, data: bytes, remote_address: Tuple[str, int]):
+        if messages.is_encapsulated(data):
+            return self.dispatch_encapsulated(data, remote_address)
+        return self.dispatch_message(self.parse(data), remote_address)
+
+    def dispatch_encapsulated(
+        self, data: bytes, remote_address: Tuple[str, int]
+    ) -> Optional[messages.EncapsulatedFrames]:
+        """
+        Handles all encapsulated messages in a datagram from a forwarder as one batch. Each wireless node is its own
+        session. The responses are encapsulated for their node and returned together in one datagram.
+        """
+        try:
+            with tracing.stage("parse"):
+                frames = messages.parse_encapsulated(data)
+        except messages.ParsingError:
+            LOG.exception("MQTT-SN Parsing Error", data=data)
+            raise MessageError("MQTT-SN Parsing")
+
+        responses = self.dispatch_batch(
+            [(frame.data, node_address(remote_address, frame.wireless_node_id)) for frame in frames]
+        )
+        out = []
+        for frame, response in zip(frames, responses):
+            if isinstance(response, MessageError):
+                LOG.warning("Unable to handle encapsulated message", wireless_node_id=frame.wireless_node_id.hex(),
+                            error=str(response))
+                continue
+            if response is None:
+                continue
+            out.append(messages.Encapsulated(
+                ctrl=frame.ctrl, wireless_node_id=frame.wireless_node_id, data=response.to_bytes()
+            ))
+        if not out:
+            return None
+        return messages.EncapsulatedFrames(frames=out)
+
+    def dispatch_batch(
+        self, datagrams: List[Tuple[bytes, Tuple[str, int]]]
+    ) -> List[Union[messages.MqttSnMessage, MessageError, None]]:
+        """
+        Handles datagrams that arrived together and returns the responses in the same order. Each response is what
+        dispatch() would have returned for the datagram, or the MessageError it would have raised.
+
+        Client ids for all REGISTER and PUBLISH are looked up with one client store call, then topics for all
+        PUBLISH with one topic store call. If a lookup fails the messages fall back to their own lookups, so errors
+        are reported per message as before. Publishes are forwarded together after all messages are handled, and
+        if that fails every PUBLISH in the batch gets CONGESTION.
+        """
+        responses: List[Union[messages.MqttSnMessage, MessageError, None]] = [None] * len(datagrams)
+        parsed: List[Tuple[int, messages.MqttSnMessage, Tuple[str, int]]] = []
+        for index, (data, remote_address) in enumerate(datagrams):
+            try:
+                if messages.is_encapsulated(data):
+                    # A batch of its own, since the sessions are those of the nodes behind the forwarder.
+                    responses[index] = self.dispatch_encapsulated(data, remote_address)
+                else:
+                    parsed.append((index, self.parse(data), remote_address))
+            except MessageError as e:
+                responses[index] = e
+
+        # Imported on the first batch, single datagrams without forwarders never need it.
+        from mqtt_sn_gateway import batch
+
+        clients = batch.PrefetchedClientStore(store=self.client_store)
+        topics = batch.PrefetchedTopicStore(store=self.topic_store)
+        forwarder = batch.DeferredForwarder(forwarder=self.forwarder)
+        self.prefetch(parsed, clients, topics)
+        gw = attrs.evolve(self, client_store=clients, topic_store=topics, forwarder=forwarder)
+
+        for index, message, remote_address in parsed:
+            structlog.contextvars.unbind_contextvars("client_id")
+            structlog.contextvars.bind_contextvars(remote_ip=remote_address[0], remote_port=remote_address[1])
+            forwarder.index = index
+            try:
+                responses[index] = gw.dispatch_message(message, remote_address)
+            except MessageError as e:
+                responses[index] = e
+        structlog.contextvars.unbind_contextvars("client_id", "remote_ip", "remote_port")
+
+        try:
+            with tracing.stage("forward"):
+                forwarder.flush()
+        except Exception:
+            LOG.exception("Unable to forward batch", count=len(forwarder.publishes))
+            published = {index: message for index, message, _ in parsed}
+            for index in forwarder.indexes:
+                message = published[index]
+                responses[index] = messages.Puback(
+                    topic_id=message.topic_id, msg_id=message.msg_id, return_code=messages.ReturnCode.CONGESTION
+                )
+        return responses
+
+    def prefetch(
+        self,
+        parsed: List[Tuple[int, messages.MqttSnMessage, Tuple[str, int]]],
+        clients: "batch.PrefetchedClientStore",
+        topics: "batch.PrefetchedTopicStore",
+    ):
+        """Looks up clients and topics for the batch. Failures are left to the handlers to report."""
+        lookups = [
+            (message, remote_address) for _, message, remote_address in parsed
+            if isinstance(message, (messages.Register, messages.Publish))
+        ]
+        try:
+            with tracing.stage("client_store"):
+                clients.prefetch([remote_address for _, remote_address in lookups])
+        except client_store.ConnectionError:
+            LOG.warning("Unable to look up clients for batch", count=len(lookups))
+            return
+        topic_lookups = []
+        for message, remote_address in lookups:
+            client_id = clients.clients.get(clients.key(remote_address))
+            if isinstance(message, messages.Publish) and client_id is not None:
+                topic_lookups.append((client_id, message.topic_id))
+        try:
+            with tracing.stage("topic_store"):
+                topics.prefetch(topic_lookups)
+        except topic_store.ConnectionError:
+            LOG.warning("Unable to look up topics for batch", count=len(topic_lookups))
+
+    def dispatch_message(self, message: messages.MqttSnMessage, remote_address: Tuple[str, int]):
+        timings = profiling.stage_timings
+        if timings is not None:
+            start = time.perf_counter()
+
+        trace = tracing.current()
+        if trace is not None:
+            trace.message_type = message.msg_type.name
+        if self.rate_limiter is not None and not self.rate_limiter.allow_address(remote_address):
+            return self.rate_limited(message)
+        if (
+            self.unknown_clients is not None
+            and type(message) in UNKNOWN_CLIENT_MESSAGES
+            and self.unknown_clients.contains(remote_address)
+        ):
+            # Answered without store access or logging, the address was unknown a moment ago.
+            return UNKNOWN_CLIENT_RESPONSE
+        LOG.info(f"Received MQTT-SN message", message=message)
+        response = self.handle(message, remote_address)
+        if timings is not None:
+            timings.record(f"dispatch.{message.msg_type.name}", time.perf_counter() - start)
+        LOG.info(f"Returning MQTT-SN message", message=response)
+        return response
+
+    def handle(self, message: messages.MqttSnMessage, remote_address: Tuple[str, int]):
+        if isinstance(message, messages.Connect):
+            return self.handle_connect(message, remote_address)
+        elif isinstance(message, messages.Register):
+            return self.handle_register(message, remote_address)
+        elif isinstance(message, messages.Publish):
+            return self.handle_publish(message, remote_address)
+        elif isinstance(message, messages.Pingreq):
+            return self.handle_ping(message)
+        elif isinstance(message, messages.Searchgw):
+            return self.handle_searchgw(message, remote_address)
+        elif isinstance(message, messages.Unsubscribe):
+            return self.handle_unsubscribe(message, remote_address)
+        elif isinstance(message, messages.Subscribe):
+            return self.handle_subscribe(message, remote_address)
+        elif isinstance(message, messages.Regack):
+            return self.handle_regack(message, remote_address)
+        elif isinstance(message, messages.Puback):
+            return self.handle_puback(message, remote_address)
+        else:
+            raise MessageError(f"Gateway cannot handle message")
+
+    def rate_limited(self, message: messages.MqttSnMessage):
+        """
+        Response to a message that is over the rate limit. Either CONGESTION, so the device backs off, or nothing.
+        Not logged above debug since offenders would flood the logs.
+        """
+        LOG.debug("Rate limited", message_type=message.msg_type.name)
+        if self.rate_limiter.drops:
+            return None
+        if isinstance(message, messages.Connect):
+            return messages.Connack(return_code=messages.ReturnCode.CONGESTION)
+        elif isinstance(message, messages.Register):
+            return messages.Regack(topic_id=None, msg_id=message.msg_id, return_code=messages.ReturnCode.CONGESTION)
+        elif isinstance(message, messages.Publish):
+            return messages.Puback(topic_id=message.topic_id, msg_id=message.msg_id,
+                                   return_code=messages.ReturnCode.CONGESTION)
+        elif isinstance(message, messages.Unsubscribe):
+            # UNSUBACK has no return code.
+            return None
+        elif isinstance(message, messages.Subscribe):
+            return self.suback(message, return_code=messages.ReturnCode.CONGESTION)
+        return None
+
+    def client_rate_limited(self, client_id: bytes) -> bool:
+        return self.rate_limiter is not None and not self.rate_limiter.allow_client(client_id)
 
     def handle_ping(self, message: messages.Pingreq):
         if message.client_id:
@@ -58,7 +284,26 @@ class MqttSnGateway:
         LOG.info(f"Received PINGREG, returning PINGRESP")
         return messages.Pingresp()
 
-    def handle_connect(self, message: messages.Connect):
+    def handle_searchgw(self, message: messages.Searchgw, remote_address: Tuple[str, int]):
+        """
+        Answered with GWINFO, later the more loaded the gateway is, or not at all at full load. See Discovery.
+        """
+        if self.discovery is None:
+            return None
+        delay = self.discovery.answer_delay()
+        if delay is None:
+            LOG.info("Not answering SEARCHGW, gateway is at full load")
+            return None
+        # Devices behind a forwarder are answered right away, the response has to go back encapsulated.
+        if delay <= 0 or is_node_address(remote_address):
+            return self.discovery.gwinfo()
+        if self.discovery.send_later(remote_address, self.discovery.gwinfo(), delay):
+            LOG.info("Answering SEARCHGW later", delay=round(delay, 3))
+        else:
+            LOG.info("Not answering SEARCHGW, too many answers are waiting")
+        return None
+
+    def handle_connect(self, message: messages.Connect, remote_address: Tuple[str, int]):
         """
         Clients need to connec and set up last will and testament. We dont handle last will and testament so
         it is possible to just return a CONNACK
@@ -67,12 +312,19 @@ class MqttSnGateway:
 
         structlog.contextvars.bind_contextvars(client_id=client_id)
 
+        if self.client_rate_limited(client_id):
+            return self.rate_limited(message)
+
         if message.flags.clean_session:
             LOG.info(f"Client requested clean session. Deleting saved topics.", client_id=client_id)
-            self.topic_store.delete_all_topics(client_id)
+            with tracing.stage("topic_store"):
+                self.topic_store.delete_all_topics(client_id)
+            if self.subscriptions is not None:
+                self.subscriptions.remove_address(remote_address)
 
         try:
-            self.client_store.add_client(client_id, remote_addr=self.remote_address)
+            with tracing.stage("client_store"):
+                self.client_store.add_client(client_id, remote_addr=remote_address)
             LOG.info(f"Client stored",
                      client_store=self.client_store)
         except client_store.ConnectionError:
@@ -83,19 +335,29 @@ class MqttSnGateway:
                           client_store=self.client_store)
             return messages.Connack(return_code=messages.ReturnCode.CONGESTION)
 
+        if self.unknown_clients is not None:
+            self.unknown_clients.discard(remote_address)
+        if self.subscriptions is not None and not message.flags.clean_session:
+            moved = self.subscriptions.move_client(client_id, remote_address)
+            if moved:
+                LOG.info("Moved subscriptions of client to its new address", subscriptions=moved)
+            self.subscriptions.touch(remote_address)
         response = messages.Connack(return_code=messages.ReturnCode.ACCEPTED)
         return response
 
-    def handle_register(self, message: messages.Register):
+    def handle_register(self, message: messages.Register, remote_address: Tuple[str, int]):
         """
         Registers topics from the client.
         """
         try:
-            client_id = self.client_store.get_client(self.remote_address)
+            with tracing.stage("client_store"):
+                client_id = self.client_store.get_client(remote_address)
             structlog.contextvars.bind_contextvars(client_id=client_id)
         except client_store.ClientDoesNotExist:
             LOG.info(f"Received a REGISTER message from an unknown client, sending DISCONNECT")
-            return messages.Disconnect()
+            if self.unknown_clients is not None:
+                self.unknown_clients.add(remote_address)
+            return UNKNOWN_CLIENT_RESPONSE
         except client_store.ConnectionError:
             LOG.error(f"Unable to connect to client store. Returning CONGESTION", client_store=self.client_store)
             return messages.Regack(topic_id=None, msg_id=message.msg_id, return_code=messages.ReturnCode.CONGESTION)
@@ -103,10 +365,14 @@ class MqttSnGateway:
             LOG.exception("Unable to retrieve client_id from client store")
             return messages.Regack(topic_id=None, msg_id=message.msg_id, return_code=messages.ReturnCode.CONGESTION)
 
+        if self.client_rate_limited(client_id):
+            return self.rate_limited(message)
+
         try:
-            topic_id = self.topic_store.add_topic_for_client(
-                topic_name=message.topic_name, client_id=client_id
-            )
+            with tracing.stage("topic_store"):
+                topic_id = self.topic_store.add_topic_for_client(
+                    topic_name=message.topic_name, client_id=client_id
+                )
         except topic_store.ConnectionError:
             LOG.error(f"Unable to connect to topic store. Returning CONGESTION", topic_store=self.topic_store)
             return messages.Regack(topic_id=None, msg_id=message.msg_id, return_code=messages.ReturnCode.CONGESTION)
@@ -126,13 +392,111 @@ class MqttSnGateway:
             return_code=messages.ReturnCode.ACCEPTED,
         )
 
-    def handle_publish(self, message: messages.Publish):
+    @staticmethod
+    def suback(message: messages.Subscribe, return_code: messages.ReturnCode, topic_id: int = 0) -> messages.Suback:
+        # Downlink messages are only sent with QoS 0.
+        return messages.Suback(
+            flags=messages.Flags(qos=0), topic_id=topic_id, msg_id=message.msg_id, return_code=return_code
+        )
+
+    def handle_subscribe(self, message: messages.Subscribe, remote_address: Tuple[str, int]):
+        """
+        Subscribes the client to downlink messages, see downlink.DownlinkSender. Only topic names are supported, with
+        or without wildcards. A topic name without wildcards is registered like with REGISTER and its topic id is
+        returned.
+        """
+        if self.subscriptions is None:
+            LOG.info("Received SUBSCRIBE but downlink is not enabled")
+            return self.suback(message, return_code=messages.ReturnCode.NOT_SUPPORTED)
+        if message.flags.topic_type != messages.TopicType.NORMAL:
+            LOG.info("Received SUBSCRIBE to a predefined or short topic, which is not supported")
+            return self.suback(message, return_code=messages.ReturnCode.NOT_SUPPORTED)
+        if not self.subscriptions.is_valid_filter(message.topic_name):
+            LOG.info("Received SUBSCRIBE to an invalid topic filter", topic_filter=message.topic_name)
+            return self.suback(message, return_code=messages.ReturnCode.INVALID_TOPIC)
+
+        try:
+            with tracing.stage("client_store"):
+                client_id = self.client_store.get_client(remote_address)
+            structlog.contextvars.bind_contextvars(client_id=client_id)
+        except client_store.ClientDoesNotExist:
+            LOG.info(f"Received a SUBSCRIBE message from an unknown client, sending DISCONNECT")
+            if self.unknown_clients is not None:
+                self.unknown_clients.add(remote_address)
+            return UNKNOWN_CLIENT_RESPONSE
+        except client_store.ConnectionError:
+            LOG.error(f"Unable to connect to client store. Returning CONGESTION", client_store=self.client_store)
+            return self.suback(message, return_code=messages.ReturnCode.CONGESTION)
+        except Exception:
+            LOG.exception("Unable to retrieve client_id from client store")
+            return self.suback(message, return_code=messages.ReturnCode.CONGESTION)
+
+        if self.client_rate_limited(client_id):
+            return self.rate_limited(message)
+
+        topic_id = 0
+        if not self.subscriptions.has_wildcards(message.topic_name):
+            try:
+                with tracing.stage("topic_store"):
+                    topic_id = self.topic_store.add_topic_for_client(
+                        topic_name=message.topic_name, client_id=client_id
+                    )
+            except topic_store.ConnectionError:
+                LOG.error(f"Unable to connect to topic store. Returning CONGESTION", topic_store=self.topic_store)
+                return self.suback(message, return_code=messages.ReturnCode.CONGESTION)
+            except Exception:
+                LOG.exception("Unable to register topic in topic store")
+                return self.suback(message, return_code=messages.ReturnCode.CONGESTION)
+
+        self.subscriptions.subscribe_client(remote_address, client_id, message.topic_name, topic_id)
+        LOG.info("Subscribed", topic_filter=message.topic_name, topic_id=topic_id)
+        return self.suback(message, return_code=messages.ReturnCode.ACCEPTED, topic_id=topic_id)
+
+    def handle_unsubscribe(self, message: messages.Unsubscribe, remote_address: Tuple[str, int]):
+        if self.subscriptions is not None and message.topic_name is not None:
+            removed = self.subscriptions.unsubscribe(remote_address, message.topic_name)
+            LOG.info("Unsubscribed", topic_filter=message.topic_name, removed=removed)
+        return messages.Unsuback(msg_id=message.msg_id)
+
+    def handle_regack(self, message: messages.Regack, remote_address: Tuple[str, int]):
+        """
+        A device acknowledging a REGISTER sent with a downlink message, see downlink.DownlinkSender. Nothing is sent
+        back.
+        """
+        if self.subscriptions is None:
+            LOG.info("Received REGACK but downlink is not enabled")
+            return None
+        accepted = message.return_code == messages.ReturnCode.ACCEPTED
+        if not self.subscriptions.acknowledge(remote_address, message.msg_id, accepted):
+            LOG.info("Received REGACK for an unknown REGISTER", msg_id=message.msg_id)
+        elif not accepted:
+            LOG.warning("Device rejected downlink topic, registering it again with the next message",
+                        topic_id=message.topic_id, return_code=message.return_code.name)
+        return None
+
+    def handle_puback(self, message: messages.Puback, remote_address: Tuple[str, int]):
+        """
+        A device acknowledging or rejecting a downlink PUBLISH. Nothing is sent back. If the device does not know the
+        topic id, the topic is registered with it again with the next message.
+        """
+        if message.return_code == messages.ReturnCode.ACCEPTED:
+            return None
+        LOG.info("Device rejected downlink PUBLISH", topic_id=message.topic_id,
+                 return_code=message.return_code.name)
+        if self.subscriptions is not None and message.return_code == messages.ReturnCode.INVALID_TOPIC:
+            self.subscriptions.forget_topic_id(remote_address, message.topic_id)
+        return None
+
+    def handle_publish(self, message: messages.Publish, remote_address: Tuple[str, int]):
         try:
-            client_id = self.client_store.get_client(self.remote_address)
+            with tracing.stage("client_store"):
+                client_id = self.client_store.get_client(remote_address)
             structlog.contextvars.bind_contextvars(client_id=client_id)
         except client_store.ClientDoesNotExist:
             LOG.error(f"Received a PUBLISH from an unknown client, sending DISCONNECT")
-            return messages.Disconnect()
+            if self.unknown_clients is not None:
+                self.unknown_clients.add(remote_address)
+            return UNKNOWN_CLIENT_RESPONSE
         except client_store.ConnectionError:
             LOG.error(f"Unable to connect to client store. Returning CONGESTION", client_store=self.client_store)
             return messages.Puback(topic_id=message.topic_id, msg_id=message.msg_id,
@@ -142,6 +506,9 @@ class MqttSnGateway:
             return messages.Puback(topic_id=message.topic_id, msg_id=message.msg_id,
                                    return_code=messages.ReturnCode.CONGESTION)
 
+        if self.client_rate_limited(client_id):
+            return self.rate_limited(message)
+
         if message.flags.qos not in [0, 1]:
             LOG.error(f"Received a PUBLISH with unsupported QOS", message=message)
             return messages.Puback(
@@ -151,8 +518,9 @@ class MqttSnGateway:
             )
 
         try:
-            topic = self.topic_store.get_topic_for_client(
-                client_id, topic_id=message.topic_id)
+            with tracing.stage("topic_store"):
+                topic = self.topic_store.get_topic_for_client(
+                    client_id, topic_id=message.topic_id)
         except topic_store.TopicDoesNotExist:
             LOG.error(f"Registered client tried to publish to a topic that is not registered", topic=message.topic_id)
             return messages.Puback(
@@ -169,6 +537,16 @@ class MqttSnGateway:
             return messages.Puback(topic_id=message.topic_id, msg_id=message.msg_id,
                                    return_code=messages.ReturnCode.CONGESTION)
 
+        if self.traffic is not None:
+            self.traffic.record(client_id, topic, len(message.data))
+
+        try:
+            tracing.check_deadline()
+        except tracing.DeadlineExceeded:
+            LOG.warning("PUBLISH passed its deadline before forwarding. Dropping it, the device will retransmit",
+                        topic=topic)
+            return None
+
         try:
             self.forward(topic=topic, payload=message.data, qos=message.flags.qos)
         except ForwardingError:
@@ -184,8 +562,10 @@ class MqttSnGateway:
         if self.extend_store_ttl_on_publish:
             try:
                 LOG.debug(f"Extending TTL of client store and topic store")
-                self.client_store.extend_client_ttl(remote_addr=self.remote_address)
-                self.topic_store.extend_topic_ttl(client_id=client_id)
+                with tracing.stage("client_store"):
+                    self.client_store.extend_client_ttl(remote_addr=remote_address)
+                with tracing.stage("topic_store"):
+                    self.topic_store.extend_topic_ttl(client_id=client_id)
             except client_store.ConnectionError:
                 # We don't care that much that we could not set expire
                 LOG.error(f"Unable to connect to client store when extending client ttl")
@@ -193,7 +573,12 @@ class MqttSnGateway:
             except topic_store.ConnectionError:
                 LOG.error(f"Unable to connect to topic store when extending topic ttl")
                 pass
+            if self.subscriptions is not None:
+                self.subscriptions.touch(remote_address)
 
+        if message.flags.qos == 0:
+            # Only errors are acknowledged for QoS 0.
+            return None
 
         return messages.Puback(
             topic_id=message.topic_id,
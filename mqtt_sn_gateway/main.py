@@ -1,11 +1,14 @@
+import time
+
+# Startup is measured from here, see --profile-startup.
+STARTED = time.perf_counter()
+
 import logging
 
 import structlog
 import click
+from mqtt_sn_gateway import profiling
 from mqtt_sn_gateway.config import Config
-from mqtt_sn_gateway.server import ThreadingUdpServer, MqttSnRequestHandler
-import sentry_sdk
-from structlog_sentry import SentryProcessor
 
 LOG = structlog.get_logger()
 
@@ -15,22 +18,26 @@ LOG = structlog.get_logger()
 @click.option("--env-file", default=None, help="Path to .env file", envvar="MQTTSN_ENV_FILE")
 @click.option("--no-env-files", is_flag=True, help="Discard all use of .env files.", envvar="MQTTSN_NO_ENV_FILES")
 @click.option("--json-logs", is_flag=True, help="Outputs logs in JSON-format", envvar="MQTTSN_JSON_LOGS")
-def main(debug, env_file, no_env_files: bool, json_logs: bool):
+@click.option(
+    "--profile-startup",
+    is_flag=True,
+    help="Run startup under cProfile, write the stats to MQTTSN_PROFILE_DIR and exit when ready.",
+    envvar="MQTTSN_PROFILE_STARTUP",
+)
+def main(debug, env_file, no_env_files: bool, json_logs: bool, profile_startup: bool):
     """
     Will assume there is a .env file in the root of the package. This is for simple development.
     To use .env files as in production use the --env-file arg to specify path.
     To make force the application to discard all .env files use the --no-env-files flag.
 
     """
+    startup = profiling.StartupProfile(started=STARTED)
+    startup.mark("imports")
+    if profile_startup:
+        startup.start_profiler()
+
     config = Config(env_file, no_env_files=no_env_files)
-    if config.SENTRY_DSN:
-        sentry_sdk.init(
-            dsn=config.SENTRY_DSN,
-            # Add request headers and IP for users,
-            # see https://docs.sentry.io/platforms/python/data-management/data-collected/ for more info
-            send_default_pii=True,
-        )
-        LOG.info("Initiated Sentry SDK for error tracking")
+    startup.mark("config")
 
     if debug:
         LOG.info("Debug is enabled")
@@ -41,11 +48,22 @@ def main(debug, env_file, no_env_files: bool, json_logs: bool):
     structlog_processors = [
         structlog.contextvars.merge_contextvars,
         structlog.processors.add_log_level,
-        SentryProcessor(event_level=logging.CRITICAL),
+    ]
+    if config.SENTRY_DSN:
+        # Only imported when used, sentry_sdk is slow to import.
+        from mqtt_sn_gateway import sentry
+
+        sentry.init(
+            config.SENTRY_DSN,
+            events_per_minute=config.SENTRY_EVENTS_PER_MINUTE,
+            burst=config.SENTRY_BURST,
+            queue_size=config.SENTRY_QUEUE_SIZE,
+        )
+        structlog_processors.append(sentry.log_processor())
+    structlog_processors += [
         structlog.processors.StackInfoRenderer(),
         structlog.dev.set_exc_info,
         structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S", utc=False),
-
     ]
     if json_logs:
         # Have to disable the
@@ -60,11 +78,40 @@ def main(debug, env_file, no_env_files: bool, json_logs: bool):
         logger_factory=structlog.PrintLoggerFactory(),
         cache_logger_on_first_use=False
     )
+    startup.mark("logging")
+
+    from mqtt_sn_gateway.server import ThreadingUdpServer, MqttSnRequestHandler
+
+    startup.mark("import_server")
 
     try:
         mqtt_sn_server = ThreadingUdpServer((config.HOST, config.PORT), MqttSnRequestHandler, config=config)
+        startup.mark("bind")
         with mqtt_sn_server as server:
-            LOG.info("Starting MQTT-SN server", host=config.HOST, port=config.PORT)
+            profiler = profiling.SamplingProfiler()
+            profiling.install_signal_handlers(
+                profiler, profile_dir=config.PROFILE_DIR, profile_seconds=config.PROFILE_SECONDS
+            )
+            if config.ADMIN_PORT is not None:
+                from mqtt_sn_gateway import admin
+
+                admin_server = admin.AdminServer(
+                    (config.ADMIN_HOST, config.ADMIN_PORT),
+                    metrics=server.metrics,
+                    profiler=profiler,
+                    profile_dir=config.PROFILE_DIR,
+                    profile_seconds=config.PROFILE_SECONDS,
+                    ready=server.ready,
+                )
+                admin_server.start()
+                startup.mark("admin")
+            server.warm_up(config.WARM_UP_TIMEOUT)
+            startup.mark("warm_up")
+            LOG.info("MQTT-SN server ready", host=config.HOST, port=config.PORT,
+                     startup_ms=startup.total_ms(), phases_ms=startup.phases)
+            if profile_startup:
+                LOG.info("Wrote startup profile", path=startup.write(config.PROFILE_DIR))
+                return
             server.serve_forever()
     except KeyboardInterrupt:
         LOG.info("Stopping MQTT-SN server")
@@ -0,0 +1,325 @@
+import math
+import threading
+import time
+from collections import defaultdict
+from enum import Enum
+from random import Random
+from typing import *
+
+from attrs import define, field
+import structlog
+
+from mqtt_sn_gateway import client_store, topic_store
+
+LOG = structlog.get_logger(__name__)
+
+
+@define
+class MemoryClientStore:
+    """
+    Keeps clients in process memory. Works as a local stand-in for ValKeyClientStore when running the gateway
+    without a Valkey server, for example in load tests. Entries never expire.
+    """
+
+    use_port_number: bool = field(default=True)
+    clients: Dict[str, bytes] = field(factory=dict)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def key_from_remote_addr(self, remote_addr: Tuple[str, int]) -> str:
+        if self.use_port_number:
+            return f"client:{remote_addr[0]}:{remote_addr[1]}"
+        else:
+            return f"client:{remote_addr[0]}"
+
+    def add_client(self, client_id: bytes, remote_addr: Tuple[str, int]) -> None:
+        with self.lock:
+            self.clients[self.key_from_remote_addr(remote_addr)] = client_id
+
+    def get_client(self, remote_addr: Tuple[str, int]) -> bytes:
+        with self.lock:
+            client_id = self.clients.get(self.key_from_remote_addr(remote_addr))
+        if client_id is None:
+            raise client_store.ClientDoesNotExist("No such client")
+        return client_id
+
+    def get_clients(self, remote_addrs: List[Tuple[str, int]]) -> List[Optional[bytes]]:
+        with self.lock:
+            return [self.clients.get(self.key_from_remote_addr(remote_addr)) for remote_addr in remote_addrs]
+
+    def delete_client(self, remote_addr: Tuple[str, int]) -> None:
+        with self.lock:
+            self.clients.pop(self.key_from_remote_addr(remote_addr), None)
+
+    def extend_client_ttl(self, remote_addr: Tuple[str, int]) -> None:
+        pass
+
+
+@define
+class MemoryTopicStore:
+    """
+    Keeps registered topics in process memory. Topic ids are the 1-based position in the client's topic list, the same
+    as in ValKeyTopicStore.
+    """
+
+    topics: DefaultDict[bytes, List[str]] = field(factory=lambda: defaultdict(list))
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def add_topic_for_client(self, client_id: bytes, topic_name: str) -> int:
+        with self.lock:
+            topics = self.topics[client_id]
+            topics.append(topic_name)
+            return len(topics)
+
+    def get_topic_for_client(self, client_id: bytes, topic_id: int) -> bytes:
+        with self.lock:
+            topics = self.topics.get(client_id, [])
+            if topic_id < 1 or topic_id > len(topics):
+                raise topic_store.TopicDoesNotExist()
+            return topics[topic_id - 1].encode()
+
+    def get_topics(self, lookups: List[Tuple[bytes, int]]) -> List[Optional[bytes]]:
+        out = []
+        for client_id, topic_id in lookups:
+            try:
+                out.append(self.get_topic_for_client(client_id, topic_id))
+            except topic_store.TopicDoesNotExist:
+                out.append(None)
+        return out
+
+    def delete_all_topics(self, client_id: bytes) -> None:
+        with self.lock:
+            self.topics.pop(client_id, None)
+
+    def extend_topic_ttl(self, client_id: bytes) -> None:
+        pass
+
+
+@define
+class MemoryForwarder:
+    """
+    Counts forwarded publishes instead of sending them to a broker.
+    """
+
+    published: int = field(default=0)
+    published_bytes: int = field(default=0)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def forward_publish(self, topic: str, payload: bytes, qos: int) -> None:
+        with self.lock:
+            self.published += 1
+            self.published_bytes += len(payload)
+
+    def forward_publishes(self, publishes: List[Tuple[str, bytes, int]]) -> None:
+        for topic, payload, qos in publishes:
+            self.forward_publish(topic, payload, qos)
+
+
+class SimulationError(ValueError):
+    """Invalid simulation profile"""
+
+
+class LatencyDistribution(str, Enum):
+    CONSTANT = "constant"
+    UNIFORM = "uniform"
+    NORMAL = "normal"
+    LOGNORMAL = "lognormal"
+    EXPONENTIAL = "exponential"
+
+
+@define
+class FaultProfile:
+    """
+    Latency and faults of a simulated dependency.
+
+    Every call waits a latency drawn from distribution with the given mean and jitter, in seconds. Jitter is the
+    standard deviation for normal and lognormal, and the largest deviation from the mean for uniform. A call fails
+    with probability error_rate, and every call fails during outages: the last outage_duration seconds of every
+    outage_every seconds since the profile was created.
+
+    Random numbers come from a generator seeded with seed, so runs are repeatable.
+    """
+
+    latency: float = field(default=0.0)
+    jitter: float = field(default=0.0)
+    distribution: LatencyDistribution = field(default=LatencyDistribution.CONSTANT, converter=LatencyDistribution)
+    error_rate: float = field(default=0.0)
+    outage_every: float = field(default=0.0)
+    outage_duration: float = field(default=0.0)
+    seed: int = field(default=0)
+    started: float = field(factory=time.monotonic)
+    random: Random = field(init=False)
+    calls: int = field(default=0)
+    errors: int = field(default=0)
+    outage_errors: int = field(default=0)
+    waited: float = field(default=0.0)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.random = Random(self.seed)
+
+    @classmethod
+    def from_spec(cls, spec: str) -> "FaultProfile":
+        """
+        Parses comma separated settings, like "latency=0.002,jitter=0.001,distribution=lognormal,error_rate=0.01".
+
+        :raises SimulationError:
+        """
+        kwargs: Dict[str, Any] = {}
+        for part in spec.split(","):
+            if not part.strip():
+                continue
+            name, separator, value = part.partition("=")
+            name = name.strip()
+            if not separator or name not in SPEC_FIELDS:
+                raise SimulationError(f"Unknown setting {part!r} in simulation profile {spec!r}")
+            try:
+                kwargs[name] = SPEC_FIELDS[name](value.strip())
+            except ValueError:
+                raise SimulationError(f"Invalid value for {name} in simulation profile {spec!r}")
+        return cls(**kwargs)
+
+    def delay(self) -> float:
+        """A latency from the distribution. Called with the lock held."""
+        mean, jitter = self.latency, self.jitter
+        if self.distribution is LatencyDistribution.UNIFORM:
+            value = self.random.uniform(mean - jitter, mean + jitter)
+        elif self.distribution is LatencyDistribution.NORMAL:
+            value = self.random.gauss(mean, jitter)
+        elif self.distribution is LatencyDistribution.LOGNORMAL and mean > 0:
+            # mu and sigma of the underlying normal distribution that give this mean and standard deviation.
+            sigma = math.sqrt(math.log(1 + (jitter / mean) ** 2))
+            value = self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+        elif self.distribution is LatencyDistribution.EXPONENTIAL and mean > 0:
+            value = self.random.expovariate(1 / mean)
+        else:
+            value = mean
+        return max(value, 0.0)
+
+    def in_outage(self, now: float) -> bool:
+        if self.outage_every <= 0 or self.outage_duration <= 0:
+            return False
+        return (now - self.started) % self.outage_every >= self.outage_every - self.outage_duration
+
+    def call(self, error: Type[Exception]):
+        """Waits the latency of one call and raises error if it fails."""
+        with self.lock:
+            self.calls += 1
+            delay = self.delay()
+            failed = self.random.random() < self.error_rate
+            self.waited += delay
+        if delay > 0:
+            time.sleep(delay)
+        if self.in_outage(time.monotonic()):
+            with self.lock:
+                self.outage_errors += 1
+            raise error("Simulated outage")
+        if failed:
+            with self.lock:
+                self.errors += 1
+            raise error("Simulated error")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "outage_errors": self.outage_errors,
+            "in_outage": self.in_outage(time.monotonic()),
+            "avg_latency_ms": round(self.waited / self.calls * 1000, 3) if self.calls else None,
+        }
+
+
+SPEC_FIELDS: Dict[str, Callable[[str], Any]] = {
+    "latency": float,
+    "jitter": float,
+    "distribution": LatencyDistribution,
+    "error_rate": float,
+    "outage_every": float,
+    "outage_duration": float,
+    "seed": int,
+}
+
+
+@define
+class SimulatedClientStore:
+    """
+    A MemoryClientStore behind a FaultProfile, standing in for ValKeyClientStore. Failures raise
+    client_store.ConnectionError like an unreachable Valkey. A batch lookup is one call.
+    """
+
+    profile: FaultProfile
+    store: MemoryClientStore = field(factory=MemoryClientStore)
+
+    @property
+    def use_port_number(self) -> bool:
+        return self.store.use_port_number
+
+    def add_client(self, client_id: bytes, remote_addr: Tuple[str, int]) -> None:
+        self.profile.call(client_store.ConnectionError)
+        self.store.add_client(client_id, remote_addr)
+
+    def get_client(self, remote_addr: Tuple[str, int]) -> bytes:
+        self.profile.call(client_store.ConnectionError)
+        return self.store.get_client(remote_addr)
+
+    def get_clients(self, remote_addrs: List[Tuple[str, int]]) -> List[Optional[bytes]]:
+        self.profile.call(client_store.ConnectionError)
+        return self.store.get_clients(remote_addrs)
+
+    def delete_client(self, remote_addr: Tuple[str, int]) -> None:
+        self.profile.call(client_store.ConnectionError)
+        self.store.delete_client(remote_addr)
+
+    def extend_client_ttl(self, remote_addr: Tuple[str, int]) -> None:
+        self.profile.call(client_store.ConnectionError)
+
+
+@define
+class SimulatedTopicStore:
+    """A MemoryTopicStore behind a FaultProfile, standing in for ValKeyTopicStore."""
+
+    profile: FaultProfile
+    store: MemoryTopicStore = field(factory=MemoryTopicStore)
+
+    def add_topic_for_client(self, client_id: bytes, topic_name: str) -> int:
+        self.profile.call(topic_store.ConnectionError)
+        return self.store.add_topic_for_client(client_id, topic_name)
+
+    def get_topic_for_client(self, client_id: bytes, topic_id: int) -> bytes:
+        self.profile.call(topic_store.ConnectionError)
+        return self.store.get_topic_for_client(client_id, topic_id)
+
+    def get_topics(self, lookups: List[Tuple[bytes, int]]) -> List[Optional[bytes]]:
+        self.profile.call(topic_store.ConnectionError)
+        return self.store.get_topics(lookups)
+
+    def delete_all_topics(self, client_id: bytes) -> None:
+        self.profile.call(topic_store.ConnectionError)
+        self.store.delete_all_topics(client_id)
+
+    def extend_topic_ttl(self, client_id: bytes) -> None:
+        self.profile.call(topic_store.ConnectionError)
+
+
+@define
+class SimulatedForwarder:
+    """
+    A MemoryForwarder behind a FaultProfile, standing in for AmqpForwarder. Failures raise ConnectionError like an
+    unreachable broker. A batch is one call, like one producer acquire.
+    """
+
+    profile: FaultProfile
+    forwarder: MemoryForwarder = field(factory=MemoryForwarder)
+
+    def warm_up(self) -> None:
+        pass
+
+    def forward_publish(self, topic: str, payload: bytes, qos: int) -> None:
+        self.profile.call(ConnectionError)
+        self.forwarder.forward_publish(topic, payload, qos)
+
+    def forward_publishes(self, publishes: List[Tuple[str, bytes, int]]) -> None:
+        self.profile.call(ConnectionError)
+        self.forwarder.forward_publishes(publishes)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.profile.stats(), "published": self.forwarder.published}
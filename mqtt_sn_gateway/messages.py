@@ -74,6 +74,25 @@ class Header:
     type: MessageType
 
 
+LONG_LENGTH_INDICATOR = 0x01
+
+
+def with_length(short_length: int) -> int:
+    """
+    Returns the full length of a message given its length when the 1 octet length encoding is used. Messages
+    that do not fit in 255 octets need 2 more octets for the 3 octet length encoding.
+    """
+    if short_length > 255:
+        return short_length + 2
+    return short_length
+
+
+def encode_length(length: int) -> bytes:
+    if length > 255:
+        return bytes([LONG_LENGTH_INDICATOR]) + length.to_bytes(2, "big")
+    return bytes([length])
+
+
 @define
 class Flags:
     dup: bool = field(default=False)
@@ -136,7 +155,8 @@ class Connect:
         out = bytearray()
         out.append(self.length)
         out.append(self.msg_type.value)
-        out.extend(b"\x00")
+        out.extend(self.flags.to_bytes())
+        out.append(PROTOCOL_ID)
         out.extend(self.duration.to_bytes(2, "big"))
         out.extend(self.client_id)
         return bytes(out)
@@ -198,8 +218,19 @@ class Register:
 
     @property
     def length(self) -> int:
-        # TODO: handle large payload length
-        return 2 + 2 + 2 + len(self.topic_name)
+        return with_length(2 + 2 + 2 + len(self.topic_name.encode()))
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.extend(encode_length(self.length))
+        out.append(self.msg_type.value)
+        if self.topic_id:
+            out.extend(self.topic_id.to_bytes(2, "big"))
+        else:
+            out.extend(b"\x00\x00")
+        out.extend(self.msg_id)
+        out.extend(self.topic_name.encode())
+        return bytes(out)
 
     @classmethod
     def from_bytes(cls, source_bytes: bytes):
@@ -282,7 +313,17 @@ class Publish:
 
     @property
     def length(self) -> int:
-        return 1 + 1 + 1 + 2 + 2 + len(self.data)
+        return with_length(1 + 1 + 1 + 2 + 2 + len(self.data))
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.extend(encode_length(self.length))
+        out.append(self.msg_type.value)
+        out.extend(self.flags.to_bytes())
+        out.extend(self.topic_id.to_bytes(2, "big"))
+        out.extend(self.msg_id)
+        out.extend(self.data)
+        return bytes(out)
 
     @classmethod
     def from_bytes(cls, source_bytes: bytes):
@@ -366,7 +407,8 @@ class Pingreq:
         out = bytearray()
         out.append(self.length)
         out.append(self.msg_type)
-        out.extend(self.client_id)
+        if self.client_id:
+            out.extend(self.client_id)
         return bytes(out)
 
     @classmethod
@@ -442,10 +484,386 @@ class Disconnect:
             return cls(duration=duration)
 
 
+@define
+class Subscribe:
+    """
+    The topic is a topic name, which may contain wildcards, when the topic type is NORMAL, a predefined topic id when
+    it is PREDEFINED and a 2 character topic name when it is SHORT.
+    """
+
+    msg_type: ClassVar[MessageType] = MessageType.SUBSCRIBE
+    flags: Flags
+    msg_id: bytes
+    topic_name: Optional[str] = field(default=None)
+    topic_id: Optional[int] = field(default=None)
+
+    @property
+    def length(self) -> int:
+        if self.flags.topic_type == TopicType.PREDEFINED:
+            return 1 + 1 + 1 + 2 + 2
+        return with_length(1 + 1 + 1 + 2 + len(self.topic_name.encode()))
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.extend(encode_length(self.length))
+        out.append(self.msg_type)
+        out.extend(self.flags.to_bytes())
+        out.extend(self.msg_id)
+        if self.flags.topic_type == TopicType.PREDEFINED:
+            out.extend(self.topic_id.to_bytes(2, "big"))
+        else:
+            out.extend(self.topic_name.encode())
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, source_bytes: bytes):
+        header = parse_header(source_bytes)
+        if header.type != cls.msg_type:
+            raise ValueError(f"Not a {cls.msg_type.name} message")
+        data = source_bytes[4 if header.length > 255 else 2:]
+        if len(data) < 3:
+            raise ValueError(f"{cls.msg_type.name} without message id")
+        flags = Flags.from_bytes(data[:1])
+        msg_id = bytes(data[1:3])
+        topic = bytes(data[3:])
+        if flags.topic_type == TopicType.PREDEFINED:
+            if len(topic) != 2:
+                raise ValueError("Predefined topic id is 2 octets")
+            return cls(flags=flags, msg_id=msg_id, topic_id=int.from_bytes(topic, "big"))
+        return cls(flags=flags, msg_id=msg_id, topic_name=topic.decode())
+
+
+@define
+class Unsubscribe(Subscribe):
+    msg_type: ClassVar[MessageType] = MessageType.UNSUBSCRIBE
+
+
+@define
+class Suback:
+    """
+    The flags only carry the granted QoS. The topic id is 0 when the subscription has wildcards, the topics are then
+    registered with the client as messages for them arrive.
+    """
+
+    msg_type: ClassVar[MessageType] = MessageType.SUBACK
+    flags: Flags
+    topic_id: int
+    msg_id: bytes
+    return_code: ReturnCode
+
+    @property
+    def length(self) -> int:
+        return 1 + 1 + 1 + 2 + 2 + 1
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.append(self.length)
+        out.append(self.msg_type)
+        out.extend(self.flags.to_bytes())
+        out.extend(self.topic_id.to_bytes(2, "big"))
+        out.extend(self.msg_id)
+        out.append(self.return_code)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, source_bytes):
+        data = bytearray(source_bytes)
+        length = data.pop(0)
+        if length != len(source_bytes) or length != 8:
+            raise ValueError("Incorrect length")
+        msg_type = MessageType(data.pop(0))
+        if msg_type != MessageType.SUBACK:
+            raise ValueError("Not a SUBACK message")
+        flags = Flags.from_bytes(bytes(data[:1]))
+        topic_id = int.from_bytes(data[1:3], "big")
+        msg_id = bytes(data[3:5])
+        return_code = ReturnCode(data[5])
+        return cls(flags=flags, topic_id=topic_id, msg_id=msg_id, return_code=return_code)
+
+
+@define
+class Unsuback:
+    msg_type: ClassVar[MessageType] = MessageType.UNSUBACK
+    msg_id: bytes
+
+    @property
+    def length(self) -> int:
+        return 1 + 1 + 2
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.append(self.length)
+        out.append(self.msg_type)
+        out.extend(self.msg_id)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, source_bytes):
+        data = bytearray(source_bytes)
+        length = data.pop(0)
+        if length != len(source_bytes) or length != 4:
+            raise ValueError("Incorrect length")
+        msg_type = MessageType(data.pop(0))
+        if msg_type != MessageType.UNSUBACK:
+            raise ValueError("Not a UNSUBACK message")
+        return cls(msg_id=bytes(data[:2]))
+
+
+@define
+class Advertise:
+    msg_type: ClassVar[MessageType] = MessageType.ADVERTISE
+    gw_id: int
+    duration: int  # seconds until the next ADVERTISE
+
+    @property
+    def length(self) -> int:
+        return 5
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.append(self.length)
+        out.append(self.msg_type)
+        out.append(self.gw_id)
+        out.extend(self.duration.to_bytes(2, "big"))
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, source_bytes):
+        data = bytearray(source_bytes)
+        length = data.pop(0)
+        if length != 5:
+            raise ValueError("Incorrect length for an ADVERTISE")
+        msg_type = MessageType(data.pop(0))
+        if msg_type != MessageType.ADVERTISE:
+            raise ValueError("Not an ADVERTISE message")
+        gw_id = data.pop(0)
+        duration = int.from_bytes(data[:2], "big")
+        return cls(gw_id=gw_id, duration=duration)
+
+
+@define
+class Searchgw:
+    msg_type: ClassVar[MessageType] = MessageType.SEARCHGW
+    radius: int = field(default=0)
+
+    @property
+    def length(self) -> int:
+        return 3
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.append(self.length)
+        out.append(self.msg_type)
+        out.append(self.radius)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, source_bytes):
+        data = bytearray(source_bytes)
+        length = data.pop(0)
+        if length != 3:
+            raise ValueError("Incorrect length for a SEARCHGW")
+        msg_type = MessageType(data.pop(0))
+        if msg_type != MessageType.SEARCHGW:
+            raise ValueError("Not a SEARCHGW message")
+        return cls(radius=data.pop(0))
+
+
+@define
+class Gwinfo:
+    """
+    The gateway address is only included when a client answers on behalf of a gateway.
+    """
+
+    msg_type: ClassVar[MessageType] = MessageType.GWINFO
+    gw_id: int
+    gw_address: bytes = field(default=b"")
+
+    @property
+    def length(self) -> int:
+        return 3 + len(self.gw_address)
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.append(self.length)
+        out.append(self.msg_type)
+        out.append(self.gw_id)
+        out.extend(self.gw_address)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, source_bytes):
+        data = bytearray(source_bytes)
+        length = data.pop(0)
+        if length != len(source_bytes):
+            raise ValueError("Incorrect length")
+        msg_type = MessageType(data.pop(0))
+        if msg_type != MessageType.GWINFO:
+            raise ValueError("Not a GWINFO message")
+        gw_id = data.pop(0)
+        return cls(gw_id=gw_id, gw_address=bytes(data))
+
+
 class ParsingError(Exception):
     """Unable to parse data into MQTT-SN Message"""
 
 
+def inner_length(source_bytes: bytes, offset: int) -> int:
+    """
+    Length of the message starting at offset, read from its header.
+
+    :raises ParsingError:
+    """
+    if len(source_bytes) - offset < 2:
+        raise ParsingError("Too short for a MQTT-SN header")
+    if source_bytes[offset] == LONG_LENGTH_INDICATOR:
+        if len(source_bytes) - offset < 4:
+            raise ParsingError("Too short for a MQTT-SN header")
+        return (source_bytes[offset + 1] << 8) | source_bytes[offset + 2]
+    return source_bytes[offset]
+
+
+@define
+class Encapsulated:
+    """
+    A message to or from a device behind a forwarder, for example a radio concentrator.
+
+    The length only covers the encapsulation: length, message type, ctrl and the wireless node id. The encapsulated
+    message follows with its own header. Bits 0 and 1 of ctrl are the broadcast radius, the rest is reserved.
+
+    A forwarder may put several encapsulated messages in one datagram, see parse_encapsulated.
+    """
+
+    msg_type: ClassVar[MessageType] = MessageType.ENCAPSULATED
+    ctrl: int
+    wireless_node_id: bytes
+    data: bytes
+
+    @property
+    def length(self) -> int:
+        return 1 + 1 + 1 + len(self.wireless_node_id)
+
+    @property
+    def radius(self) -> int:
+        return self.ctrl & 0b11
+
+    def to_bytes(self) -> bytes:
+        out = bytearray()
+        out.append(self.length)
+        out.append(self.msg_type)
+        out.append(self.ctrl)
+        out.extend(self.wireless_node_id)
+        out.extend(self.data)
+        return bytes(out)
+
+    @classmethod
+    def read(cls, source_bytes: bytes, offset: int = 0) -> Tuple["Encapsulated", int]:
+        """
+        Reads the encapsulated message at offset and returns it with the offset after it.
+
+        :raises ParsingError:
+        """
+        if len(source_bytes) - offset < 3:
+            raise ParsingError("Too short for an encapsulation header")
+        length = source_bytes[offset]
+        if length < 3 or source_bytes[offset + 1] != MessageType.ENCAPSULATED:
+            raise ParsingError("Not an encapsulated message")
+        start = offset + length
+        end = start + inner_length(source_bytes, start)
+        if end > len(source_bytes) or end - start < 2:
+            raise ParsingError("Length of encapsulated message does not match the datagram")
+        message = cls(
+            ctrl=source_bytes[offset + 2],
+            wireless_node_id=bytes(source_bytes[offset + 3:start]),
+            data=bytes(source_bytes[start:end]),
+        )
+        return message, end
+
+    @classmethod
+    def from_bytes(cls, source_bytes: bytes) -> "Encapsulated":
+        message, end = cls.read(source_bytes)
+        if end != len(source_bytes):
+            raise ValueError("Incorrect length")
+        return message
+
+
+@define
+class EncapsulatedFrames:
+    """Several encapsulated messages sent in one datagram."""
+
+    msg_type: ClassVar[MessageType] = MessageType.ENCAPSULATED
+    frames: List[Encapsulated]
+
+    def to_bytes(self) -> bytes:
+        return b"".join(frame.to_bytes() for frame in self.frames)
+
+
+def is_encapsulated(source_bytes: bytes) -> bool:
+    # The encapsulation length is never the 3 octet indicator, since it is at least 3.
+    return len(source_bytes) >= 2 and source_bytes[1] == MessageType.ENCAPSULATED and source_bytes[0] >= 3
+
+
+def parse_encapsulated(source_bytes: bytes) -> List[Encapsulated]:
+    """
+    Splits a datagram into the encapsulated messages in it.
+
+    :raises ParsingError:
+    """
+    frames = []
+    offset = 0
+    while offset < len(source_bytes):
+        frame, offset = Encapsulated.read(source_bytes, offset)
+        frames.append(frame)
+    return frames
+
+
+def parse_header(source_bytes: bytes) -> Header:
+    """
+    Cheap validation of the header without copying the data. The length in the header has to match the length of
+    the datagram.
+
+    :raises ParsingError:
+    """
+    size = len(source_bytes)
+    if size < 2:
+        raise ParsingError("Datagram too short for a MQTT-SN header")
+    if source_bytes[0] == LONG_LENGTH_INDICATOR:
+        if size < 4:
+            raise ParsingError("Datagram too short for a MQTT-SN header")
+        length = (source_bytes[1] << 8) | source_bytes[2]
+        type_value = source_bytes[3]
+    else:
+        length = source_bytes[0]
+        type_value = source_bytes[1]
+    if length != size:
+        raise ParsingError(f"Length in header is {length} but datagram is {size} octets")
+    try:
+        return Header(length=length, type=MessageType(type_value))
+    except ValueError:
+        raise ParsingError(f"Unknown message type {type_value}")
+
+
+MESSAGE_CLASSES = {
+    MessageType.CONNECT: Connect,
+    MessageType.CONNACK: Connack,
+    MessageType.PUBLISH: Publish,
+    MessageType.PUBACK: Puback,
+    MessageType.REGISTER: Register,
+    MessageType.REGACK: Regack,
+    MessageType.PINGREQ: Pingreq,
+    MessageType.PINGRESP: Pingresp,
+    MessageType.DISCONNECT: Disconnect,
+    MessageType.ENCAPSULATED: Encapsulated,
+    MessageType.ADVERTISE: Advertise,
+    MessageType.SEARCHGW: Searchgw,
+    MessageType.GWINFO: Gwinfo,
+    MessageType.SUBSCRIBE: Subscribe,
+    MessageType.SUBACK: Suback,
+    MessageType.UNSUBSCRIBE: Unsubscribe,
+    MessageType.UNSUBACK: Unsuback,
+}
+
+
 @define
 class MessageFactory:
     @staticmethod
@@ -453,35 +871,16 @@ class MessageFactory:
         """
         :raises ParsingError:
         """
+        if is_encapsulated(source_bytes):
+            # The length in the header is only that of the encapsulation, so the header check does not apply.
+            message_class = Encapsulated
+        else:
+            header = parse_header(source_bytes)
+            message_class = MESSAGE_CLASSES.get(header.type)
+            if message_class is None:
+                raise ParsingError(f"{header.type.name} is not supported")
         try:
-            data = bytearray(source_bytes)
-            initial_length = data.pop(0)
-            if initial_length == 1:
-                # Indicates that 3 bytes are used for the length.
-                # Next 2 bytes indicates the lenght.
-                length = int.from_bytes(data[:2], "big")
-                data = data[2:]
-            else:
-                length = initial_length
-
-            message_type = MessageType(data.pop(0))
-
-            if message_type == MessageType.CONNECT:
-                return Connect.from_bytes(source_bytes)
-            elif message_type == MessageType.CONNACK:
-                return Connack.from_bytes(source_bytes)
-            elif message_type == MessageType.PUBLISH:
-                return Publish.from_bytes(source_bytes)
-            elif message_type == MessageType.PUBACK:
-                return Puback.from_bytes(source_bytes)
-            elif message_type == MessageType.REGISTER:
-                return Register.from_bytes(source_bytes)
-            elif message_type == MessageType.REGACK:
-                return Regack.from_bytes(source_bytes)
-            elif message_type == MessageType.PINGREQ:
-                return Pingreq.from_bytes(source_bytes)
-            else:
-                raise ValueError(f"{message_type} is not supported")
+            return message_class.from_bytes(source_bytes)
         except Exception:
             raise ParsingError("Unable to create MQTT-SN message")
 
@@ -0,0 +1,28 @@
+from typing import *
+
+from attrs import define, field
+import structlog
+
+LOG = structlog.get_logger(__name__)
+
+
+@define
+class MetricsRegistry:
+    """
+    Collects metrics from the parts of the gateway. Each part registers a callable that returns a JSON serializable
+    snapshot of its metrics. Snapshots are only taken when metrics are requested.
+    """
+
+    providers: Dict[str, Callable[[], Any]] = field(factory=dict)
+
+    def register(self, name: str, provider: Callable[[], Any]):
+        self.providers[name] = provider
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = {}
+        for name, provider in self.providers.items():
+            try:
+                out[name] = provider()
+            except Exception:
+                LOG.exception("Unable to collect metrics", provider=name)
+        return out
@@ -0,0 +1,343 @@
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import *
+
+from attrs import define, field
+import structlog
+import valkey
+
+from mqtt_sn_gateway.valkey_client import UNAVAILABLE_ERRORS
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_MAX_SIZE = 100_000
+DEFAULT_TTL = 300.0  # seconds, a safety net in case an invalidation is lost
+MAX_PENDING_WRITES = 10_000
+RECONNECT_DELAY = 1.0  # seconds
+POLL_TIMEOUT = 1.0  # seconds, how often the listener checks if it should stop
+KEY_PREFIXES = ["client:", "topic:"]
+INVALIDATION_CHANNEL = "__redis__:invalidate"
+# Keyspace events that do not change the value. EXPIRE is sent on every publish when TTLs are extended.
+IGNORED_KEYSPACE_EVENTS = {"expire"}
+
+
+class InvalidationSource(str, Enum):
+    TRACKING = "tracking"
+    KEYSPACE = "keyspace"
+
+
+@define
+class CacheEntry:
+    expires: float
+    values: Dict[Hashable, Any] = field(factory=dict)
+
+
+@define
+class NearCache:
+    """
+    Keeps store reads in process memory and evicts them when the keys change in Valkey, on any gateway instance.
+
+    Entries are grouped by Valkey key, since that is what invalidations name, and within a key by the read command,
+    like ("LINDEX", 0). Entries are only served while an InvalidationListener is connected. When it is not, for example
+    while Valkey restarts, all reads go to Valkey and the cache is flushed.
+
+    A read that is in flight when the key is invalidated is not stored: the entry is created before the read and only
+    filled if it is still the same entry when the read is done.
+    """
+
+    max_size: int = field(default=DEFAULT_MAX_SIZE)
+    ttl: float = field(default=DEFAULT_TTL)
+    entries: "OrderedDict[str, CacheEntry]" = field(factory=OrderedDict)
+    connected: bool = field(default=False)
+    pending_writes: "OrderedDict[str, float]" = field(factory=OrderedDict)
+    hits: int = field(default=0)
+    misses: int = field(default=0)
+    bypassed: int = field(default=0)
+    invalidations: int = field(default=0)
+    flushes: int = field(default=0)
+    lag_count: int = field(default=0)
+    lag_total: float = field(default=0.0)
+    lag_max: float = field(default=0.0)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def read_through(self, key: str, command: Hashable, load: Callable[[], Any]) -> Any:
+        """
+        Returns the cached result of command on key, or loads and caches it. None results are not cached.
+        """
+        entry = None
+        with self.lock:
+            if not self.connected:
+                self.bypassed += 1
+            else:
+                now = time.monotonic()
+                entry = self.entries.get(key)
+                if entry is not None and entry.expires > now and command in entry.values:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return entry.values[command]
+                self.misses += 1
+                if entry is None or entry.expires <= now:
+                    entry = CacheEntry(expires=now + self.ttl)
+                    self.entries[key] = entry
+                    while len(self.entries) > self.max_size:
+                        self.entries.popitem(last=False)
+
+        value = load()
+        if entry is not None and value is not None:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    entry.values[command] = value
+        return value
+
+    def read_many(
+        self, reads: List[Tuple[str, Hashable]], load: Callable[[List[int]], List[Any]]
+    ) -> List[Any]:
+        """
+        Like read_through for many (key, command) at once. Hits are served from the cache and load is called once
+        with the indexes of the misses, in order, and returns their results.
+        """
+        results: List[Any] = [None] * len(reads)
+        entries: List[Optional[CacheEntry]] = []
+        missed: List[int] = []
+        with self.lock:
+            if not self.connected:
+                self.bypassed += len(reads)
+                missed = list(range(len(reads)))
+                entries = [None] * len(reads)
+            else:
+                now = time.monotonic()
+                for index, (key, command) in enumerate(reads):
+                    entry = self.entries.get(key)
+                    if entry is not None and entry.expires > now and command in entry.values:
+                        self.hits += 1
+                        self.entries.move_to_end(key)
+                        results[index] = entry.values[command]
+                        continue
+                    self.misses += 1
+                    if entry is None or entry.expires <= now:
+                        entry = CacheEntry(expires=now + self.ttl)
+                        self.entries[key] = entry
+                    missed.append(index)
+                    entries.append(entry)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        if not missed:
+            return results
+
+        values = load(missed)
+        with self.lock:
+            for index, entry, value in zip(missed, entries, values):
+                results[index] = value
+                key, command = reads[index]
+                if entry is not None and value is not None and self.entries.get(key) is entry:
+                    entry.values[command] = value
+        return results
+
+    def reserve(self, key: str) -> Optional[CacheEntry]:
+        """
+        Creates an empty entry for a key that is about to be preloaded, see fill. Returns None if the key is already
+        cached, the cache is full or not connected, so a preload never evicts entries that are in use.
+        """
+        with self.lock:
+            if not self.connected or key in self.entries or len(self.entries) >= self.max_size:
+                return None
+            entry = CacheEntry(expires=time.monotonic() + self.ttl)
+            self.entries[key] = entry
+            return entry
+
+    def fill(self, key: str, entry: CacheEntry, values: Dict[Hashable, Any]) -> bool:
+        """
+        Stores preloaded values in an entry from reserve, unless the key was invalidated since. Without values, for
+        a key that expired meanwhile, the entry is removed again.
+        """
+        with self.lock:
+            if self.entries.get(key) is not entry:
+                return False
+            if not values:
+                del self.entries[key]
+                return False
+            entry.values.update(values)
+            return True
+
+    def written(self, key: str):
+        """
+        Called when this gateway changed the key. Evicts it right away, without waiting for the invalidation, and
+        notes the time so the invalidation lag can be measured when it arrives.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.pending_writes[key] = time.monotonic()
+            self.pending_writes.move_to_end(key)
+            while len(self.pending_writes) > MAX_PENDING_WRITES:
+                self.pending_writes.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.invalidations += 1
+            self.entries.pop(key, None)
+            written = self.pending_writes.pop(key, None)
+            if written is not None:
+                lag = time.monotonic() - written
+                self.lag_count += 1
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+
+    def flush(self):
+        with self.lock:
+            self.flushes += 1
+            self.entries.clear()
+
+    def set_connected(self, connected: bool):
+        """Entries from before a (re)connect may have missed invalidations, so they are dropped either way."""
+        with self.lock:
+            self.connected = connected
+            self.flushes += 1
+            self.entries.clear()
+            self.pending_writes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "connected": self.connected,
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "bypassed": self.bypassed,
+            "invalidations": self.invalidations,
+            "flushes": self.flushes,
+            "invalidation_lag_ms": {
+                "count": self.lag_count,
+                "avg": round(self.lag_total / self.lag_count * 1000, 3) if self.lag_count else None,
+                "max": round(self.lag_max * 1000, 3),
+            },
+        }
+
+
+def invalidation_source(source: str, extend_store_ttl_on_publish: bool) -> InvalidationSource:
+    """
+    TRACKING announces EXPIRE like any other change, so with TTLs extended on every PUBLISH the keys of a device would
+    be evicted on each of its publishes and the cache would hardly ever hit. KEYSPACE is used instead.
+    """
+    source = InvalidationSource(source)
+    if source is InvalidationSource.TRACKING and extend_store_ttl_on_publish:
+        LOG.warning(
+            "Near cache tracking invalidations evict keys on every TTL extension, using keyspace notifications. "
+            "Set MQTTSN_EXTEND_STORE_TTL_ON_PUBLISH=false to use tracking"
+        )
+        return InvalidationSource.KEYSPACE
+    return source
+
+
+@define
+class InvalidationListener:
+    """
+    Receives invalidations for client: and topic: keys from Valkey on a dedicated connection and applies them to the
+    near cache.
+
+    TRACKING uses client side caching in broadcast mode, so every change to a key with the prefixes is announced, no
+    matter which gateway read it. Every change includes EXPIRE, so it does not go with extend_store_ttl_on_publish,
+    see invalidation_source.
+
+    KEYSPACE subscribes to keyspace notifications and ignores EXPIRE. It needs notify-keyspace-events to include
+    K, g, $, l, x and e on the server.
+    """
+
+    url: str
+    cache: NearCache
+    source: InvalidationSource = field(default=InvalidationSource.TRACKING, converter=InvalidationSource)
+    prefixes: List[str] = field(factory=lambda: list(KEY_PREFIXES))
+    stop_event: threading.Event = field(factory=threading.Event)
+    thread: Optional[threading.Thread] = field(default=None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="near-cache-invalidations", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                if self.source is InvalidationSource.TRACKING:
+                    self.listen_tracking()
+                else:
+                    self.listen_keyspace()
+            except UNAVAILABLE_ERRORS + (OSError,):
+                LOG.warning("Lost near cache invalidations, reading from Valkey until reconnected",
+                            source=self.source.value)
+            except Exception:
+                LOG.exception("Error in near cache invalidation listener", source=self.source.value)
+            self.cache.set_connected(False)
+            self.stop_event.wait(RECONNECT_DELAY)
+
+    def listen_tracking(self):
+        # Tracking is turned on for one connection and the invalidations are redirected to a second one subscribed to
+        # the invalidation channel, so only public client API is needed and it works with RESP2.
+        client = valkey.Valkey.from_url(self.url, single_connection_client=True)
+        subscriber = client.connection_pool.get_connection("SUBSCRIBE")
+        try:
+            subscriber.send_command("CLIENT", "ID")
+            subscriber_id = subscriber.read_response()
+            subscriber.send_command("SUBSCRIBE", INVALIDATION_CHANNEL)
+            subscriber.read_response()
+            arguments = ["CLIENT", "TRACKING", "ON", "REDIRECT", subscriber_id, "BCAST"]
+            for prefix in self.prefixes:
+                arguments += ["PREFIX", prefix]
+            client.execute_command(*arguments)
+            self.cache.set_connected(True)
+            LOG.info("Receiving near cache invalidations", source=self.source.value, prefixes=self.prefixes)
+            while not self.stop_event.is_set():
+                if subscriber.can_read(timeout=POLL_TIMEOUT):
+                    self.handle_tracking(subscriber.read_response())
+                else:
+                    # Tracking ends silently with the connection that turned it on.
+                    client.ping()
+        finally:
+            subscriber.disconnect()
+            client.connection_pool.release(subscriber)
+            client.close()
+
+    def handle_tracking(self, message: Any):
+        """Handles a message from the invalidation channel: [b"message", channel, keys]."""
+        if not isinstance(message, list) or len(message) != 3 or message[0] not in (b"message", "message"):
+            return
+        keys = message[2]
+        if keys is None:
+            # Sent on FLUSHALL and FLUSHDB.
+            self.cache.flush()
+            return
+        for key in keys:
+            self.cache.invalidate(key.decode() if isinstance(key, bytes) else key)
+
+    def listen_keyspace(self):
+        client = valkey.Valkey.from_url(self.url)
+        db = client.connection_pool.connection_kwargs.get("db", 0)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.psubscribe(*[f"__keyspace@{db}__:{prefix}*" for prefix in self.prefixes])
+            self.cache.set_connected(True)
+            LOG.info("Receiving near cache invalidations", source=self.source.value, prefixes=self.prefixes)
+            while not self.stop_event.is_set():
+                message = pubsub.get_message(timeout=POLL_TIMEOUT)
+                if message is not None:
+                    self.handle_keyspace(message)
+        finally:
+            pubsub.close()
+            client.close()
+
+    def handle_keyspace(self, message: Dict[str, Any]):
+        channel = message["channel"]
+        event = message["data"]
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        if isinstance(event, bytes):
+            event = event.decode()
+        if event in IGNORED_KEYSPACE_EVENTS:
+            return
+        self.cache.invalidate(channel.split(":", 1)[1])
@@ -0,0 +1,166 @@
+import threading
+import time
+from typing import *
+
+from attrs import define, field
+import structlog
+
+from mqtt_sn_gateway import client_store, topic_store
+from mqtt_sn_gateway.nearcache import NearCache
+from mqtt_sn_gateway.valkey_client import UNAVAILABLE_ERRORS
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_RATE = 5_000  # keys per second
+DEFAULT_ACTIVE_WINDOW = 60 * 60 * 24  # 1 day in seconds
+SCAN_COUNT = 500
+CONNECT_TIMEOUT = 30.0  # seconds to wait for the near cache to receive invalidations
+
+
+@define
+class KeyFamily:
+    """
+    Keys preloaded with one SCAN pattern. ttl is what the stores set on write, so ttl minus the remaining TTL of a key
+    is the time since it was last written or extended.
+    """
+
+    prefix: str
+    ttl: int
+    read: Callable[[Any, str], None]
+    values: Callable[[Any], Dict[Hashable, Any]]
+
+
+def client_family() -> KeyFamily:
+    # Same command as ValKeyClientStore.get_client reads through the cache with.
+    return KeyFamily(
+        prefix="client:",
+        ttl=client_store.CLIENT_TTL,
+        read=lambda pipeline, key: pipeline.get(key),
+        values=lambda value: {} if value is None else {"GET": value},
+    )
+
+
+def topic_family() -> KeyFamily:
+    # The whole list is read once and cached as the LINDEX reads of ValKeyTopicStore.get_topic.
+    return KeyFamily(
+        prefix="topic:",
+        ttl=topic_store.DEFAULT_TTL,
+        read=lambda pipeline, key: pipeline.lrange(key, 0, -1),
+        values=lambda value: {("LINDEX", index): topic for index, topic in enumerate(value or [])},
+    )
+
+
+@define
+class Preloader:
+    """
+    Streams recently active client: and topic: keys from Valkey into the near cache after startup, so the first
+    requests from every device after a deploy do not all go to Valkey.
+
+    Keys are found with SCAN and read with one pipeline of TTL and GET or LRANGE per SCAN batch. Keys last written or
+    extended more than active_window ago are skipped. The preload is limited to rate keys per second and stops at
+    max_keys or when the near cache is full, without evicting entries that requests already cached. It runs in its
+    own thread while requests are served.
+
+    Entries are reserved before they are read, like NearCache.read_through, so a key invalidated during the preload is
+    not cached with the old value.
+    """
+
+    valkey: Any
+    cache: NearCache
+    rate: float = field(default=DEFAULT_RATE)
+    max_keys: int = field(default=0)
+    active_window: float = field(default=DEFAULT_ACTIVE_WINDOW)
+    scan_count: int = field(default=SCAN_COUNT)
+    families: List[KeyFamily] = field(factory=lambda: [client_family(), topic_family()])
+    stop_event: threading.Event = field(factory=threading.Event)
+    thread: Optional[threading.Thread] = field(default=None)
+    scanned: int = field(default=0)
+    loaded: int = field(default=0)
+    skipped: int = field(default=0)
+    started: Optional[float] = field(default=None)
+    finished: Optional[float] = field(default=None)
+
+    def __attrs_post_init__(self):
+        if self.max_keys <= 0:
+            self.max_keys = self.cache.max_size
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="near-cache-preload", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while not self.cache.connected:
+            if self.stop_event.wait(0.1) or time.monotonic() > deadline:
+                LOG.warning("Near cache is not receiving invalidations, skipping preload")
+                return
+        try:
+            self.preload()
+        except UNAVAILABLE_ERRORS as e:
+            LOG.warning("Unable to preload near cache", error=str(e), loaded=self.loaded)
+        except Exception:
+            LOG.exception("Error preloading near cache", loaded=self.loaded)
+
+    def preload(self):
+        self.started = time.monotonic()
+        LOG.info("Preloading near cache", max_keys=self.max_keys, rate=self.rate, active_window=self.active_window)
+        for family in self.families:
+            cursor = 0
+            while self.loaded < self.max_keys and not self.cache_full() and not self.stop_event.is_set():
+                cursor, keys = self.valkey.scan(cursor=cursor, match=f"{family.prefix}*", count=self.scan_count)
+                self.load(family, [key.decode() if isinstance(key, bytes) else key for key in keys])
+                self.throttle()
+                if cursor == 0:
+                    break
+        self.finished = time.monotonic()
+        LOG.info("Preloaded near cache", **self.stats())
+
+    def cache_full(self) -> bool:
+        return len(self.cache.entries) >= self.cache.max_size
+
+    def load(self, family: KeyFamily, keys: List[str]):
+        self.scanned += len(keys)
+        reserved = []
+        for key in keys[: self.max_keys - self.loaded]:
+            entry = self.cache.reserve(key)
+            if entry is not None:
+                reserved.append((key, entry))
+        if not reserved:
+            return
+        pipeline = self.valkey.pipeline(transaction=False)
+        for key, _ in reserved:
+            pipeline.ttl(key)
+            family.read(pipeline, key)
+        results = pipeline.execute()
+        oldest = family.ttl - self.active_window
+        for index, (key, entry) in enumerate(reserved):
+            ttl, value = results[index * 2], results[index * 2 + 1]
+            # -1 is a key without expiry, which says nothing about when it was used.
+            active = ttl == -1 or ttl >= oldest
+            if self.cache.fill(key, entry, family.values(value) if active else {}):
+                self.loaded += 1
+            else:
+                self.skipped += 1
+
+    def throttle(self):
+        """Sleeps until the keys scanned so far are within rate."""
+        if self.rate <= 0:
+            return
+        ahead = self.started + self.scanned / self.rate - time.monotonic()
+        if ahead > 0:
+            self.stop_event.wait(ahead)
+
+    def stats(self) -> Dict[str, Any]:
+        end = self.finished or time.monotonic()
+        return {
+            "running": self.started is not None and self.finished is None,
+            "scanned": self.scanned,
+            "loaded": self.loaded,
+            "skipped": self.skipped,
+            "seconds": round(end - self.started, 3) if self.started is not None else None,
+        }
@@ -0,0 +1,189 @@
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import *
+
+from attrs import define, field
+import structlog
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 0.005  # 200 Hz
+
+# Set when stage timings are enabled. Instrumented code checks this for None so there is no cost when disabled.
+stage_timings: Optional["StageTimings"] = None
+
+
+@define
+class StageTimings:
+    """
+    Aggregated time spent in named stages of the request handling. Recording is thread safe.
+    """
+
+    stages: Dict[str, List[float]] = field(factory=dict)
+    started_at: float = field(factory=time.time)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def record(self, stage: str, seconds: float):
+        with self.lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                if seconds > entry[2]:
+                    entry[2] = seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = {
+                stage: {
+                    "count": count,
+                    "total_ms": round(total * 1000, 3),
+                    "mean_ms": round(total / count * 1000, 3),
+                    "max_ms": round(maximum * 1000, 3),
+                }
+                for stage, (count, total, maximum) in self.stages.items()
+            }
+        return {"started_at": self.started_at, "stages": stages}
+
+
+def enable_stage_timings() -> StageTimings:
+    global stage_timings
+    if stage_timings is None:
+        stage_timings = StageTimings()
+        LOG.info("Stage timings enabled")
+    return stage_timings
+
+
+def disable_stage_timings() -> Optional[Dict[str, Any]]:
+    """Disables stage timings and returns what was recorded."""
+    global stage_timings
+    timings, stage_timings = stage_timings, None
+    if timings is None:
+        return None
+    snapshot = timings.snapshot()
+    LOG.info("Stage timings disabled", **snapshot)
+    return snapshot
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+@define
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads at a fixed interval from a background thread and writes them in the collapsed
+    stack format used by flamegraph.pl and speedscope: one line per unique stack, frames separated by ";" from the
+    root, followed by the number of samples.
+
+    Only one profile can run at a time.
+    """
+
+    interval: float = field(default=DEFAULT_SAMPLE_INTERVAL)
+    _running: threading.Lock = field(init=False, factory=threading.Lock)
+
+    @property
+    def running(self) -> bool:
+        return self._running.locked()
+
+    def start(self, seconds: float, output_path: str) -> bool:
+        """Starts profiling in the background. Returns False if a profile is already running."""
+        if not self._running.acquire(blocking=False):
+            LOG.warning("A profile is already running")
+            return False
+        threading.Thread(
+            target=self._run, args=(seconds, output_path), name="sampling-profiler", daemon=True
+        ).start()
+        return True
+
+    def _run(self, seconds: float, output_path: str):
+        try:
+            LOG.info("Starting sampling profiler", seconds=seconds, output_path=output_path, interval=self.interval)
+            samples = self.sample(seconds)
+            with open(output_path, "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            LOG.info("Profile written", output_path=output_path, samples=sum(samples.values()))
+        except Exception:
+            LOG.exception("Profiling failed", output_path=output_path)
+        finally:
+            self._running.release()
+
+    def sample(self, seconds: float) -> Counter:
+        own_thread = threading.get_ident()
+        samples: Counter = Counter()
+        stop_at = time.monotonic() + seconds
+        while time.monotonic() < stop_at:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                samples[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return samples
+
+
+@define
+class StartupProfile:
+    """
+    Time spent in each phase of startup, from started until each mark(). With start_profiler() startup also runs
+    under cProfile and write() saves the stats, to be read with pstats or snakeviz.
+    """
+
+    started: float = field(factory=time.perf_counter)
+    last: Optional[float] = field(default=None)
+    phases: Dict[str, float] = field(factory=dict)
+    profiler: Optional[Any] = field(default=None)
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - (self.last or self.started)) * 1000, 3)
+        self.last = now
+
+    def total_ms(self) -> float:
+        return round(((self.last or self.started) - self.started) * 1000, 3)
+
+    def start_profiler(self):
+        import cProfile
+
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def write(self, directory: str) -> str:
+        self.profiler.disable()
+        path = os.path.join(directory, f"startup-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+        self.profiler.dump_stats(path)
+        return path
+
+
+def profile_path(directory: str) -> str:
+    return os.path.join(directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+
+
+def install_signal_handlers(profiler: SamplingProfiler, profile_dir: str, profile_seconds: float):
+    """
+    SIGUSR1 starts a profile for profile_seconds. SIGUSR2 toggles stage timings, the timings recorded are logged when
+    they are disabled.
+    """
+
+    def on_profile_signal(signum, frame):
+        profiler.start(profile_seconds, profile_path(profile_dir))
+
+    def on_stage_timings_signal(signum, frame):
+        if stage_timings is None:
+            enable_stage_timings()
+        else:
+            disable_stage_timings()
+
+    signal.signal(signal.SIGUSR1, on_profile_signal)
+    signal.signal(signal.SIGUSR2, on_stage_timings_signal)
@@ -0,0 +1,151 @@
+import ipaddress
+import threading
+import time
+from collections import Counter, OrderedDict
+from enum import Enum
+from typing import *
+
+from attrs import define, field
+import structlog
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_MAX_BUCKETS = 1_000_000
+DEFAULT_TOP_OFFENDERS = 20
+
+
+class RateLimitKey(str, Enum):
+    ADDRESS = "address"
+    SUBNET = "subnet"
+    CLIENT_ID = "client_id"
+
+
+class RateLimitAction(str, Enum):
+    CONGESTION = "congestion"
+    DROP = "drop"
+
+
+def format_key(key: Hashable) -> str:
+    if isinstance(key, tuple):
+        return ":".join(str(part) for part in key)
+    if isinstance(key, bytes):
+        return key.decode(errors="replace")
+    return str(key)
+
+
+@define
+class TokenBucketLimiter:
+    """
+    Token buckets per key. Each key gets `burst` tokens that refill at `rate` tokens per second, and every allowed
+    request takes one token.
+
+    Buckets are kept in an OrderedDict ordered by last use. A bucket that has not been used for burst / rate seconds
+    is full again and is the same as a new bucket, so it can be removed without changing the result. Old buckets are
+    removed from the front on every call, which keeps memory proportional to the number of recently active keys.
+    max_buckets is a hard limit on top of that.
+    """
+
+    rate: float
+    burst: float
+    max_buckets: int = field(default=DEFAULT_MAX_BUCKETS)
+    buckets: "OrderedDict[Hashable, List[float]]" = field(factory=OrderedDict)
+    allowed: int = field(default=0)
+    rejected: int = field(default=0)
+    offenders: Counter = field(factory=Counter)
+    max_offenders: int = field(default=DEFAULT_TOP_OFFENDERS)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    @property
+    def idle_ttl(self) -> float:
+        return self.burst / self.rate
+
+    def allow(self, key: Hashable, now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self.buckets[key] = bucket
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                self.allowed += 1
+                return True
+            self.rejected += 1
+            self._count_offender(key)
+            return False
+
+    def _expire(self, now: float):
+        idle_ttl = self.idle_ttl
+        buckets = self.buckets
+        while buckets:
+            key, (_, last) = next(iter(buckets.items()))
+            if now - last < idle_ttl and len(buckets) < self.max_buckets:
+                return
+            del buckets[key]
+
+    def _count_offender(self, key: Hashable):
+        self.offenders[key] += 1
+        # Only the top offenders are interesting, trim the rest so the counter does not grow without bound.
+        if len(self.offenders) > self.max_offenders * 10:
+            self.offenders = Counter(dict(self.offenders.most_common(self.max_offenders)))
+
+    def top_offenders(self, n: Optional[int] = None) -> List[Tuple[Hashable, int]]:
+        with self.lock:
+            return self.offenders.most_common(n or self.max_offenders)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buckets": len(self.buckets),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "top_offenders": [[format_key(key), count] for key, count in self.top_offenders()],
+        }
+
+
+@define
+class RateLimiter:
+    """
+    Rate limits requests by remote address, by subnet of the remote address or by client id.
+
+    Address and subnet limits are checked before a message is handled. Client id limits can only be checked once the
+    client id is known, that is in CONNECT or after the client store lookup.
+    """
+
+    limiter: TokenBucketLimiter
+    key_type: RateLimitKey = field(default=RateLimitKey.ADDRESS, converter=RateLimitKey)
+    action: RateLimitAction = field(default=RateLimitAction.CONGESTION, converter=RateLimitAction)
+    ipv4_prefix: int = field(default=24)
+    ipv6_prefix: int = field(default=64)
+
+    @property
+    def drops(self) -> bool:
+        """Offenders are not answered, instead of getting CONGESTION."""
+        return self.action is RateLimitAction.DROP
+
+    def subnet(self, ip: str) -> str:
+        # Devices behind a forwarder, "node@ip", count towards the subnet of the forwarder.
+        ip = ip.rpartition("@")[2]
+        address = ipaddress.ip_address(ip)
+        prefix = self.ipv4_prefix if address.version == 4 else self.ipv6_prefix
+        return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+    def allow_address(self, remote_addr: Tuple[str, int]) -> bool:
+        if self.key_type is RateLimitKey.ADDRESS:
+            return self.limiter.allow((remote_addr[0], remote_addr[1]))
+        if self.key_type is RateLimitKey.SUBNET:
+            return self.limiter.allow(self.subnet(remote_addr[0]))
+        return True
+
+    def allow_client(self, client_id: bytes) -> bool:
+        if self.key_type is RateLimitKey.CLIENT_ID:
+            return self.limiter.allow(client_id)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {"key": self.key_type.value, "action": self.action.value, **self.limiter.stats()}
@@ -0,0 +1,202 @@
+import itertools
+import random
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import *
+
+from attrs import define, field
+import structlog
+import valkey
+
+from mqtt_sn_gateway.valkey_client import UNAVAILABLE_ERRORS
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_READ_YOUR_WRITES_WINDOW = 5.0  # seconds
+DEFAULT_RETRY_AFTER = 10.0  # seconds a failing replica is skipped
+LATENCY_SMOOTHING = 0.2
+LATENCY_PROBE_RATE = 0.02  # share of reads sent to a random replica to keep latency estimates fresh
+MAX_RECENT_WRITES = 100_000
+
+
+class ReplicaSelection(str, Enum):
+    ROUND_ROBIN = "round_robin"
+    LATENCY = "latency"
+
+
+@define
+class Replica:
+    name: str
+    valkey: valkey.Valkey
+    latency: Optional[float] = field(default=None)
+    down_until: float = field(default=0.0)
+    reads: int = field(default=0)
+    errors: int = field(default=0)
+
+    def record_latency(self, seconds: float):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+
+@define
+class ReplicaRouter:
+    """
+    Sends reads to replicas and leaves writes to the primary.
+
+    Replication is asynchronous so a replica can lag behind the primary. Two things cover that:
+
+    * Keys written through this router are read from the primary for read_your_writes_window seconds.
+    * A read from a replica that finds nothing is retried on the primary. The write may have been done by another
+      gateway instance, for example a PUBLISH arriving on another node right after its REGISTER.
+
+    A replica that fails is skipped for retry_after seconds and the read goes to the primary.
+    """
+
+    primary: valkey.Valkey
+    replicas: List[Replica]
+    selection: ReplicaSelection = field(default=ReplicaSelection.ROUND_ROBIN, converter=ReplicaSelection)
+    read_your_writes_window: float = field(default=DEFAULT_READ_YOUR_WRITES_WINDOW)
+    retry_after: float = field(default=DEFAULT_RETRY_AFTER)
+    recent_writes: "OrderedDict[str, float]" = field(factory=OrderedDict)
+    primary_reads: int = field(default=0)
+    primary_fallbacks: int = field(default=0)
+    lock: threading.Lock = field(factory=threading.Lock)
+    _round_robin: Iterator[int] = field(init=False)
+
+    def __attrs_post_init__(self):
+        self._round_robin = itertools.cycle(range(len(self.replicas)))
+
+    @classmethod
+    def from_urls(cls, primary: valkey.Valkey, urls: List[str], **kwargs) -> "ReplicaRouter":
+        replicas = [Replica(name=url.rsplit("@", 1)[-1], valkey=valkey.Valkey.from_url(url)) for url in urls]
+        return cls(primary=primary, replicas=replicas, **kwargs)
+
+    def written(self, key: str):
+        """Marks the key as written so it is read from the primary until replicas have caught up."""
+        now = time.monotonic()
+        with self.lock:
+            self.recent_writes[key] = now + self.read_your_writes_window
+            self.recent_writes.move_to_end(key)
+            while self.recent_writes:
+                oldest, expires = next(iter(self.recent_writes.items()))
+                if expires > now and len(self.recent_writes) <= MAX_RECENT_WRITES:
+                    break
+                del self.recent_writes[oldest]
+
+    def recently_written(self, key: str) -> bool:
+        expires = self.recent_writes.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def choose(self) -> Optional[Replica]:
+        now = time.monotonic()
+        available = [replica for replica in self.replicas if replica.down_until <= now]
+        if not available:
+            return None
+        if self.selection is ReplicaSelection.LATENCY:
+            unmeasured = [replica for replica in available if replica.latency is None]
+            if unmeasured:
+                return unmeasured[0]
+            if random.random() < LATENCY_PROBE_RATE:
+                return random.choice(available)
+            return min(available, key=lambda replica: replica.latency)
+        with self.lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[next(self._round_robin)]
+                if replica.down_until <= now:
+                    return replica
+        return None
+
+    def read(self, key: str, command: Callable[[valkey.Valkey], Any]) -> Any:
+        """
+        Runs a read command for key on a replica, or on the primary when the replica can not be trusted to have the
+        data.
+
+        :raises valkey.exceptions.ConnectionError: If the primary is needed and can not be reached.
+        """
+        replica = None if self.recently_written(key) else self.choose()
+        if replica is None:
+            self.primary_reads += 1
+            return command(self.primary)
+
+        start = time.perf_counter()
+        try:
+            result = command(replica.valkey)
+        except UNAVAILABLE_ERRORS:
+            self.replica_failed(replica)
+            self.primary_fallbacks += 1
+            return command(self.primary)
+        replica.record_latency(time.perf_counter() - start)
+        replica.reads += 1
+        if result is None:
+            self.primary_fallbacks += 1
+            return command(self.primary)
+        return result
+
+    def read_many(self, keys: List[str], command: Callable[[valkey.Valkey, List[int]], List[Any]]) -> List[Any]:
+        """
+        Runs a read command for many keys at once, like MGET or a pipeline. command gets the client and the indexes
+        into keys to read, and returns one result per index.
+
+        Keys that were recently written, and keys the replica did not have, are read from the primary with one more
+        call.
+
+        :raises valkey.exceptions.ConnectionError: If the primary is needed and can not be reached.
+        """
+        results: List[Any] = [None] * len(keys)
+        replica = self.choose()
+        if replica is None:
+            from_primary = list(range(len(keys)))
+            from_replica = []
+        else:
+            from_primary = [index for index, key in enumerate(keys) if self.recently_written(key)]
+            from_replica = [index for index, key in enumerate(keys) if not self.recently_written(key)]
+
+        if from_replica:
+            start = time.perf_counter()
+            try:
+                values = command(replica.valkey, from_replica)
+            except UNAVAILABLE_ERRORS:
+                self.replica_failed(replica)
+                self.primary_fallbacks += 1
+                from_primary = list(range(len(keys)))
+            else:
+                replica.record_latency(time.perf_counter() - start)
+                replica.reads += 1
+                misses = [index for index, value in zip(from_replica, values) if value is None]
+                for index, value in zip(from_replica, values):
+                    results[index] = value
+                if misses:
+                    self.primary_fallbacks += 1
+                    from_primary = sorted(from_primary + misses)
+
+        if from_primary:
+            self.primary_reads += 1
+            for index, value in zip(from_primary, command(self.primary, from_primary)):
+                results[index] = value
+        return results
+
+    def replica_failed(self, replica: Replica):
+        replica.errors += 1
+        replica.down_until = time.monotonic() + self.retry_after
+        LOG.warning("Replica unavailable, reading from primary", replica=replica.name, retry_after=self.retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "selection": self.selection.value,
+            "primary_reads": self.primary_reads,
+            "primary_fallbacks": self.primary_fallbacks,
+            "recent_writes": len(self.recent_writes),
+            "replicas": {
+                replica.name: {
+                    "reads": replica.reads,
+                    "errors": replica.errors,
+                    "latency_ms": None if replica.latency is None else round(replica.latency * 1000, 3),
+                    "down": replica.down_until > time.monotonic(),
+                }
+                for replica in self.replicas
+            },
+        }
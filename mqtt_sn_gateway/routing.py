@@ -0,0 +1,129 @@
+from enum import IntEnum
+from typing import *
+
+from attrs import define, field
+from kombu import Exchange
+import structlog
+
+from mqtt_sn_gateway.subscriptions import TopicTrie, is_valid_filter
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_CACHE_SIZE = 10_000
+
+
+class RoutingError(ValueError):
+    """Invalid routing rule"""
+
+
+class DeliveryMode(IntEnum):
+    TRANSIENT = 1
+    PERSISTENT = 2
+
+
+@define
+class Route:
+    """
+    Where and how a publish is sent. properties are the extra arguments to Producer.publish, built once so nothing is
+    allocated per publish.
+    """
+
+    exchange: Exchange
+    delivery_mode: Optional[DeliveryMode] = field(default=None)
+    priority: Optional[int] = field(default=None)
+    properties: Dict[str, Any] = field(init=False)
+
+    def __attrs_post_init__(self):
+        self.properties = {}
+        if self.delivery_mode is not None:
+            self.properties["delivery_mode"] = int(self.delivery_mode)
+        if self.priority is not None:
+            self.properties["priority"] = self.priority
+
+
+def parse_rule(rule: str, exchanges: Dict[str, Exchange]) -> Tuple[str, Route]:
+    """
+    A rule is topic_filter=exchange[:transient|persistent[:priority]], like mr/+/alarm/#=alarms:persistent:9.
+
+    :raises RoutingError:
+    """
+    topic_filter, separator, target = rule.strip().partition("=")
+    if not separator or not is_valid_filter(topic_filter):
+        raise RoutingError(f"Invalid topic filter in routing rule {rule!r}")
+    parts = target.split(":")
+    if not parts[0] or len(parts) > 3:
+        raise RoutingError(f"Routing rule {rule!r} is not topic_filter=exchange[:delivery_mode[:priority]]")
+    exchange = exchanges.setdefault(parts[0], Exchange(parts[0], type="topic"))
+    delivery_mode = None
+    if len(parts) > 1 and parts[1]:
+        try:
+            delivery_mode = DeliveryMode[parts[1].upper()]
+        except KeyError:
+            raise RoutingError(f"Delivery mode in routing rule {rule!r} is not transient or persistent")
+    priority = None
+    if len(parts) > 2 and parts[2]:
+        try:
+            priority = int(parts[2])
+        except ValueError:
+            raise RoutingError(f"Priority in routing rule {rule!r} is not a number")
+        if not 0 <= priority <= 255:
+            raise RoutingError(f"Priority in routing rule {rule!r} is not 0-255")
+    return topic_filter, Route(exchange=exchange, delivery_mode=delivery_mode, priority=priority)
+
+
+@define
+class RoutingTable:
+    """
+    Chooses the route of a publish by its MQTT topic. Rules are compiled into a topic trie at startup and the first
+    matching rule, in configured order, wins. Topics not matching any rule use the default route.
+
+    Routes are cached per topic, so a topic seen before is routed with one dict lookup. The cache is cleared when
+    it reaches cache_size.
+    """
+
+    rules: List[Tuple[str, Route]]
+    default: Route
+    cache_size: int = field(default=DEFAULT_CACHE_SIZE)
+    trie: TopicTrie = field(init=False)
+    cache: Dict[Union[bytes, str], Route] = field(factory=dict)
+    hits: int = field(default=0)
+    misses: int = field(default=0)
+
+    def __attrs_post_init__(self):
+        self.trie = TopicTrie()
+        for index, (topic_filter, _) in enumerate(self.rules):
+            self.trie.add(topic_filter, index)
+
+    @classmethod
+    def from_rules(cls, rules: List[str], default_exchange: Exchange, **kwargs) -> "RoutingTable":
+        """
+        :raises RoutingError:
+        """
+        exchanges = {default_exchange.name: default_exchange}
+        table = cls(rules=[parse_rule(rule, exchanges) for rule in rules], default=Route(exchange=default_exchange),
+                    **kwargs)
+        for topic_filter, route in table.rules:
+            LOG.info("Routing rule", topic_filter=topic_filter, exchange=route.exchange.name, **route.properties)
+        return table
+
+    def exchanges(self) -> List[Exchange]:
+        out = {self.default.exchange.name: self.default.exchange}
+        for _, route in self.rules:
+            out.setdefault(route.exchange.name, route.exchange)
+        return list(out.values())
+
+    def route(self, topic: Union[bytes, str]) -> Route:
+        route = self.cache.get(topic)
+        if route is not None:
+            self.hits += 1
+            return route
+        self.misses += 1
+        matched = self.trie.match(topic.decode() if isinstance(topic, bytes) else topic)
+        route = self.rules[min(matched)][1] if matched else self.default
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[topic] = route
+        return route
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rules": len(self.rules), "cached": len(self.cache), "hits": self.hits, "misses": self.misses}
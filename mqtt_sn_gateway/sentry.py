@@ -0,0 +1,170 @@
+"""
+Error reporting to Sentry.
+
+sentry_sdk and structlog_sentry take a noticeable part of startup to import, so they are only imported when a DSN is
+configured. Until init() is called capture_exception() does nothing, the same as sentry_sdk without a client.
+
+Exceptions are not sent from the thread that handles the datagram. capture_exception() fingerprints the exception by
+its type and where it was raised, rate limits events per fingerprint and puts the rest on a bounded queue that a
+background thread sends to Sentry. When the queue is full the exception is dropped, so a failing dependency can not
+slow down or block requests through error reporting. The number of exceptions behind each event is added to it as
+`occurrences`.
+"""
+import logging
+import queue
+import threading
+from collections import Counter
+from typing import *
+
+from attrs import define, field
+import structlog
+
+if TYPE_CHECKING:
+    from mqtt_sn_gateway.ratelimit import TokenBucketLimiter
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_EVENTS_PER_MINUTE = 6.0  # per fingerprint
+DEFAULT_BURST = 3
+DEFAULT_QUEUE_SIZE = 100
+MAX_FINGERPRINTS = 1_000
+
+sdk: Optional[Any] = None
+reporter: Optional["ErrorReporter"] = None
+
+
+def fingerprint(error: BaseException) -> str:
+    """
+    The exception type and the innermost frame it was raised in. Does not read source files, unlike the traceback
+    module, so it is cheap enough for every failing datagram.
+    """
+    location = ""
+    tb = error.__traceback__
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        location = f"{code.co_filename}:{code.co_name}:{tb.tb_lineno}"
+        tb = tb.tb_next
+    error_type = type(error)
+    return f"{error_type.__module__}.{error_type.__qualname__}@{location}"
+
+
+@define
+class ErrorReporter:
+    """
+    Rate limits exceptions per fingerprint and sends the allowed ones to Sentry from a background thread. Exceptions
+    over the rate limit are only counted, and the count is sent with the next event of the same fingerprint.
+    """
+
+    limiter: "TokenBucketLimiter"
+    send: Callable[[BaseException, str, int, Dict[str, Any]], None]
+    queue_size: int = field(default=DEFAULT_QUEUE_SIZE)
+    events: queue.Queue = field(init=False)
+    occurrences: Counter = field(factory=Counter)
+    thread: Optional[threading.Thread] = field(default=None)
+    reported: int = field(default=0)
+    sent: int = field(default=0)
+    dropped: int = field(default=0)
+    failed: int = field(default=0)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.events = queue.Queue(maxsize=self.queue_size)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="sentry-reporter", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.events.put(None)
+        if self.thread is not None:
+            self.thread.join()
+
+    def report(self, error: BaseException):
+        """Never blocks."""
+        key = fingerprint(error)
+        with self.lock:
+            self.reported += 1
+            self.occurrences[key] += 1
+            if len(self.occurrences) > MAX_FINGERPRINTS:
+                self.occurrences.clear()
+                self.occurrences[key] = 1
+            if not self.limiter.allow(key):
+                return
+            occurrences = self.occurrences.pop(key)
+        # The log context, like the remote address, is bound to the request thread.
+        context = structlog.contextvars.merge_contextvars(None, "", {})
+        try:
+            self.events.put_nowait((error, key, occurrences, context))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            try:
+                self.send(*event)
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                LOG.warning("Unable to send error to Sentry", error=str(e))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "reported": self.reported,
+            "sent": self.sent,
+            "rate_limited": self.limiter.rejected,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "queued": self.events.qsize(),
+            "top_fingerprints": [[key, count] for key, count in self.limiter.top_offenders(5)],
+        }
+
+
+def send_event(error: BaseException, key: str, occurrences: int, context: Dict[str, Any]) -> None:
+    with sdk.new_scope() as scope:
+        scope.fingerprint = [key]
+        scope.set_extra("occurrences", occurrences)
+        if context:
+            scope.set_context("request", context)
+        sdk.capture_exception(error)
+
+
+def init(
+    dsn: str,
+    events_per_minute: float = DEFAULT_EVENTS_PER_MINUTE,
+    burst: int = DEFAULT_BURST,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+) -> None:
+    global sdk, reporter
+    import sentry_sdk
+    from mqtt_sn_gateway.ratelimit import TokenBucketLimiter
+
+    sentry_sdk.init(
+        dsn=dsn,
+        # Add request headers and IP for users,
+        # see https://docs.sentry.io/platforms/python/data-management/data-collected/ for more info
+        send_default_pii=True,
+    )
+    sdk = sentry_sdk
+    reporter = ErrorReporter(
+        limiter=TokenBucketLimiter(rate=events_per_minute / 60, burst=burst),
+        send=send_event,
+        queue_size=queue_size,
+    )
+    reporter.start()
+    LOG.info("Initiated Sentry SDK for error tracking", events_per_minute=events_per_minute, burst=burst)
+
+
+def log_processor() -> Callable:
+    """structlog processor sending CRITICAL log events to Sentry."""
+    from structlog_sentry import SentryProcessor
+
+    return SentryProcessor(event_level=logging.CRITICAL)
+
+
+def capture_exception(error: BaseException) -> None:
+    if reporter is not None:
+        reporter.report(error)
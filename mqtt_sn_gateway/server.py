@@ -1,18 +1,23 @@
+import socket
 import socketserver
-
-import sentry_sdk
-import valkey
+import threading
+import time
 
 from mqtt_sn_gateway.config import Config
-from mqtt_sn_gateway import client_store, gateway, topic_store
+# Parts that are only used when configured are imported where they are set up, so they do not slow down startup.
+from mqtt_sn_gateway import (
+    capture, client_store, gateway, metrics, routing, sentry, topic_store, tracing, udp, valkey_client
+)
 import structlog
 from kombu import Connection, Exchange
 
-from mqtt_sn_gateway.forward import AmqpForwarder
+from mqtt_sn_gateway.forward import AmqpForwarder, ShardedAmqpForwarder
 from functools import partial
 
 LOG = structlog.get_logger(__name__)
 
+WARM_UP_RETRY_DELAY = 0.5  # seconds
+
 
 class MqttSnRequestHandler(socketserver.BaseRequestHandler):
     """
@@ -33,44 +38,446 @@ class MqttSnRequestHandler(socketserver.BaseRequestHandler):
         super().__init__(request, client_address, server)
 
     def handle(self):
+        if self.server.batch_max_size > 1:
+            self.handle_batch()
+            return
+        trace = None
         try:
-            data = self.request[0]
-            socket = self.request[1]
+            data, socket, arrival, received_at = self.request
+            trace = tracing.start(arrival=arrival, deadline=arrival + self.server.request_deadline)
+            trace.add("queue", time.monotonic() - trace.arrival)
+            if self.server.load is not None:
+                self.server.load.request_started(self.client_address)
+            if self.server.capture is not None:
+                self.server.capture.record(capture.Direction.IN, received_at, self.client_address, data)
             structlog.contextvars.bind_contextvars(
                 remote_ip=self.client_address[0], remote_port=self.client_address[1]
             )
+            if trace.expired():
+                self.server.count_requests(expired=1)
+                LOG.warning("Datagram waited past its deadline before handling. Dropping it",
+                            queue_ms=trace.stages_ms()["queue"])
+                return
             LOG.debug("Received UDP data", data=data)
-            vk = valkey.Valkey.from_url(self.config.VALKEY_CONNECTION_STRING)
-            clients = client_store.ValKeyClientStore(
-                valkey=vk, use_port_number=self.config.USE_PORT_NUMBER_IN_CLIENT_STORE
-            )
-            topics = topic_store.ValKeyTopicStore(valkey=vk)
-            amqp_connection = Connection(self.config.AMQP_CONNECTION_STRING)
-            amqp_exchange = Exchange(self.config.AMQP_PUBLISH_EXCHANGE, type="topic")
-            forwarder = AmqpForwarder(
-                exchange=amqp_exchange, connection=amqp_connection
-            )
-            gw = gateway.MqttSnGateway(
-                remote_address=self.client_address,
-                client_store=clients,
-                topic_store=topics,
-                forwarder=forwarder,
-                extend_store_ttl_on_publish=self.config.EXTEND_STORE_TTL_ON_PUBLISH,
-            )
-
-            response = gw.dispatch(data)
+            response = self.server.gateway.dispatch(data, self.client_address)
+            if response is None:
+                return
             out_data = response.to_bytes()
 
             LOG.debug("Sending UDP data", data=out_data)
-            socket.sendto(out_data, self.client_address)
+            with tracing.stage("send"):
+                socket.sendto(out_data, self.client_address)
+            if self.server.capture is not None:
+                self.server.capture.record(capture.Direction.OUT, time.time(), self.client_address, out_data)
+
+        except Exception as e:
+            sentry.capture_exception(e)
+            raise
+        finally:
+            if trace is not None:
+                if self.server.load is not None:
+                    self.server.load.request_done(trace.elapsed())
+                self.log_if_slow(trace)
+
+    def handle_batch(self):
+        """
+        Handles the datagrams that were waiting on the socket together, see MqttSnGateway.dispatch_batch.
+        """
+        datagrams, socket, arrival, received_at = self.request
+        trace = tracing.start(arrival=arrival, deadline=arrival + self.server.request_deadline)
+        trace.add("queue", time.monotonic() - trace.arrival)
+        if self.server.load is not None:
+            for _, address in datagrams:
+                self.server.load.request_started(address)
+        try:
+            if self.server.capture is not None:
+                for data, address in datagrams:
+                    self.server.capture.record(capture.Direction.IN, received_at, address, data)
+            if trace.expired():
+                self.server.count_requests(expired=len(datagrams))
+                LOG.warning("Batch waited past its deadline before handling. Dropping it",
+                            count=len(datagrams), queue_ms=trace.stages_ms()["queue"])
+                return
+            LOG.debug("Received UDP batch", count=len(datagrams))
+            responses = self.server.gateway.dispatch_batch(datagrams)
+            trace.message_type = f"batch of {len(datagrams)}"
+
+            with tracing.stage("send"):
+                for (_, address), response in zip(datagrams, responses):
+                    if isinstance(response, Exception):
+                        sentry.capture_exception(response)
+                        continue
+                    if response is None:
+                        continue
+                    out_data = response.to_bytes()
+                    socket.sendto(out_data, address)
+                    if self.server.capture is not None:
+                        self.server.capture.record(capture.Direction.OUT, time.time(), address, out_data)
 
         except Exception as e:
-            sentry_sdk.capture_exception(e)
+            sentry.capture_exception(e)
             raise
+        finally:
+            if self.server.load is not None:
+                self.server.load.request_done(trace.elapsed(), count=len(datagrams))
+            self.log_if_slow(trace)
+
+    def log_if_slow(self, trace: tracing.RequestTrace):
+        elapsed = trace.elapsed()
+        if elapsed < self.server.slow_request_threshold:
+            return
+        self.server.count_requests(slow=1)
+        LOG.warning(
+            "Slow request",
+            message_type=trace.message_type,
+            total_ms=round(elapsed * 1000, 3),
+            stages_ms=trace.stages_ms(),
+            past_deadline=trace.expired(),
+        )
 
 
 class ThreadingUdpServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
     def __init__(self, server_address, RequestHandlerClass, config: Config):
         self.config = config
+        self.metrics = metrics.MetricsRegistry()
+        if sentry.reporter is not None:
+            self.metrics.register("sentry", sentry.reporter.stats)
+        # Set when the socket is bound and connections are warmed up, see warm_up.
+        self.ready = threading.Event()
+        # Shared by all requests, the client is thread safe and keeps a connection pool.
+        self.valkey = valkey_client.create_valkey(config.VALKEY_CONNECTION_STRING, cluster=config.VALKEY_CLUSTER)
+        self.replicas = None
+        # A cluster client finds the replicas of each shard itself.
+        if config.VALKEY_REPLICA_CONNECTION_STRINGS and not config.VALKEY_CLUSTER:
+            from mqtt_sn_gateway import replicas
+
+            self.replicas = replicas.ReplicaRouter.from_urls(
+                self.valkey,
+                config.VALKEY_REPLICA_CONNECTION_STRINGS,
+                selection=config.VALKEY_REPLICA_SELECTION,
+                read_your_writes_window=config.VALKEY_READ_YOUR_WRITES_WINDOW,
+            )
+            self.metrics.register("valkey_replicas", self.replicas.stats)
+        self.near_cache = None
+        self.invalidation_listener = None
+        self.preloader = None
+        # Invalidations come from one node, so in a cluster they would only cover that node's slots.
+        if config.NEAR_CACHE and not config.VALKEY_CLUSTER:
+            from mqtt_sn_gateway import nearcache
+
+            self.near_cache = nearcache.NearCache(max_size=config.NEAR_CACHE_MAX_SIZE, ttl=config.NEAR_CACHE_TTL)
+            self.invalidation_listener = nearcache.InvalidationListener(
+                url=config.VALKEY_CONNECTION_STRING,
+                cache=self.near_cache,
+                source=nearcache.invalidation_source(config.NEAR_CACHE, config.EXTEND_STORE_TTL_ON_PUBLISH),
+            )
+            self.invalidation_listener.start()
+            self.metrics.register("near_cache", self.near_cache.stats)
+            if config.NEAR_CACHE_PRELOAD:
+                from mqtt_sn_gateway import preload
+
+                self.preloader = preload.Preloader(
+                    valkey=self.valkey,
+                    cache=self.near_cache,
+                    rate=config.NEAR_CACHE_PRELOAD_RATE,
+                    max_keys=config.NEAR_CACHE_PRELOAD_MAX_KEYS,
+                    active_window=config.NEAR_CACHE_PRELOAD_ACTIVE_WINDOW,
+                )
+                self.metrics.register("near_cache_preload", self.preloader.stats)
+        elif config.NEAR_CACHE_PRELOAD:
+            LOG.warning("MQTTSN_NEAR_CACHE_PRELOAD needs the near cache, not preloading")
+        self.simulated_client_store = None
+        self.simulated_topic_store = None
+        self.simulated_forwarder = None
+        if config.SIMULATED_STORES is not None or config.SIMULATED_FORWARDER is not None:
+            self.setup_simulation(config)
+        amqp_exchange = Exchange(config.AMQP_PUBLISH_EXCHANGE, type="topic")
+        # Compiled once, invalid rules stop the gateway from starting.
+        self.routes = routing.RoutingTable.from_rules(config.AMQP_ROUTES, default_exchange=amqp_exchange)
+        if config.AMQP_ROUTES:
+            self.metrics.register("amqp_routes", self.routes.stats)
+        self.sharded_forwarder = None
+        amqp_urls = config.AMQP_SHARD_CONNECTION_STRINGS or [config.AMQP_CONNECTION_STRING]
+        if len(amqp_urls) * config.AMQP_SHARDS > 1 and self.simulated_forwarder is None:
+            self.sharded_forwarder = ShardedAmqpForwarder.from_urls(
+                amqp_urls, exchange=amqp_exchange, connections_per_url=config.AMQP_SHARDS, routes=self.routes
+            )
+            self.metrics.register("amqp_shards", self.sharded_forwarder.stats)
+        # Forwarders that outlive requests wrap this one.
+        shared_forwarder = self.simulated_forwarder or self.sharded_forwarder or AmqpForwarder(
+            exchange=amqp_exchange, connection=Connection(config.AMQP_CONNECTION_STRING), routes=self.routes
+        )
+        self.amqp_forwarder = shared_forwarder
+        self.aggregating_forwarder = None
+        if config.AGGREGATE_WINDOW > 0:
+            from mqtt_sn_gateway import aggregate
+
+            self.aggregating_forwarder = aggregate.AggregatingForwarder(
+                forwarder=shared_forwarder,
+                window=config.AGGREGATE_WINDOW,
+                max_messages=config.AGGREGATE_MAX_MESSAGES,
+                max_bytes=config.AGGREGATE_MAX_BYTES,
+                batch_format=config.AGGREGATE_FORMAT,
+                flush_timeout=config.AGGREGATE_FLUSH_TIMEOUT,
+            )
+            self.aggregating_forwarder.start()
+            self.metrics.register("aggregate", self.aggregating_forwarder.stats)
+            shared_forwarder = self.aggregating_forwarder
+        self.qos0_queue = None
+        if config.QOS0_QUEUE_SIZE > 0:
+            from mqtt_sn_gateway import forward_queue
+
+            self.qos0_queue = forward_queue.QueuedForwarder(
+                forwarder=shared_forwarder,
+                max_size=config.QOS0_QUEUE_SIZE,
+                workers=config.QOS0_QUEUE_WORKERS,
+                policy=config.QOS0_QUEUE_OVERFLOW,
+            )
+            self.qos0_queue.start()
+            self.metrics.register("qos0_queue", self.qos0_queue.stats)
+        self.subscriptions = None
+        self.downlink = None
+        self.downlink_consumer = None
+        if config.DOWNLINK_EXCHANGE:
+            from mqtt_sn_gateway import downlink, subscriptions
+
+            self.subscriptions = subscriptions.SubscriptionIndex(
+                ttl=config.DOWNLINK_SUBSCRIPTION_TTL, max_addresses=config.DOWNLINK_MAX_DEVICES
+            )
+            self.downlink = downlink.DownlinkSender(
+                subscriptions=self.subscriptions,
+                topic_store=self.simulated_topic_store or topic_store.ValKeyTopicStore(
+                    valkey=self.valkey,
+                    replicas=self.replicas,
+                    near_cache=self.near_cache,
+                ),
+                batch_size=config.DOWNLINK_BATCH_SIZE,
+                batch_interval=config.DOWNLINK_BATCH_INTERVAL,
+            )
+            self.downlink_consumer = downlink.DownlinkConsumer(
+                url=config.AMQP_CONNECTION_STRING,
+                exchange=Exchange(config.DOWNLINK_EXCHANGE, type="topic"),
+                sender=self.downlink,
+                binding_key=config.DOWNLINK_BINDING_KEY,
+            )
+            self.metrics.register("downlink", self.downlink.stats)
+        self.load = None
+        self.discovery = None
+        # Load is tracked on every datagram, so only when SEARCHGW is answered or ADVERTISE sent.
+        if config.DISCOVERY or config.ADVERTISE_INTERVAL > 0:
+            from mqtt_sn_gateway import discovery
+
+            self.load = discovery.LoadMonitor(
+                max_in_flight=config.DISCOVERY_MAX_IN_FLIGHT,
+                target_latency=config.DISCOVERY_TARGET_LATENCY,
+                max_sessions=config.DISCOVERY_MAX_SESSIONS,
+            )
+            self.discovery = discovery.Discovery(
+                gw_id=config.GATEWAY_ID,
+                monitor=self.load,
+                max_answer_delay=config.SEARCHGW_MAX_DELAY,
+                advertise_address=(config.ADVERTISE_HOST, config.ADVERTISE_PORT or config.PORT),
+                advertise_interval=config.ADVERTISE_INTERVAL,
+            )
+            self.metrics.register("discovery", self.discovery.stats)
+        self.batch_max_size = config.BATCH_MAX_SIZE
+        self.request_deadline = config.REQUEST_DEADLINE
+        self.slow_request_threshold = config.SLOW_REQUEST_THRESHOLD
+        self.expired_requests = 0
+        self.slow_requests = 0
+        # Counted from every handler thread.
+        self.requests_lock = threading.Lock()
+        self.metrics.register(
+            "requests", lambda: {"expired": self.expired_requests, "slow": self.slow_requests}
+        )
+        self.rate_limiter = None
+        if config.RATE_LIMIT:
+            from mqtt_sn_gateway import ratelimit
+
+            self.rate_limiter = ratelimit.RateLimiter(
+                limiter=ratelimit.TokenBucketLimiter(rate=config.RATE_LIMIT, burst=config.RATE_LIMIT_BURST),
+                key_type=config.RATE_LIMIT_KEY,
+                action=config.RATE_LIMIT_ACTION,
+                ipv4_prefix=config.RATE_LIMIT_IPV4_PREFIX,
+                ipv6_prefix=config.RATE_LIMIT_IPV6_PREFIX,
+            )
+            self.metrics.register("rate_limit", self.rate_limiter.stats)
+        self.unknown_clients = None
+        if config.UNKNOWN_CLIENT_CACHE_TTL > 0:
+            self.unknown_clients = client_store.UnknownClientCache(
+                use_port_number=config.USE_PORT_NUMBER_IN_CLIENT_STORE, ttl=config.UNKNOWN_CLIENT_CACHE_TTL
+            )
+            self.metrics.register("unknown_clients", self.unknown_clients.stats)
+        self.traffic = None
+        if config.TRAFFIC_STATS:
+            from mqtt_sn_gateway import traffic
+
+            self.traffic = traffic.TrafficStats(
+                k=config.TRAFFIC_STATS_TOP_K,
+                window=config.TRAFFIC_STATS_WINDOW,
+                width=config.TRAFFIC_STATS_WIDTH,
+                depth=config.TRAFFIC_STATS_DEPTH,
+            )
+            self.metrics.register("traffic", self.traffic.snapshot)
+        self.capture = None
+        if config.CAPTURE_FILE:
+            self.capture = capture.CaptureWriter(
+                path=config.CAPTURE_FILE,
+                max_bytes=config.CAPTURE_MAX_BYTES,
+                backup_count=config.CAPTURE_BACKUP_COUNT,
+            )
+            self.capture.start()
+            self.metrics.register("capture", lambda: {"dropped": self.capture.dropped})
+        # Built once and shared by all requests.
+        self.gateway = self.build_gateway()
         request_handler = partial(RequestHandlerClass, config=config)
         socketserver.UDPServer.__init__(self, server_address, request_handler)
+        self.socket_monitor = udp.SocketMonitor(
+            sock=self.socket, rcvbuf=self.buffer_sizes["rcvbuf"], interval=config.UDP_STATS_INTERVAL
+        )
+        self.socket_monitor.start()
+        self.metrics.register("udp_socket", self.socket_monitor.stats)
+        if self.discovery is not None:
+            self.discovery.sock = self.socket
+            self.discovery.start_advertising()
+        if self.downlink_consumer is not None:
+            self.downlink.sock = self.socket
+            self.downlink_consumer.start()
+        # Requests are served while the preload runs.
+        if self.preloader is not None:
+            self.preloader.start()
+
+    def server_bind(self):
+        # Before binding, so no datagram arrives while the buffers are still the default size.
+        self.buffer_sizes = udp.set_buffer_sizes(
+            self.socket, rcvbuf=self.config.UDP_RCVBUF, sndbuf=self.config.UDP_SNDBUF
+        )
+        super().server_bind()
+
+    def setup_simulation(self, config: Config):
+        """
+        Stand-ins for Valkey and the AMQP broker with simulated latency and faults, see memory.FaultProfile. For
+        benchmarks without the real services. Everything is kept in memory and nothing is forwarded.
+        """
+        from mqtt_sn_gateway import memory
+
+        if config.SIMULATED_STORES is not None:
+            # Both stores share the profile, as they share a Valkey server.
+            profile = memory.FaultProfile.from_spec(config.SIMULATED_STORES)
+            self.simulated_client_store = memory.SimulatedClientStore(
+                profile=profile, store=memory.MemoryClientStore(use_port_number=config.USE_PORT_NUMBER_IN_CLIENT_STORE)
+            )
+            self.simulated_topic_store = memory.SimulatedTopicStore(profile=profile)
+            self.metrics.register("simulated_stores", profile.stats)
+            LOG.warning("Using simulated stores, nothing is stored in Valkey", profile=config.SIMULATED_STORES)
+        if config.SIMULATED_FORWARDER is not None:
+            self.simulated_forwarder = memory.SimulatedForwarder(
+                profile=memory.FaultProfile.from_spec(config.SIMULATED_FORWARDER)
+            )
+            self.metrics.register("simulated_forwarder", self.simulated_forwarder.stats)
+            LOG.warning("Using simulated forwarder, nothing is sent to AMQP", profile=config.SIMULATED_FORWARDER)
+
+    def build_gateway(self) -> gateway.MqttSnGateway:
+        if self.simulated_client_store is not None:
+            clients, topics = self.simulated_client_store, self.simulated_topic_store
+        else:
+            clients = client_store.ValKeyClientStore(
+                valkey=self.valkey,
+                use_port_number=self.config.USE_PORT_NUMBER_IN_CLIENT_STORE,
+                replicas=self.replicas,
+                near_cache=self.near_cache,
+            )
+            topics = topic_store.ValKeyTopicStore(
+                valkey=self.valkey,
+                replicas=self.replicas,
+                near_cache=self.near_cache,
+            )
+        return gateway.MqttSnGateway(
+            client_store=clients,
+            topic_store=topics,
+            forwarder=self.aggregating_forwarder or self.amqp_forwarder,
+            extend_store_ttl_on_publish=self.config.EXTEND_STORE_TTL_ON_PUBLISH,
+            rate_limiter=self.rate_limiter,
+            unknown_clients=self.unknown_clients,
+            qos0_forwarder=self.qos0_queue,
+            # The load is also tracked for ADVERTISE alone, SEARCHGW is only answered when asked for.
+            discovery=self.discovery if self.config.DISCOVERY else None,
+            subscriptions=self.subscriptions,
+            traffic=self.traffic,
+        )
+
+    def warm_up(self, timeout: float) -> bool:
+        """
+        Connects to Valkey and the broker, so the first requests do not wait for connections, and then sets ready.
+        Retries until timeout. If they can not be reached by then the gateway is ready anyway, requests get
+        CONGESTION until they can be reached. Returns False in that case.
+
+        Datagrams that arrive meanwhile wait on the bound socket.
+        """
+        steps = []
+        if self.simulated_client_store is None:
+            steps.append(("valkey", self.valkey.ping))
+        if self.replicas is not None:
+            steps += [(f"valkey_replica_{replica.name}", replica.valkey.ping) for replica in self.replicas.replicas]
+        steps.append(("amqp", self.amqp_forwarder.warm_up))
+        deadline = time.monotonic() + timeout
+        warmed = True
+        for name, connect in steps:
+            started = time.monotonic()
+            while True:
+                try:
+                    connect()
+                    LOG.info("Warmed up connection", connection=name,
+                             ms=round((time.monotonic() - started) * 1000, 3))
+                    break
+                except Exception as e:
+                    if time.monotonic() + WARM_UP_RETRY_DELAY >= deadline:
+                        LOG.warning("Unable to warm up connection, starting without it", connection=name,
+                                    error=str(e))
+                        warmed = False
+                        break
+                    time.sleep(WARM_UP_RETRY_DELAY)
+        self.ready.set()
+        return warmed
+
+    def count_requests(self, expired: int = 0, slow: int = 0):
+        with self.requests_lock:
+            self.expired_requests += expired
+            self.slow_requests += slow
+
+    def get_request(self):
+        data, client_addr = self.socket.recvfrom(self.max_packet_size)
+        # The arrival time travels with the datagram so queueing before handling can be measured, and the wall clock
+        # time so a capture records when it arrived, not when a handler thread got to it.
+        arrival = time.monotonic()
+        received_at = time.time()
+        if self.batch_max_size <= 1:
+            return (data, self.socket, arrival, received_at), client_addr
+        # Take whatever else is already waiting on the socket, without blocking, and handle it as one batch.
+        datagrams = [(data, client_addr)]
+        while len(datagrams) < self.batch_max_size:
+            try:
+                datagrams.append(self.socket.recvfrom(self.max_packet_size, socket.MSG_DONTWAIT))
+            except BlockingIOError:
+                break
+        return (datagrams, self.socket, arrival, received_at), client_addr
+
+    def server_close(self):
+        if self.downlink_consumer is not None:
+            self.downlink_consumer.stop()
+        self.socket_monitor.stop()
+        super().server_close()
+        if self.discovery is not None:
+            self.discovery.stop()
+        if self.capture is not None:
+            self.capture.stop()
+        if self.preloader is not None:
+            self.preloader.stop()
+        if self.invalidation_listener is not None:
+            self.invalidation_listener.stop()
+        if self.qos0_queue is not None:
+            self.qos0_queue.stop()
+        if self.aggregating_forwarder is not None:
+            self.aggregating_forwarder.stop()
+        if self.sharded_forwarder is not None:
+            self.sharded_forwarder.close()
@@ -0,0 +1,364 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import *
+
+from attrs import define, field
+import structlog
+
+LOG = structlog.get_logger(__name__)
+
+SEPARATOR = "/"
+SINGLE_LEVEL = "+"
+MULTI_LEVEL = "#"
+
+# Same as the client store entry of the device, see client_store.CLIENT_TTL.
+DEFAULT_TTL = 60 * 60 * 24 * 7  # seconds
+DEFAULT_MAX_ADDRESSES = 100_000
+PRUNE_INTERVAL = 60.0  # seconds
+REGISTRATION_TIMEOUT = 60.0  # seconds, a REGISTER not acknowledged by then is sent again with the next message
+MAX_PENDING_REGISTRATIONS = 10_000
+
+
+def is_valid_filter(topic_filter: str) -> bool:
+    """
+    + has to be a whole level, # has to be a whole level and the last one.
+    """
+    if not topic_filter:
+        return False
+    levels = topic_filter.split(SEPARATOR)
+    for index, level in enumerate(levels):
+        if MULTI_LEVEL in level and (level != MULTI_LEVEL or index != len(levels) - 1):
+            return False
+        if SINGLE_LEVEL in level and level != SINGLE_LEVEL:
+            return False
+    return True
+
+
+def has_wildcards(topic_filter: str) -> bool:
+    return SINGLE_LEVEL in topic_filter or MULTI_LEVEL in topic_filter
+
+
+@define
+class TrieNode:
+    children: Dict[str, "TrieNode"] = field(factory=dict)
+    values: Set[Hashable] = field(factory=set)
+
+
+@define
+class TopicTrie:
+    """
+    Maps topic filters, with + and # wildcards, to values. match() walks one level of the trie per level of the topic,
+    following the exact level, + and #, so the cost depends on the depth of the topic and the wildcards on the way,
+    not on how many filters there are.
+
+    As in MQTT, a/# also matches a, and topics starting with $ are not matched by a wildcard in the first level.
+
+    Not thread safe.
+    """
+
+    root: TrieNode = field(factory=TrieNode)
+    size: int = field(default=0)
+
+    def add(self, topic_filter: str, value: Hashable) -> None:
+        node = self.root
+        for level in topic_filter.split(SEPARATOR):
+            node = node.children.setdefault(level, TrieNode())
+        if value not in node.values:
+            node.values.add(value)
+            self.size += 1
+
+    def remove(self, topic_filter: str, value: Hashable) -> bool:
+        """Removes the value and any nodes left empty. Returns False if it was not there."""
+        path = [self.root]
+        levels = topic_filter.split(SEPARATOR)
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return False
+            path.append(node)
+        if value not in path[-1].values:
+            return False
+        path[-1].values.discard(value)
+        self.size -= 1
+        for level, parent, node in zip(reversed(levels), reversed(path[:-1]), reversed(path[1:])):
+            if node.values or node.children:
+                break
+            del parent.children[level]
+        return True
+
+    def match(self, topic: str) -> Set[Hashable]:
+        out: Set[Hashable] = set()
+        levels = topic.split(SEPARATOR)
+        system_topic = topic.startswith("$")
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            wildcards_allowed = depth > 0 or not system_topic
+            multi = node.children.get(MULTI_LEVEL)
+            if multi is not None and wildcards_allowed:
+                out.update(multi.values)
+            if depth == len(levels):
+                out.update(node.values)
+                continue
+            child = node.children.get(levels[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            single = node.children.get(SINGLE_LEVEL)
+            if single is not None and wildcards_allowed:
+                stack.append((single, depth + 1))
+        return out
+
+    def __len__(self) -> int:
+        return self.size
+
+
+@define
+class Subscription:
+    """
+    topic_id is the id given to the client in SUBACK, 0 for filters with wildcards. For those, topics are registered
+    with the client the first time a message for them is sent, and the ids are kept in registered.
+    """
+
+    remote_address: Tuple[str, int]
+    client_id: bytes
+    topic_filter: str
+    topic_id: int
+    registered: Dict[str, int] = field(factory=dict)
+
+
+@define
+class SubscriptionIndex:
+    """
+    Subscriptions of the devices that subscribed through this gateway instance, by topic filter. A device subscribing
+    again to the same filter replaces its subscription.
+
+    Subscriptions of an address expire ttl seconds after the device was last active, like its client store entry, so
+    dead devices are not sent to forever. When a client connects from a new address, after a NAT rebinding for
+    example, its subscriptions move to the new address. At most max_addresses devices are kept, the one that expires
+    first is removed to make room.
+
+    REGISTERs sent to devices for wildcard subscriptions are pending until the device answers with REGACK. If it
+    rejects the topic or does not answer within REGISTRATION_TIMEOUT, the topic is registered again with the next
+    message.
+    """
+
+    ttl: float = field(default=DEFAULT_TTL)
+    max_addresses: int = field(default=DEFAULT_MAX_ADDRESSES)
+    trie: TopicTrie = field(factory=TopicTrie)
+    subscriptions: Dict[Tuple[Tuple[str, int], str], Subscription] = field(factory=dict)
+    by_address: Dict[Tuple[str, int], Set[str]] = field(factory=dict)
+    by_client: Dict[bytes, Set[Tuple[str, int]]] = field(factory=dict)
+    # In expiry order, since every address has the same ttl and is moved to the end when it is extended.
+    expires: "OrderedDict[Tuple[str, int], float]" = field(factory=OrderedDict)
+    pending: "OrderedDict[Tuple[Tuple[str, int], bytes], Tuple[Subscription, str, float]]" = field(
+        factory=OrderedDict
+    )
+    next_prune: float = field(default=0.0)
+    expired: int = field(default=0)
+    evicted: int = field(default=0)
+    moved: int = field(default=0)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    # So the gateway can use them through the index it is given, without importing this module.
+    is_valid_filter = staticmethod(is_valid_filter)
+    has_wildcards = staticmethod(has_wildcards)
+
+    def subscribe_client(
+        self, remote_address: Tuple[str, int], client_id: bytes, topic_filter: str, topic_id: int
+    ) -> None:
+        self.subscribe(Subscription(
+            remote_address=remote_address, client_id=client_id, topic_filter=topic_filter, topic_id=topic_id
+        ))
+
+    def subscribe(self, subscription: Subscription) -> None:
+        now = time.monotonic()
+        address = subscription.remote_address
+        key = (address, subscription.topic_filter)
+        with self.lock:
+            self.prune(now)
+            if self.max_addresses and address not in self.by_address and len(self.by_address) >= self.max_addresses:
+                self.evict()
+            self.add(key, subscription)
+            self.extend(address, now)
+
+    def touch(self, remote_address: Tuple[str, int]) -> None:
+        """Extends the subscriptions of an active device. Called where its client store entry is extended."""
+        if remote_address not in self.expires:
+            return
+        with self.lock:
+            if remote_address in self.expires:
+                self.extend(remote_address, time.monotonic())
+
+    def move_client(self, client_id: bytes, remote_address: Tuple[str, int]) -> int:
+        """
+        Moves the subscriptions of client_id from any other address to remote_address, when the client connects
+        again without a clean session. Returns the number moved.
+        """
+        if client_id not in self.by_client:
+            return 0
+        moved = 0
+        with self.lock:
+            for address in list(self.by_client.get(client_id, ())):
+                if address == remote_address:
+                    continue
+                for topic_filter in list(self.by_address.get(address, ())):
+                    subscription = self.subscriptions[(address, topic_filter)]
+                    if subscription.client_id != client_id:
+                        continue
+                    self.remove(address, topic_filter)
+                    subscription.remote_address = remote_address
+                    self.add((remote_address, topic_filter), subscription)
+                    moved += 1
+            if moved:
+                self.extend(remote_address, time.monotonic())
+                self.moved += moved
+        return moved
+
+    def unsubscribe(self, remote_address: Tuple[str, int], topic_filter: str) -> bool:
+        with self.lock:
+            return self.remove(remote_address, topic_filter)
+
+    def remove_address(self, remote_address: Tuple[str, int]) -> int:
+        """Removes all subscriptions of a remote address, for example on a clean session CONNECT."""
+        with self.lock:
+            topic_filters = list(self.by_address.get(remote_address, ()))
+            for topic_filter in topic_filters:
+                self.remove(remote_address, topic_filter)
+            return len(topic_filters)
+
+    def add(self, key: Tuple[Tuple[str, int], str], subscription: Subscription) -> None:
+        previous = self.subscriptions.get(key)
+        if previous is not None:
+            self.remove(*key)
+        address = subscription.remote_address
+        self.subscriptions[key] = subscription
+        self.trie.add(subscription.topic_filter, key)
+        self.by_address.setdefault(address, set()).add(subscription.topic_filter)
+        self.by_client.setdefault(subscription.client_id, set()).add(address)
+
+    def remove(self, remote_address: Tuple[str, int], topic_filter: str) -> bool:
+        key = (remote_address, topic_filter)
+        subscription = self.subscriptions.pop(key, None)
+        if subscription is None:
+            return False
+        self.trie.remove(topic_filter, key)
+        topic_filters = self.by_address[remote_address]
+        topic_filters.discard(topic_filter)
+        if not topic_filters:
+            del self.by_address[remote_address]
+            self.expires.pop(remote_address, None)
+        if not any(
+            self.subscriptions[(remote_address, other)].client_id == subscription.client_id
+            for other in topic_filters
+        ):
+            addresses = self.by_client.get(subscription.client_id, set())
+            addresses.discard(remote_address)
+            if not addresses:
+                self.by_client.pop(subscription.client_id, None)
+        return True
+
+    def extend(self, remote_address: Tuple[str, int], now: float) -> None:
+        self.expires[remote_address] = now + self.ttl
+        self.expires.move_to_end(remote_address)
+
+    def remove_expired(self, remote_address: Tuple[str, int]) -> None:
+        for topic_filter in list(self.by_address.get(remote_address, ())):
+            self.remove(remote_address, topic_filter)
+        self.expired += 1
+
+    def evict(self) -> None:
+        if not self.expires:
+            return
+        address = next(iter(self.expires))
+        for topic_filter in list(self.by_address.get(address, ())):
+            self.remove(address, topic_filter)
+        self.evicted += 1
+
+    def prune(self, now: float) -> None:
+        """Removes expired addresses and registrations. Runs at most every PRUNE_INTERVAL, with the lock held."""
+        if now < self.next_prune:
+            return
+        self.next_prune = now + PRUNE_INTERVAL
+        while self.expires:
+            address, expires = next(iter(self.expires.items()))
+            if expires > now:
+                break
+            self.remove_expired(address)
+        while self.pending:
+            key, (subscription, topic, sent) = next(iter(self.pending.items()))
+            if sent + REGISTRATION_TIMEOUT > now:
+                break
+            del self.pending[key]
+            subscription.registered.pop(topic, None)
+
+    def registering(self, subscription: Subscription, topic: str, topic_id: int, msg_id: bytes) -> None:
+        """Records a REGISTER sent to the device, until it is acknowledged with REGACK."""
+        with self.lock:
+            subscription.registered[topic] = topic_id
+            self.pending[(subscription.remote_address, msg_id)] = (subscription, topic, time.monotonic())
+            if len(self.pending) > MAX_PENDING_REGISTRATIONS:
+                _, (oldest, oldest_topic, _) = self.pending.popitem(last=False)
+                oldest.registered.pop(oldest_topic, None)
+
+    def acknowledge(self, remote_address: Tuple[str, int], msg_id: bytes, accepted: bool) -> bool:
+        """
+        Matches a REGACK from the device to its pending REGISTER. A rejected topic is registered again with the
+        next message. Returns False if there was no such REGISTER.
+        """
+        with self.lock:
+            pending = self.pending.pop((remote_address, msg_id), None)
+            if pending is None:
+                return False
+            subscription, topic, _ = pending
+            if not accepted:
+                subscription.registered.pop(topic, None)
+            return True
+
+    def forget_topic_id(self, remote_address: Tuple[str, int], topic_id: int) -> int:
+        """
+        Forgets a topic id the device rejected in a PUBACK, so the topic is registered again with the next message.
+        Returns the number of subscriptions it was registered for.
+        """
+        forgotten = 0
+        with self.lock:
+            for topic_filter in self.by_address.get(remote_address, ()):
+                registered = self.subscriptions[(remote_address, topic_filter)].registered
+                for topic in [topic for topic, value in registered.items() if value == topic_id]:
+                    del registered[topic]
+                    forgotten += 1
+        return forgotten
+
+    def match(self, topic: str) -> List[Subscription]:
+        """
+        Subscriptions matching the topic, at most one per remote address. An exact filter is preferred, since the
+        client already knows its topic id. Expired subscriptions are removed instead.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.prune(now)
+            keys = self.trie.match(topic)
+            matched: Dict[Tuple[str, int], Subscription] = {}
+            expired = set()
+            for key in keys:
+                subscription = self.subscriptions[key]
+                address = subscription.remote_address
+                if self.expires.get(address, now) < now:
+                    expired.add(address)
+                    continue
+                current = matched.get(address)
+                if current is None or subscription.topic_filter == topic:
+                    matched[address] = subscription
+            for address in expired:
+                self.remove_expired(address)
+            return list(matched.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscriptions": len(self.subscriptions),
+            "addresses": len(self.by_address),
+            "pending_registrations": len(self.pending),
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "moved": self.moved,
+        }
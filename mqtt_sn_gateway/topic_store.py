@@ -3,6 +3,13 @@ from typing import *
 import structlog
 import valkey
 
+from mqtt_sn_gateway.valkey_client import UNAVAILABLE_ERRORS
+
+if TYPE_CHECKING:
+    # Only used when configured, see server.ThreadingUdpServer.
+    from mqtt_sn_gateway.nearcache import NearCache
+    from mqtt_sn_gateway.replicas import ReplicaRouter
+
 LOG = structlog.get_logger(__name__)
 
 DEFAULT_TTL = 60 * 60 * 24 * 7 # 7 days
@@ -29,6 +36,13 @@ class TopicStore(Protocol):
         """
         ...
 
+    def get_topics(self, lookups: List[Tuple[bytes, int]]) -> List[Optional[bytes]]:
+        """
+        Looks up many (client_id, topic_id) in one call. Topics that do not exist are None.
+        :raises TopicStoreConnectionError: Incase unable to connect to topic store
+        """
+        ...
+
     def delete_all_topics(self, client_id: bytes) -> None:
         """
         On clean session all topics should be erased.
@@ -44,10 +58,24 @@ class TopicStore(Protocol):
 
 @define
 class ValKeyTopicStore:
+    """
+    Keyname for topics is "topic:client_id".
+
+    With replicas, lookups are routed to read replicas and writes stay on the primary.
+
+    With a near cache, lookups are served from process memory and misses are read from the primary.
+    """
     valkey: valkey.Valkey
+    replicas: Optional["ReplicaRouter"] = field(default=None)
+    near_cache: Optional["NearCache"] = field(default=None)
 
-    @staticmethod
-    def build_key(client_id: bytes) -> str:
+    def written(self, key: str):
+        if self.replicas is not None:
+            self.replicas.written(key)
+        if self.near_cache is not None:
+            self.near_cache.written(key)
+
+    def build_key(self, client_id: bytes) -> str:
         return f"topic:{client_id.decode()}"
 
     def add_topic_for_client(self, client_id: bytes, topic_name: str) -> int:
@@ -58,9 +86,10 @@ class ValKeyTopicStore:
             key = self.build_key(client_id)
             LOG.debug("Adding topic for client", key=key, client_id=client_id, topic_name=topic_name)
             index = self.valkey.rpush(key, topic_name)
+            self.written(key)
             LOG.debug("Topic register for client", key=key, client_id=client_id, topic_name=topic_name, topic_id=index)
             return index
-        except valkey.exceptions.ConnectionError:
+        except UNAVAILABLE_ERRORS:
             raise ConnectionError("Unable to connect to topic store")
 
     def get_topic_for_client(self, client_id: bytes, topic_id: int) -> bytes:
@@ -71,7 +100,14 @@ class ValKeyTopicStore:
             key = self.build_key(client_id)
             topic_index = topic_id - 1
             LOG.debug("Requesting topic name for topic id", client_id=client_id, topic_index=topic_index, topic_id=topic_id)
-            result = self.valkey.lindex(key, topic_index)
+            if self.near_cache is not None:
+                result = self.near_cache.read_through(
+                    key, ("LINDEX", topic_index), lambda: self.valkey.lindex(key, topic_index)
+                )
+            elif self.replicas is not None:
+                result = self.replicas.read(key, lambda vk: vk.lindex(key, topic_index))
+            else:
+                result = self.valkey.lindex(key, topic_index)
             if isinstance(result, tuple):
                 topic = result[0]
             else:
@@ -83,7 +119,32 @@ class ValKeyTopicStore:
                       topic_name=topic)
 
             return topic
-        except valkey.exceptions.ConnectionError:
+        except UNAVAILABLE_ERRORS:
+            raise ConnectionError("Unable to connect to topic store")
+
+    def get_topics(self, lookups: List[Tuple[bytes, int]]) -> List[Optional[bytes]]:
+        """
+        Uses one pipeline of LINDEX for all lookups, or for those not in the near cache.
+        """
+        keys = [self.build_key(client_id) for client_id, _ in lookups]
+
+        def lindex_all(vk: valkey.Valkey, indexes: List[int]) -> List[Optional[bytes]]:
+            pipeline = vk.pipeline(transaction=False)
+            for index in indexes:
+                pipeline.lindex(keys[index], lookups[index][1] - 1)
+            return pipeline.execute()
+
+        try:
+            LOG.debug("Requesting topic names", count=len(lookups))
+            if self.near_cache is not None:
+                return self.near_cache.read_many(
+                    [(key, ("LINDEX", topic_id - 1)) for key, (_, topic_id) in zip(keys, lookups)],
+                    lambda indexes: lindex_all(self.valkey, indexes),
+                )
+            if self.replicas is not None:
+                return self.replicas.read_many(keys, lindex_all)
+            return lindex_all(self.valkey, list(range(len(keys))))
+        except UNAVAILABLE_ERRORS:
             raise ConnectionError("Unable to connect to topic store")
 
     def delete_all_topics(self, client_id: bytes) -> None:
@@ -91,7 +152,8 @@ class ValKeyTopicStore:
             key = self.build_key(client_id)
             LOG.debug("Deleting all topics for client", key=key, client_id=client_id)
             self.valkey.delete(key)
-        except valkey.exceptions.ConnectionError:
+            self.written(key)
+        except UNAVAILABLE_ERRORS:
             raise ConnectionError("Unable to connect to topic store")
 
     def extend_topic_ttl(self, client_id: bytes) -> None:
@@ -99,5 +161,5 @@ class ValKeyTopicStore:
             key = self.build_key(client_id)
             LOG.debug("Extending ttl for topic list", key=key, client_id=client_id)
             self.valkey.expire(key, DEFAULT_TTL)
-        except valkey.exceptions.ConnectionError:
+        except UNAVAILABLE_ERRORS:
             raise ConnectionError("Unable to connect to topic store")
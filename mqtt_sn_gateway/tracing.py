@@ -0,0 +1,74 @@
+import contextlib
+import time
+from contextvars import ContextVar
+from typing import *
+
+from attrs import define, field
+
+
+class DeadlineExceeded(Exception):
+    """The request waited past its deadline and is not worth handling anymore"""
+
+
+@define
+class RequestTrace:
+    """
+    Follows one datagram through the gateway. Times are from time.monotonic().
+
+    The deadline is when the device will have given up on the request and retransmitted it, so work on the request
+    after that is wasted.
+    """
+
+    arrival: float
+    deadline: float
+    stages: Dict[str, float] = field(factory=dict)
+    message_type: Optional[str] = field(default=None)
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def expired(self) -> bool:
+        return time.monotonic() > self.deadline
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.arrival
+
+    def stages_ms(self) -> Dict[str, float]:
+        return {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()}
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("request_trace", default=None)
+
+
+def start(arrival: float, deadline: float) -> RequestTrace:
+    """Starts tracing the request handled in the current context."""
+    trace = RequestTrace(arrival=arrival, deadline=deadline)
+    _current_trace.set(trace)
+    return trace
+
+
+def current() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Adds the time spent in the block to the stage of the current trace, if there is one."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add(name, time.monotonic() - start_time)
+
+
+def check_deadline():
+    """
+    :raises DeadlineExceeded: If the request in the current context is past its deadline.
+    """
+    trace = _current_trace.get()
+    if trace is not None and trace.expired():
+        raise DeadlineExceeded(f"Request is {trace.elapsed():.3f} s old")
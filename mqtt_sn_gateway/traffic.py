@@ -0,0 +1,168 @@
+import threading
+import time
+from array import array
+from typing import *
+
+from attrs import define, field
+import structlog
+
+from mqtt_sn_gateway.ratelimit import format_key
+
+LOG = structlog.get_logger(__name__)
+
+DEFAULT_WIDTH = 2048
+DEFAULT_DEPTH = 4
+DEFAULT_TOP_K = 20
+DEFAULT_WINDOW = 300.0  # seconds, counts are halved after each window
+HASH_MASK = 0xFFFFFFFFFFFFFFFF
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+@define
+class CountMinSketch:
+    """
+    Approximate counts for any number of keys in width * depth counters. An estimate is never below the true count
+    and is above it by at most about total / width with high probability.
+
+    Uses conservative update, only the counters at the current minimum for the key are raised, which keeps
+    overestimates of rare keys lower than a plain count-min sketch. Row indexes are derived from one hash of the key.
+    """
+
+    width: int = field(default=DEFAULT_WIDTH)
+    depth: int = field(default=DEFAULT_DEPTH)
+    rows: List[array] = field(init=False)
+
+    def __attrs_post_init__(self):
+        self.rows = [array("q", bytes(8 * self.width)) for _ in range(self.depth)]
+
+    def indexes(self, key: Hashable) -> List[int]:
+        # Each row takes the high bits of a new multiplicative hash of the digest. Rows derived as first + row * step
+        # let two keys collide in every row far too often in a narrow sketch.
+        digest = hash(key) & HASH_MASK
+        out = []
+        for row in range(self.depth):
+            digest = (digest * HASH_MULTIPLIER + row + 1) & HASH_MASK
+            out.append((digest >> 32) % self.width)
+        return out
+
+    def add(self, key: Hashable, amount: int = 1, indexes: Optional[List[int]] = None) -> int:
+        """
+        Adds amount to key and returns its new estimate. indexes from a sketch of the same size can be passed to
+        not hash the key again.
+        """
+        if indexes is None:
+            indexes = self.indexes(key)
+        counters = list(zip(self.rows, indexes))
+        estimate = min([row[index] for row, index in counters]) + amount
+        for row, index in counters:
+            if row[index] < estimate:
+                row[index] = estimate
+        return estimate
+
+    def estimate(self, key: Hashable) -> int:
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+    def decay(self):
+        for number, row in enumerate(self.rows):
+            self.rows[number] = array("q", [value >> 1 for value in row])
+
+
+@define
+class HeavyHitters:
+    """
+    The k keys with the highest estimated weight in the sketch. A key enters the top when its estimate passes the
+    smallest one in it. floor is a lower bound of that smallest estimate, so the top is only searched when a key
+    could enter it.
+    """
+
+    k: int = field(default=DEFAULT_TOP_K)
+    sketch: CountMinSketch = field(factory=CountMinSketch)
+    top: Dict[Hashable, int] = field(factory=dict)
+    floor: int = field(default=0)
+    total: int = field(default=0)
+
+    def add(self, key: Hashable, amount: int = 1, indexes: Optional[List[int]] = None):
+        self.total += amount
+        estimate = self.sketch.add(key, amount, indexes)
+        if key in self.top or len(self.top) < self.k:
+            self.top[key] = estimate
+            return
+        if estimate <= self.floor:
+            return
+        smallest = min(self.top, key=self.top.__getitem__)
+        if estimate > self.top[smallest]:
+            del self.top[smallest]
+            self.top[key] = estimate
+            smallest = min(self.top, key=self.top.__getitem__)
+        self.floor = self.top[smallest]
+
+    def decay(self):
+        self.sketch.decay()
+        self.total >>= 1
+        self.floor >>= 1
+        self.top = {key: value >> 1 for key, value in self.top.items()}
+
+    def most_common(self) -> List[Tuple[Hashable, int]]:
+        return sorted(self.top.items(), key=lambda item: item[1], reverse=True)
+
+
+@define
+class TrafficStats:
+    """
+    Publishes and payload bytes per topic and per client id, as heavy hitter summaries in fixed memory. Counts are
+    halved at the end of every window, so old traffic fades out and the top lists show recent load.
+
+    Memory is 4 sketches of width * depth 8 byte counters plus 4 top lists of k keys, no matter how many topics and
+    clients there are.
+    """
+
+    k: int = field(default=DEFAULT_TOP_K)
+    width: int = field(default=DEFAULT_WIDTH)
+    depth: int = field(default=DEFAULT_DEPTH)
+    window: float = field(default=DEFAULT_WINDOW)
+    summaries: Dict[str, HeavyHitters] = field(init=False)
+    window_started: float = field(factory=time.monotonic)
+    windows: int = field(default=0)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.summaries = {
+            name: HeavyHitters(k=self.k, sketch=CountMinSketch(width=self.width, depth=self.depth))
+            for name in ["publishes_by_topic", "bytes_by_topic", "publishes_by_client", "bytes_by_client"]
+        }
+
+    def record(self, client_id: bytes, topic: Union[bytes, str], size: int):
+        now = time.monotonic()
+        summaries = self.summaries
+        with self.lock:
+            if now - self.window_started >= self.window:
+                self.decay(now)
+            # All sketches have the same size, so each key is hashed once.
+            topic_indexes = summaries["publishes_by_topic"].sketch.indexes(topic)
+            client_indexes = summaries["publishes_by_client"].sketch.indexes(client_id)
+            summaries["publishes_by_topic"].add(topic, 1, topic_indexes)
+            summaries["bytes_by_topic"].add(topic, size, topic_indexes)
+            summaries["publishes_by_client"].add(client_id, 1, client_indexes)
+            summaries["bytes_by_client"].add(client_id, size, client_indexes)
+
+    def decay(self, now: float):
+        for summary in self.summaries.values():
+            summary.decay()
+        self.window_started = now
+        self.windows += 1
+
+    def estimate(self, name: str, key: Hashable) -> int:
+        with self.lock:
+            return self.summaries[name].sketch.estimate(key)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            out: Dict[str, Any] = {
+                "window_seconds": self.window,
+                "windows": self.windows,
+                "publishes": self.summaries["publishes_by_topic"].total,
+                "bytes": self.summaries["bytes_by_topic"].total,
+            }
+            for name, summary in self.summaries.items():
+                out[f"top_{name}"] = [[format_key(key), value] for key, value in summary.most_common()]
+        return out
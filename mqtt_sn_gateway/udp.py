@@ -0,0 +1,138 @@
+import os
+import socket
+import threading
+from typing import *
+
+from attrs import define, field
+import structlog
+
+LOG = structlog.get_logger(__name__)
+
+PROC_NET_UDP = ["/proc/net/udp", "/proc/net/udp6"]
+DEFAULT_SAMPLE_INTERVAL = 10.0  # seconds
+
+
+def set_buffer_sizes(
+    sock: socket.socket, rcvbuf: Optional[int] = None, sndbuf: Optional[int] = None
+) -> Dict[str, int]:
+    """
+    Requests socket buffer sizes and returns what the kernel granted. Linux doubles the requested size for its own
+    bookkeeping but caps the request at net.core.rmem_max and net.core.wmem_max first, so a granted size below the
+    requested one means the limit was hit.
+    """
+    granted = {}
+    for name, option, requested, limit in [
+        ("rcvbuf", socket.SO_RCVBUF, rcvbuf, "net.core.rmem_max"),
+        ("sndbuf", socket.SO_SNDBUF, sndbuf, "net.core.wmem_max"),
+    ]:
+        if requested is not None:
+            sock.setsockopt(socket.SOL_SOCKET, option, requested)
+        granted[name] = sock.getsockopt(socket.SOL_SOCKET, option)
+        if requested is None:
+            continue
+        if granted[name] < requested:
+            LOG.warning("Kernel granted a smaller UDP socket buffer than requested, raise the limit",
+                        buffer=name, requested=requested, granted=granted[name], limit=limit)
+        else:
+            LOG.info("Set UDP socket buffer", buffer=name, requested=requested, granted=granted[name])
+    return granted
+
+
+def parse_proc_net_udp(lines: Iterable[str], inode: int) -> Optional[Dict[str, int]]:
+    """
+    Queue sizes in bytes and drops of the socket with inode, from the format of /proc/net/udp:
+
+    sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+    """
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 13 or not fields[0].endswith(":") or int(fields[9]) != inode:
+            continue
+        tx_queue, rx_queue = fields[4].split(":")
+        return {"tx_queue": int(tx_queue, 16), "rx_queue": int(rx_queue, 16), "drops": int(fields[12])}
+    return None
+
+
+@define
+class SocketMonitor:
+    """
+    Samples the receive queue and the kernel drop counter of the server socket from /proc/net/udp. Drops are the
+    datagrams the kernel discarded since the socket was created because the receive buffer was full, they never reach
+    the gateway. A receive queue that is often near rcvbuf means the gateway falls behind.
+
+    Sampled every interval in the background, so short bursts are seen between /metrics requests, and on every stats()
+    call. Not available outside Linux.
+    """
+
+    sock: socket.socket
+    rcvbuf: int = field(default=0)
+    interval: float = field(default=DEFAULT_SAMPLE_INTERVAL)
+    paths: List[str] = field(factory=lambda: list(PROC_NET_UDP))
+    inode: int = field(init=False)
+    available: bool = field(default=True)
+    last: Optional[Dict[str, int]] = field(default=None)
+    max_rx_queue: int = field(default=0)
+    samples: int = field(default=0)
+    stop_event: threading.Event = field(factory=threading.Event)
+    thread: Optional[threading.Thread] = field(default=None)
+    lock: threading.Lock = field(factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        self.inode = os.fstat(self.sock.fileno()).st_ino
+
+    def read(self) -> Optional[Dict[str, int]]:
+        for path in self.paths:
+            try:
+                with open(path) as f:
+                    result = parse_proc_net_udp(f, self.inode)
+            except OSError:
+                continue
+            if result is not None:
+                return result
+        return None
+
+    def sample(self) -> Optional[Dict[str, int]]:
+        if not self.available:
+            return None
+        current = self.read()
+        if current is None:
+            self.available = False
+            LOG.info("UDP socket statistics are not available", paths=self.paths)
+            return None
+        with self.lock:
+            if self.last is not None and current["drops"] > self.last["drops"]:
+                LOG.warning("Kernel dropped datagrams, the UDP receive buffer was full",
+                            dropped=current["drops"] - self.last["drops"], rx_queue=current["rx_queue"],
+                            rcvbuf=self.rcvbuf)
+            self.last = current
+            self.max_rx_queue = max(self.max_rx_queue, current["rx_queue"])
+            self.samples += 1
+        return current
+
+    def start(self):
+        if self.interval <= 0 or self.sample() is None:
+            return
+        self.thread = threading.Thread(target=self.run, name="udp-socket-monitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def stats(self) -> Dict[str, Any]:
+        current = self.sample()
+        if current is None:
+            return {"available": False, "rcvbuf": self.rcvbuf}
+        return {
+            "available": True,
+            "rcvbuf": self.rcvbuf,
+            "rx_queue_bytes": current["rx_queue"],
+            "max_rx_queue_bytes": self.max_rx_queue,
+            "tx_queue_bytes": current["tx_queue"],
+            "drops": current["drops"],
+        }
@@ -0,0 +1,32 @@
+from typing import List, Optional, Union
+
+import valkey
+import valkey.cluster
+import structlog
+
+LOG = structlog.get_logger(__name__)
+
+# Errors that mean the store can not be reached right now, as opposed to errors in how it is used.
+UNAVAILABLE_ERRORS = (
+    valkey.exceptions.ConnectionError,
+    valkey.exceptions.ClusterError,
+    valkey.exceptions.SlotNotCoveredError,
+)
+
+
+def create_valkey(url: str, cluster: bool = False) -> Union[valkey.Valkey, valkey.cluster.ValkeyCluster]:
+    """
+    Creates a client with its own connection pool. It is thread safe and should be shared by all requests.
+    A cluster client discovers the rest of the cluster from the node in the url.
+    """
+    if cluster:
+        LOG.info("Using Valkey Cluster", url=url)
+        return valkey.cluster.ValkeyCluster.from_url(url)
+    return valkey.Valkey.from_url(url)
+
+
+def mget(client: Union[valkey.Valkey, valkey.cluster.ValkeyCluster], keys: List[str]) -> List[Optional[bytes]]:
+    """MGET that also works across slots on a cluster, with one MGET per slot."""
+    if isinstance(client, valkey.cluster.ValkeyCluster):
+        return client.mget_nonatomic(keys)
+    return client.mget(keys)
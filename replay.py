@@ -0,0 +1,231 @@
+"""
+Replays datagrams captured by the gateway (MQTTSN_CAPTURE_FILE) against a MQTT-SN gateway.
+
+Every source address in the capture gets its own UDP socket, so each original device keeps a distinct source port
+during the replay. Datagrams from one source are sent in the captured order and a datagram is not sent before the
+response to the previous one from the same source has arrived or timed out.
+
+    python replay.py capture.bin.2 capture.bin.1 capture.bin --port 2883 --speed 1
+    python replay.py capture.bin --speed 10
+    python replay.py capture.bin --speed 0   # as fast as possible
+
+When done the latency and errors of the replay are compared with the responses recorded in the capture.
+"""
+import asyncio
+import itertools
+import time
+from collections import defaultdict
+from typing import *
+
+import click
+from attrs import define, field
+
+from mqtt_sn_gateway import capture, messages
+
+ResponseKey = Tuple[messages.MessageType, bytes]
+
+
+def expected_response(message) -> Optional[ResponseKey]:
+    """The response to wait for, None if there is none to wait for."""
+    if reply_optional(message):
+        return None
+    if isinstance(message, messages.Connect):
+        return messages.MessageType.CONNACK, b""
+    if isinstance(message, messages.Register):
+        return messages.MessageType.REGACK, message.msg_id
+    if isinstance(message, messages.Publish):
+        return messages.MessageType.PUBACK, message.msg_id
+    if isinstance(message, messages.Pingreq):
+        return messages.MessageType.PINGRESP, b""
+    return None
+
+
+def response_key(message) -> ResponseKey:
+    return message.msg_type, getattr(message, "msg_id", b"")
+
+
+def is_error(response) -> bool:
+    if isinstance(response, messages.Disconnect):
+        return True
+    return getattr(response, "return_code", messages.ReturnCode.ACCEPTED) != messages.ReturnCode.ACCEPTED
+
+
+def parse(data: bytes):
+    try:
+        return messages.MessageFactory.from_bytes(data)
+    except messages.ParsingError:
+        return None
+
+
+def reply_optional(message) -> bool:
+    """A successful QoS 0 PUBLISH is not answered, only rejections are."""
+    return isinstance(message, messages.Publish) and message.flags.qos == 0
+
+
+@define
+class Outcome:
+    latencies: List[float] = field(factory=list)
+    requests: int = field(default=0)
+    errors: int = field(default=0)
+    timeouts: int = field(default=0)
+
+    def add(self, latency: Optional[float], error: bool):
+        self.requests += 1
+        if latency is not None:
+            self.latencies.append(latency)
+        else:
+            self.timeouts += 1
+        if error:
+            self.errors += 1
+
+    def percentile(self, percent: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        values = sorted(self.latencies)
+        return values[max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))]
+
+
+def analyse_capture(records: List[capture.CaptureRecord]) -> Outcome:
+    """Pairs the captured requests with the captured responses to get the latency and errors of the original run."""
+    outcome = Outcome()
+    pending: Dict[Tuple[str, int], Dict[ResponseKey, Tuple[float, Any]]] = defaultdict(dict)
+    for record in records:
+        message = parse(record.data)
+        if message is None:
+            continue
+        source = pending[record.remote_addr]
+        if record.direction == capture.Direction.IN:
+            key = expected_response(message)
+            if key is not None:
+                source[key] = (record.timestamp, message)
+            continue
+        if isinstance(message, messages.Disconnect):
+            matched = [source.pop(next(iter(source)))] if source else []
+        else:
+            matched = [source.pop(response_key(message))] if response_key(message) in source else []
+        for timestamp, _ in matched:
+            outcome.add(record.timestamp - timestamp, is_error(message))
+    for source in pending.values():
+        for _ in source.values():
+            outcome.add(None, True)
+    return outcome
+
+
+class Source(asyncio.DatagramProtocol):
+    """Replays the datagrams of one captured source address from its own socket."""
+
+    def __init__(self, outcome: Outcome, response_timeout: float):
+        self.outcome = outcome
+        self.response_timeout = response_timeout
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.waiting: Optional[Tuple[ResponseKey, asyncio.Future]] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        message = parse(data)
+        if message is None or self.waiting is None:
+            return
+        key, future = self.waiting
+        if not future.done() and (isinstance(message, messages.Disconnect) or response_key(message) == key):
+            future.set_result(message)
+
+    def error_received(self, exc):
+        pass
+
+    async def replay(self, records: List[capture.CaptureRecord], start: float, first_timestamp: float,
+                     speed: float):
+        loop = asyncio.get_running_loop()
+        for record in records:
+            if speed > 0:
+                delay = start + (record.timestamp - first_timestamp) / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            message = parse(record.data)
+            key = expected_response(message) if message is not None else None
+            if key is None:
+                self.transport.sendto(record.data)
+                continue
+            future = loop.create_future()
+            self.waiting = (key, future)
+            sent = time.perf_counter()
+            self.transport.sendto(record.data)
+            try:
+                response = await asyncio.wait_for(future, self.response_timeout)
+                self.outcome.add(time.perf_counter() - sent, is_error(response))
+            except asyncio.TimeoutError:
+                self.outcome.add(None, True)
+            finally:
+                self.waiting = None
+
+
+async def replay(records: List[capture.CaptureRecord], host: str, port: int, speed: float,
+                 response_timeout: float) -> Outcome:
+    loop = asyncio.get_running_loop()
+    outcome = Outcome()
+    by_source: Dict[Tuple[str, int], List[capture.CaptureRecord]] = defaultdict(list)
+    for record in records:
+        if record.direction == capture.Direction.IN:
+            by_source[record.remote_addr].append(record)
+    if not by_source:
+        return outcome
+    first_timestamp = min(source_records[0].timestamp for source_records in by_source.values())
+    transports = []
+    runs = []
+    start = time.perf_counter()
+    for source_records in by_source.values():
+        transport, source = await loop.create_datagram_endpoint(
+            lambda: Source(outcome, response_timeout), remote_addr=(host, port)
+        )
+        transports.append(transport)
+        runs.append(source.replay(source_records, start, first_timestamp, speed))
+    try:
+        await asyncio.gather(*runs)
+    finally:
+        for transport in transports:
+            transport.close()
+    return outcome
+
+
+def format_ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.2f}"
+
+
+def report(original: Outcome, replayed: Outcome):
+    rows = [
+        ("requests", original.requests, replayed.requests),
+        ("errors", original.errors, replayed.errors),
+        ("no response", original.timeouts, replayed.timeouts),
+    ]
+    click.echo(f"{'':<16}{'original':>12}{'replay':>12}{'delta':>12}")
+    for name, before, after in rows:
+        click.echo(f"{name:<16}{before:>12}{after:>12}{after - before:>+12}")
+    for percent in (50, 90, 99):
+        before, after = original.percentile(percent), replayed.percentile(percent)
+        delta = "-" if before is None or after is None else f"{(after - before) * 1000:+.2f}"
+        click.echo(f"{f'p{percent} ms':<16}{format_ms(before):>12}{format_ms(after):>12}{delta:>12}")
+
+
+@click.command()
+@click.argument("capture_files", nargs=-1, required=True)
+@click.option("--host", default="127.0.0.1", help="Target host for MQTT-SN gateway")
+@click.option("--port", default=1884, help="Target port for MQTT-SN gateway")
+@click.option("--speed", default=1.0, help="Replay speed. 1 is real time, 10 is ten times faster, 0 is max speed")
+@click.option("--response-timeout", default=5.0, help="Seconds to wait for a response")
+def main(capture_files, host, port, speed, response_timeout):
+    """
+    Replay capture files against a MQTT-SN gateway. Give rotated files oldest first.
+    """
+    records = list(itertools.chain.from_iterable(capture.read_capture(path) for path in capture_files))
+    sources = {record.remote_addr for record in records if record.direction == capture.Direction.IN}
+    click.echo(f"Replaying {len(records)} records from {len(sources)} sources to {host}:{port}")
+    original = analyse_capture(records)
+    start = time.perf_counter()
+    replayed = asyncio.run(replay(records, host, port, speed, response_timeout))
+    click.echo(f"Replay took {time.perf_counter() - start:.2f} s\n")
+    report(original, replayed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+from mqtt_sn_gateway import memory
+from mqtt_sn_gateway.aggregate import AggregatingForwarder, BatchFlushError, BatchFormat, frame, unframe
+
+
+class RecordingForwarder(memory.MemoryForwarder):
+    def __init__(self, fail=False):
+        super().__init__()
+        self.messages = []
+        self.fail = fail
+
+    def forward_publish(self, topic, payload, qos):
+        if self.fail:
+            raise ConnectionError("Broker down")
+        self.messages.append((topic, payload))
+
+
+@pytest.fixture
+def aggregator():
+    aggregator = AggregatingForwarder(forwarder=RecordingForwarder(), window=0.01, max_messages=3)
+    aggregator.start()
+    yield aggregator
+    aggregator.stop()
+
+
+class TestFraming:
+    @pytest.mark.parametrize("batch_format", list(BatchFormat))
+    def test_roundtrip(self, batch_format):
+        payloads = [b'{"V":1}', b"", b'{"V":2}']
+        assert unframe(frame(payloads, batch_format), batch_format) == payloads
+
+    def test_length_prefixed(self):
+        assert frame([b"ab"], BatchFormat.LENGTH_PREFIXED) == b"\x00\x00\x00\x02ab"
+
+
+class TestAggregatingForwarder:
+    def test_batches_until_max_messages(self, aggregator):
+        threads = [
+            threading.Thread(target=aggregator.forward_publish, args=(b"a/b", str(n).encode(), 1)) for n in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(aggregator.forwarder.messages) == 1
+        topic, payload = aggregator.forwarder.messages[0]
+        assert topic == b"a/b"
+        assert sorted(unframe(payload, BatchFormat.NDJSON)) == [b"0", b"1", b"2"]
+
+    def test_window_flushes_partial_batch(self, aggregator):
+        aggregator.forward_publish(b"a/b", b"1", qos=1)
+        assert aggregator.forwarder.messages == [(b"a/b", b"1\n")]
+
+    def test_topics_are_batched_separately(self, aggregator):
+        aggregator.forward_publishes([(b"a", b"1", 1), (b"b", b"2", 1), (b"a", b"3", 1)])
+        assert sorted(aggregator.forwarder.messages) == [(b"a", b"1\n3\n"), (b"b", b"2\n")]
+
+    def test_qos0_does_not_wait(self, aggregator):
+        aggregator.forward_publish(b"a/b", b"1", qos=0)
+        aggregator.stop()
+        assert aggregator.forwarder.messages == [(b"a/b", b"1\n")]
+
+    def test_failed_flush_raises_for_qos1(self):
+        aggregator = AggregatingForwarder(forwarder=RecordingForwarder(fail=True), window=0.01)
+        aggregator.start()
+        with pytest.raises(BatchFlushError):
+            aggregator.forward_publish(b"a/b", b"1", qos=1)
+        aggregator.stop()
+        assert aggregator.errors == 1
+
+    def test_payload_with_newline_keeps_topic_order(self):
+        aggregator = AggregatingForwarder(forwarder=RecordingForwarder(), window=10)
+        aggregator.start()
+        aggregator.forward_publish(b"a/b", b"1", qos=0)
+        aggregator.forward_publish(b"a/b", b"2\n3", qos=1)
+        aggregator.stop()
+        assert aggregator.forwarder.messages == [(b"a/b", b"1\n"), (b"a/b", b"2\n3")]
+
+    def test_wait_times_out(self):
+        aggregator = AggregatingForwarder(forwarder=RecordingForwarder(), window=10, flush_timeout=0.01)
+        with pytest.raises(BatchFlushError):
+            aggregator.forward_publish(b"a/b", b"1", qos=1)
+        assert aggregator.stats()["timeouts"] == 1
+
+    def test_timeouts_counted_from_many_threads(self):
+        aggregator = AggregatingForwarder(forwarder=RecordingForwarder(), window=10, flush_timeout=0.01)
+        batch = aggregator.add(b"a/b", b"1")
+
+        def wait():
+            for _ in range(20):
+                with pytest.raises(BatchFlushError):
+                    aggregator.wait(batch, timeout=0)
+
+        threads = [threading.Thread(target=wait) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert aggregator.stats()["timeouts"] == 160
+
+    def test_refused_once_stopped(self, aggregator):
+        aggregator.stop()
+        with pytest.raises(BatchFlushError):
+            aggregator.forward_publish(b"a/b", b"1", qos=0)
@@ -0,0 +1,83 @@
+from mqtt_sn_gateway import gateway, memory, messages
+
+
+class CountingClientStore(memory.MemoryClientStore):
+    single_lookups: int = 0
+    batch_lookups: int = 0
+
+    def get_client(self, remote_addr):
+        self.single_lookups += 1
+        return super().get_client(remote_addr)
+
+    def get_clients(self, remote_addrs):
+        self.batch_lookups += 1
+        return super().get_clients(remote_addrs)
+
+
+class FailingForwarder(memory.MemoryForwarder):
+    def forward_publishes(self, publishes):
+        raise RuntimeError("Broker down")
+
+
+def connect(client_id: bytes) -> bytes:
+    return messages.Connect(flags=messages.Flags(clean_session=True), duration=60, client_id=client_id).to_bytes()
+
+
+def publish(topic_id: int, msg_id: int) -> bytes:
+    return messages.Publish(
+        flags=messages.Flags(qos=1), topic_id=topic_id, msg_id=msg_id.to_bytes(2, "big"), data=b"1"
+    ).to_bytes()
+
+
+def build(clients=None, forwarder=None) -> gateway.MqttSnGateway:
+    return gateway.MqttSnGateway(
+        client_store=clients or CountingClientStore(),
+        topic_store=memory.MemoryTopicStore(),
+        forwarder=forwarder or memory.MemoryForwarder(),
+    )
+
+
+class TestDispatchBatch:
+    def test_lookups_are_done_once_for_the_batch(self):
+        gw = build()
+        for port in range(1000, 1010):
+            gw.client_store.add_client(f"C{port}".encode(), ("10.0.0.1", port))
+            gw.topic_store.add_topic_for_client(f"C{port}".encode(), "a/b")
+        responses = gw.dispatch_batch([(publish(1, port), ("10.0.0.1", port)) for port in range(1000, 1010)])
+        assert [response.msg_id for response in responses] == [port.to_bytes(2, "big") for port in range(1000, 1010)]
+        assert all(response.return_code == messages.ReturnCode.ACCEPTED for response in responses)
+        assert gw.client_store.batch_lookups == 1
+        assert gw.client_store.single_lookups == 0
+        assert gw.forwarder.published == 10
+
+    def test_per_message_errors(self):
+        gw = build()
+        gw.client_store.add_client(b"C1", ("10.0.0.1", 1000))
+        responses = gw.dispatch_batch([
+            (b"\x02", ("10.0.0.1", 1000)),
+            (publish(1, 1), ("10.0.0.1", 1000)),
+            (publish(1, 2), ("10.0.0.2", 1000)),
+        ])
+        assert isinstance(responses[0], gateway.MessageError)
+        assert responses[1].return_code == messages.ReturnCode.INVALID_TOPIC
+        assert isinstance(responses[2], messages.Disconnect)
+
+    def test_connect_and_register_earlier_in_batch_are_seen(self):
+        gw = build()
+        register = messages.Register(msg_id=b"\x00\x01", topic_name="a/b", topic_id=None).to_bytes()
+        responses = gw.dispatch_batch([
+            (connect(b"C1"), ("10.0.0.1", 1000)),
+            (register, ("10.0.0.1", 1000)),
+            (publish(1, 2), ("10.0.0.1", 1000)),
+        ])
+        assert responses[0].return_code == messages.ReturnCode.ACCEPTED
+        assert responses[1].topic_id == 1
+        assert responses[2].return_code == messages.ReturnCode.ACCEPTED
+
+    def test_failed_forward_gives_congestion(self):
+        gw = build(forwarder=FailingForwarder())
+        gw.client_store.add_client(b"C1", ("10.0.0.1", 1000))
+        gw.topic_store.add_topic_for_client(b"C1", "a/b")
+        responses = gw.dispatch_batch([(publish(1, 1), ("10.0.0.1", 1000))])
+        assert responses[0].return_code == messages.ReturnCode.CONGESTION
+        assert responses[0].msg_id == b"\x00\x01"
@@ -0,0 +1,53 @@
+import os
+import threading
+
+from mqtt_sn_gateway import capture
+
+
+class TestCapture:
+    def test_roundtrip(self, tmp_path):
+        path = str(tmp_path / "capture.bin")
+        writer = capture.CaptureWriter(path=path)
+        writer.start()
+        writer.record(capture.Direction.IN, 1000.5, ("10.0.0.1", 1234), b"\x02\x16")
+        writer.record(capture.Direction.OUT, 1000.75, ("2001:db8::1", 4321), b"\x02\x17")
+        writer.stop()
+
+        records = list(capture.read_capture(path))
+        assert records == [
+            capture.CaptureRecord(capture.Direction.IN, 1000.5, ("10.0.0.1", 1234), b"\x02\x16"),
+            capture.CaptureRecord(capture.Direction.OUT, 1000.75, ("2001:db8::1", 4321), b"\x02\x17"),
+        ]
+
+    def test_rotation(self, tmp_path):
+        path = str(tmp_path / "capture.bin")
+        writer = capture.CaptureWriter(path=path, max_bytes=100, backup_count=2)
+        writer.start()
+        for index in range(20):
+            writer.record(capture.Direction.IN, float(index), ("10.0.0.1", 1234), b"x" * 20)
+        writer.stop()
+
+        assert os.path.exists(path + ".1")
+        assert os.path.exists(path + ".2")
+        assert not os.path.exists(path + ".3")
+        timestamps = [
+            record.timestamp
+            for file in (path + ".2", path + ".1", path)
+            for record in capture.read_capture(file)
+        ]
+        assert timestamps == sorted(timestamps)
+        assert timestamps[-1] == 19.0
+
+    def test_drops_counted_from_many_threads(self, tmp_path):
+        writer = capture.CaptureWriter(path=str(tmp_path / "capture.bin"), queue_size=1)
+
+        def record():
+            for _ in range(1000):
+                writer.record(capture.Direction.IN, 0.0, ("10.0.0.1", 1000), b"x")
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert writer.dropped == 8 * 1000 - 1
@@ -0,0 +1,59 @@
+from mqtt_sn_gateway import client_store, gateway, memory, messages
+from mqtt_sn_gateway.subscriptions import SubscriptionIndex
+
+
+class CountingClientStore(memory.MemoryClientStore):
+    lookups: int = 0
+
+    def get_client(self, remote_addr):
+        self.lookups += 1
+        return super().get_client(remote_addr)
+
+
+class TestUnknownClientCache:
+    def test_add_and_discard(self):
+        cache = client_store.UnknownClientCache(use_port_number=True)
+        cache.add(("10.0.0.1", 1000))
+        assert cache.contains(("10.0.0.1", 1000))
+        assert not cache.contains(("10.0.0.1", 1001))
+        cache.discard(("10.0.0.1", 1000))
+        assert not cache.contains(("10.0.0.1", 1000))
+
+    def test_expires(self):
+        cache = client_store.UnknownClientCache(use_port_number=True, ttl=-1)
+        cache.add(("10.0.0.1", 1000))
+        assert not cache.contains(("10.0.0.1", 1000))
+
+    def test_gateway_answers_repeat_offenders_without_store_lookup(self):
+        store = CountingClientStore()
+        cache = client_store.UnknownClientCache(use_port_number=True)
+        gw = gateway.MqttSnGateway(
+            client_store=store,
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+            unknown_clients=cache,
+        )
+        publish = messages.Publish(flags=messages.Flags(qos=1), topic_id=1, msg_id=b"\x00\x01", data=b"1").to_bytes()
+        assert isinstance(gw.dispatch(publish, ("10.0.0.1", 1000)), messages.Disconnect)
+        assert isinstance(gw.dispatch(publish, ("10.0.0.1", 1000)), messages.Disconnect)
+        assert store.lookups == 1
+
+        connect = messages.Connect(flags=messages.Flags(), duration=60, client_id=b"client-1").to_bytes()
+        gw.dispatch(connect, ("10.0.0.1", 1000))
+        assert not cache.contains(("10.0.0.1", 1000))
+
+    def test_gateway_answers_repeat_subscribe_without_store_lookup(self):
+        store = CountingClientStore()
+        gw = gateway.MqttSnGateway(
+            client_store=store,
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+            subscriptions=SubscriptionIndex(),
+            unknown_clients=client_store.UnknownClientCache(use_port_number=True),
+        )
+        subscribe = messages.Subscribe(flags=messages.Flags(qos=0), msg_id=b"\x00\x01", topic_name="a/b").to_bytes()
+        assert isinstance(gw.dispatch(subscribe, ("10.0.0.1", 1000)), messages.Disconnect)
+        assert isinstance(gw.dispatch(subscribe, ("10.0.0.1", 1000)), messages.Disconnect)
+        assert store.lookups == 1
+        unsubscribe = messages.Unsubscribe(flags=messages.Flags(qos=0), msg_id=b"\x00\x02", topic_name="a/b")
+        assert isinstance(gw.dispatch(unsubscribe.to_bytes(), ("10.0.0.1", 1000)), messages.Unsuback)
@@ -14,3 +14,8 @@ class TestConnect:
         assert msg.duration == int.from_bytes(b"\xfd ", 'big')
         assert msg.client_id == b'94193A04010020B8'
 
+
+    def test_to_bytes(self):
+        data = b'\x16\x04\x04\x01\xfd 94193A04010020B8'
+        msg = messages.Connect.from_bytes(data)
+        assert msg.to_bytes() == data
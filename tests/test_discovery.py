@@ -0,0 +1,150 @@
+import socket
+import threading
+import time
+
+from mqtt_sn_gateway import gateway, memory, messages
+from mqtt_sn_gateway.discovery import Discovery, LoadMonitor
+
+SEARCHGW = b"\x03\x01\x00"
+ADDRESS = ("10.0.0.1", 1000)
+
+
+def build_discovery(**kwargs) -> Discovery:
+    monitor = LoadMonitor(max_in_flight=10, target_latency=0.1, max_sessions=100)
+    return Discovery(gw_id=7, monitor=monitor, max_answer_delay=0.5, **kwargs)
+
+
+class TestDiscoveryMessages:
+    def test_advertise(self):
+        advertise = messages.Advertise(gw_id=7, duration=900)
+        assert advertise.to_bytes() == b"\x05\x00\x07\x03\x84"
+        assert messages.MessageFactory.from_bytes(advertise.to_bytes()) == advertise
+
+    def test_searchgw(self):
+        data = b"\x03\x01\x00"
+        assert messages.MessageFactory.from_bytes(data) == messages.Searchgw(radius=0)
+        assert messages.Searchgw(radius=0).to_bytes() == data
+
+    def test_gwinfo(self):
+        assert messages.Gwinfo(gw_id=7).to_bytes() == b"\x03\x02\x07"
+        gwinfo = messages.Gwinfo(gw_id=7, gw_address=b"\x0a\x00\x00\x01")
+        assert messages.MessageFactory.from_bytes(gwinfo.to_bytes()) == gwinfo
+
+
+class TestLoadMonitor:
+    def test_idle(self):
+        assert build_discovery().monitor.load() == 0.0
+
+    def test_in_flight(self):
+        monitor = build_discovery().monitor
+        for port in range(5):
+            monitor.request_started(("10.0.0.1", port))
+        assert monitor.load() == 0.5
+        monitor.request_done(0.0, count=5)
+        assert monitor.in_flight == 0
+
+    def test_sessions_expire(self):
+        monitor = LoadMonitor(max_in_flight=10, target_latency=0.1, max_sessions=100, session_window=0.05)
+        monitor.request_started(("10.0.0.1", 1000))
+        time.sleep(0.06)
+        monitor.request_started(("10.0.0.2", 1000))
+        assert len(monitor.sessions) == 1
+
+
+class TestDiscovery:
+    def test_answer_delay_grows_with_load(self):
+        discovery = build_discovery()
+        assert discovery.answer_delay() == 0.0
+        discovery.monitor.in_flight = 5
+        assert discovery.answer_delay() == 0.25
+
+    def test_delayed_answers_are_bounded(self):
+        discovery = build_discovery(max_scheduled=2)
+        try:
+            assert discovery.send_later(ADDRESS, discovery.gwinfo(), 60)
+            assert discovery.send_later(ADDRESS, discovery.gwinfo(), 60)
+            assert not discovery.send_later(ADDRESS, discovery.gwinfo(), 60)
+            assert discovery.stats()["searchgw_dropped"] == 1
+            assert discovery.stats()["searchgw_scheduled"] == 2
+        finally:
+            discovery.stop()
+        discovery.scheduler.join(1)
+        assert not discovery.scheduler.is_alive()
+
+    def test_delayed_answers_sent_when_due_by_one_thread(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(2)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        discovery = build_discovery(sock=sender)
+        try:
+            discovery.send_later(receiver.getsockname(), messages.Gwinfo(gw_id=2), 0.05)
+            discovery.send_later(receiver.getsockname(), messages.Gwinfo(gw_id=1), 0.01)
+            assert [messages.MessageFactory.from_bytes(receiver.recvfrom(64)[0]).gw_id for _ in range(2)] == [1, 2]
+        finally:
+            discovery.stop()
+            receiver.close()
+            sender.close()
+
+    def test_declines_at_full_load(self):
+        discovery = build_discovery()
+        discovery.monitor.in_flight = 10
+        assert discovery.answer_delay() is None
+        assert discovery.stats()["searchgw_declined"] == 1
+
+    def test_answers_counted_from_many_threads(self):
+        discovery = build_discovery()
+
+        def search():
+            for _ in range(1000):
+                discovery.answer_delay()
+
+        threads = [threading.Thread(target=search) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert discovery.stats()["searchgw_answered"] == 8000
+
+
+class TestSearchgw:
+    def build(self, discovery) -> gateway.MqttSnGateway:
+        return gateway.MqttSnGateway(
+            client_store=memory.MemoryClientStore(),
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+            discovery=discovery,
+        )
+
+    def test_answered_when_idle(self):
+        response = self.build(build_discovery()).dispatch(SEARCHGW, ADDRESS)
+        assert response == messages.Gwinfo(gw_id=7)
+
+    def test_not_answered_at_full_load(self):
+        discovery = build_discovery()
+        discovery.monitor.in_flight = 10
+        assert self.build(discovery).dispatch(SEARCHGW, ADDRESS) is None
+
+    def test_not_answered_without_discovery(self):
+        assert self.build(None).dispatch(SEARCHGW, ADDRESS) is None
+
+    def test_answered_later_under_load(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(2)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        discovery = build_discovery(sock=sender)
+        discovery.monitor.in_flight = 1
+        try:
+            assert self.build(discovery).dispatch(SEARCHGW, receiver.getsockname()) is None
+            data, _ = receiver.recvfrom(64)
+            assert messages.MessageFactory.from_bytes(data) == messages.Gwinfo(gw_id=7)
+        finally:
+            receiver.close()
+            sender.close()
+
+    def test_answered_right_away_via_forwarder(self):
+        discovery = build_discovery()
+        discovery.monitor.in_flight = 1
+        node = gateway.node_address(ADDRESS, b"\x01")
+        assert self.build(discovery).dispatch(SEARCHGW, node) == messages.Gwinfo(gw_id=7)
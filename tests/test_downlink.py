@@ -0,0 +1,168 @@
+import socket
+import time
+
+import pytest
+from kombu import Connection, Exchange, Producer
+
+from mqtt_sn_gateway import downlink, gateway, memory, messages
+from mqtt_sn_gateway.subscriptions import SubscriptionIndex
+
+
+@pytest.fixture
+def receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(2)
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def sender():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    yield downlink.DownlinkSender(
+        subscriptions=SubscriptionIndex(), topic_store=memory.MemoryTopicStore(), batch_size=2, sock=sock
+    )
+    sock.close()
+
+
+def subscribe(index: SubscriptionIndex, remote_address, topic_filter: str) -> messages.MqttSnMessage:
+    clients = memory.MemoryClientStore()
+    clients.add_client(b"meter", remote_address)
+    gw = gateway.MqttSnGateway(
+        client_store=clients,
+        topic_store=memory.MemoryTopicStore(),
+        forwarder=memory.MemoryForwarder(),
+        subscriptions=index,
+    )
+    message = messages.Subscribe(flags=messages.Flags(qos=0), msg_id=b"\x00\x01", topic_name=topic_filter)
+    return gw.dispatch(message.to_bytes(), remote_address)
+
+
+def receive(sock: socket.socket) -> messages.MqttSnMessage:
+    data, _ = sock.recvfrom(1024)
+    return messages.MessageFactory.from_bytes(data)
+
+
+class TestSubscribe:
+    def test_subscribe_to_topic(self):
+        index = SubscriptionIndex()
+        response = subscribe(index, ("10.0.0.1", 1000), "config/meter")
+        assert response == messages.Suback(
+            flags=messages.Flags(qos=0), topic_id=1, msg_id=b"\x00\x01", return_code=messages.ReturnCode.ACCEPTED
+        )
+        assert len(index.match("config/meter")) == 1
+
+    def test_wildcard_gets_topic_id_0(self):
+        response = subscribe(SubscriptionIndex(), ("10.0.0.1", 1000), "config/#")
+        assert response.topic_id == 0
+        assert response.return_code == messages.ReturnCode.ACCEPTED
+
+    def test_invalid_filter(self):
+        response = subscribe(SubscriptionIndex(), ("10.0.0.1", 1000), "config/#/meter")
+        assert response.return_code == messages.ReturnCode.INVALID_TOPIC
+
+    def test_not_supported_without_downlink(self):
+        response = subscribe(None, ("10.0.0.1", 1000), "config/meter")
+        assert response.return_code == messages.ReturnCode.NOT_SUPPORTED
+
+    def test_unsubscribe(self):
+        index = SubscriptionIndex()
+        subscribe(index, ("10.0.0.1", 1000), "config/meter")
+        gw = gateway.MqttSnGateway(
+            client_store=memory.MemoryClientStore(),
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+            subscriptions=index,
+        )
+        message = messages.Unsubscribe(flags=messages.Flags(qos=0), msg_id=b"\x00\x02", topic_name="config/meter")
+        assert gw.dispatch(message.to_bytes(), ("10.0.0.1", 1000)) == messages.Unsuback(msg_id=b"\x00\x02")
+        assert index.match("config/meter") == []
+
+
+class TestDownlinkSender:
+    def test_publish_to_exact_subscription(self, sender, receiver):
+        subscribe(sender.subscriptions, receiver.getsockname(), "config/meter")
+        assert sender.fan_out("config/meter", b"interval=60") == 1
+        publish = receive(receiver)
+        assert publish.topic_id == 1
+        assert publish.flags.qos == 0
+        assert publish.data == b"interval=60"
+
+    def test_wildcard_registers_topic_once(self, sender, receiver):
+        subscribe(sender.subscriptions, receiver.getsockname(), "config/#")
+        sender.fan_out("config/meter", b"1")
+        register = receive(receiver)
+        assert register.topic_name == "config/meter"
+        assert receive(receiver).topic_id == register.topic_id
+        sender.fan_out("config/meter", b"2")
+        assert isinstance(receive(receiver), messages.Publish)
+        assert sender.registers == 1
+
+    def test_regack_from_device_is_matched(self, sender, receiver):
+        subscribe(sender.subscriptions, receiver.getsockname(), "config/#")
+        sender.fan_out("config/meter", b"1")
+        register = receive(receiver)
+        gw = gateway.MqttSnGateway(
+            client_store=memory.MemoryClientStore(),
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+            subscriptions=sender.subscriptions,
+        )
+        regack = messages.Regack(
+            topic_id=register.topic_id, msg_id=register.msg_id, return_code=messages.ReturnCode.ACCEPTED
+        )
+        assert gw.dispatch(regack.to_bytes(), receiver.getsockname()) is None
+        assert sender.subscriptions.stats()["pending_registrations"] == 0
+
+    def test_rejected_topic_is_registered_again(self, sender, receiver):
+        subscribe(sender.subscriptions, receiver.getsockname(), "config/#")
+        sender.fan_out("config/meter", b"1")
+        publish = [receive(receiver), receive(receiver)][1]
+        gw = gateway.MqttSnGateway(
+            client_store=memory.MemoryClientStore(),
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+            subscriptions=sender.subscriptions,
+        )
+        puback = messages.Puback(
+            topic_id=publish.topic_id, msg_id=publish.msg_id, return_code=messages.ReturnCode.INVALID_TOPIC
+        )
+        assert gw.dispatch(puback.to_bytes(), receiver.getsockname()) is None
+        sender.fan_out("config/meter", b"2")
+        assert isinstance(receive(receiver), messages.Register)
+        assert sender.registers == 2
+
+    def test_sent_in_batches(self, sender, receiver):
+        host, port = receiver.getsockname()
+        receiver.close()
+        for offset in range(5):
+            subscribe(sender.subscriptions, (host, port + offset), "config/+")
+        sender.batch_interval = 0.01
+        sender.fan_out("config/all", b"1")
+        assert sender.sent + sender.errors == 10
+
+    def test_encapsulated_for_node_address(self, sender, receiver):
+        host, port = receiver.getsockname()
+        subscribe(sender.subscriptions, gateway.node_address((host, port), b"\x0a\x0b"), "config/meter")
+        sender.fan_out("config/meter", b"1")
+        frame = receive(receiver)
+        assert frame.wireless_node_id == b"\x0a\x0b"
+        assert messages.Publish.from_bytes(frame.data).data == b"1"
+
+
+def test_consumer_fans_out_from_exchange(sender, receiver):
+    subscribe(sender.subscriptions, receiver.getsockname(), "config/meter")
+    exchange = Exchange("downlink", type="topic")
+    consumer = downlink.DownlinkConsumer(url="memory://", exchange=exchange, sender=sender)
+    consumer.start()
+    try:
+        with Connection("memory://") as connection:
+            producer = Producer(connection.channel(), exchange=exchange)
+            deadline = time.monotonic() + 2
+            while sender.received == 0 and time.monotonic() < deadline:
+                producer.publish(b"interval=60", routing_key="config.meter")
+                time.sleep(0.05)
+        assert receive(receiver).data == b"interval=60"
+    finally:
+        consumer.stop()
@@ -0,0 +1,70 @@
+import pytest
+
+from mqtt_sn_gateway import gateway, memory, messages
+
+CONNECT = messages.Connect(flags=messages.Flags(clean_session=True), duration=60, client_id=b"C1").to_bytes()
+
+
+def encapsulate(node_id: bytes, data: bytes, ctrl: int = 0) -> bytes:
+    return messages.Encapsulated(ctrl=ctrl, wireless_node_id=node_id, data=data).to_bytes()
+
+
+FORWARDER = ("10.0.0.1", 1000)
+
+
+def build() -> gateway.MqttSnGateway:
+    return gateway.MqttSnGateway(
+        client_store=memory.MemoryClientStore(),
+        topic_store=memory.MemoryTopicStore(),
+        forwarder=memory.MemoryForwarder(),
+    )
+
+
+class TestEncapsulated:
+    def test_to_bytes(self):
+        assert encapsulate(b"\xAA\xBB", b"\x02\x16", ctrl=1) == b"\x05\xFE\x01\xAA\xBB\x02\x16"
+
+    def test_from_bytes(self):
+        message = messages.MessageFactory.from_bytes(b"\x05\xFE\x01\xAA\xBB\x02\x16")
+        assert message == messages.Encapsulated(ctrl=1, wireless_node_id=b"\xAA\xBB", data=b"\x02\x16")
+        assert message.radius == 1
+
+    def test_parse_many(self):
+        frames = messages.parse_encapsulated(encapsulate(b"\x01", CONNECT) + encapsulate(b"\x02", b"\x02\x16"))
+        assert [frame.wireless_node_id for frame in frames] == [b"\x01", b"\x02"]
+        assert frames[0].data == CONNECT
+
+    def test_long_inner_message(self):
+        publish = messages.Publish(flags=messages.Flags(), topic_id=1, msg_id=b"\x00\x01", data=b"x" * 300)
+        frames = messages.parse_encapsulated(encapsulate(b"\x01", publish.to_bytes()) * 2)
+        assert len(frames) == 2
+        assert messages.Publish.from_bytes(frames[1].data) == publish
+
+    def test_truncated_datagram(self):
+        with pytest.raises(messages.ParsingError):
+            messages.parse_encapsulated(encapsulate(b"\x01", CONNECT)[:-1])
+
+
+class TestGatewayEncapsulated:
+    def test_nodes_have_their_own_sessions(self):
+        gw = build()
+        register = messages.Register(msg_id=b"\x00\x01", topic_name="a/b", topic_id=None).to_bytes()
+        connect_two = messages.Connect(flags=messages.Flags(clean_session=True), duration=60, client_id=b"C2")
+        response = gw.dispatch(
+            encapsulate(b"\x01", CONNECT) + encapsulate(b"\x02", connect_two.to_bytes())
+            + encapsulate(b"\x01", register) + encapsulate(b"\x03", register, ctrl=2),
+            FORWARDER,
+        )
+        assert [frame.wireless_node_id for frame in response.frames] == [b"\x01", b"\x02", b"\x01", b"\x03"]
+        assert response.frames[3].ctrl == 2
+        replies = [messages.MessageFactory.from_bytes(frame.data) for frame in response.frames]
+        assert replies[2].return_code == messages.ReturnCode.ACCEPTED
+        # Node 3 never connected, the forwarder having done so does not count.
+        assert isinstance(replies[3], messages.Disconnect)
+        assert gw.client_store.get_client(gateway.node_address(FORWARDER, b"\x02")) == b"C2"
+
+    def test_response_is_one_datagram(self):
+        gw = build()
+        data = encapsulate(b"\x01", CONNECT) + encapsulate(b"\x02", CONNECT)
+        frames = messages.parse_encapsulated(gw.dispatch(data, FORWARDER).to_bytes())
+        assert len(frames) == 2
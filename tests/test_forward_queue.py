@@ -0,0 +1,106 @@
+import threading
+
+from mqtt_sn_gateway import gateway, memory, messages
+from mqtt_sn_gateway.forward_queue import QueuedForwarder
+
+
+class BlockedForwarder(memory.MemoryForwarder):
+    """Blocks until released, like a slow broker"""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def forward_publishes(self, publishes):
+        self.release.wait()
+        super().forward_publishes(publishes)
+
+
+class FailingForwarder(memory.MemoryForwarder):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def forward_publishes(self, publishes):
+        with self.lock:
+            self.calls += 1
+        raise RuntimeError("Broker down")
+
+
+class TestQueuedForwarder:
+    def test_workers_forward_queued(self):
+        queue = QueuedForwarder(forwarder=memory.MemoryForwarder(), workers=2)
+        queue.start()
+        for n in range(50):
+            queue.forward_publish(b"a/b", b"1", qos=0)
+        queue.stop()
+        assert queue.forwarder.published == 50
+        assert queue.stats()["forwarded"] == 50
+
+    def test_errors_counted_from_many_workers(self):
+        forwarder = FailingForwarder()
+        queue = QueuedForwarder(forwarder=forwarder, workers=8)
+        queue.start()
+        for n in range(500):
+            queue.forward_publish(b"a/b", b"1", qos=0)
+        queue.stop()
+        assert queue.stats()["errors"] == forwarder.calls
+        assert queue.stats()["forwarded"] == 0
+
+    def test_drop_oldest(self):
+        queue = QueuedForwarder(forwarder=memory.MemoryForwarder(), max_size=2)
+        for payload in [b"1", b"2", b"3"]:
+            queue.forward_publish(b"a/b", payload, qos=0)
+        assert [payload for _, payload, _ in queue.queue] == [b"2", b"3"]
+        assert queue.dropped == 1
+
+    def test_drop_newest(self):
+        queue = QueuedForwarder(forwarder=memory.MemoryForwarder(), max_size=2, policy="drop_newest")
+        for payload in [b"1", b"2", b"3"]:
+            queue.forward_publish(b"a/b", payload, qos=0)
+        assert [payload for _, payload, _ in queue.queue] == [b"1", b"2"]
+
+    def test_does_not_wait_for_broker(self):
+        forwarder = BlockedForwarder()
+        queue = QueuedForwarder(forwarder=forwarder, workers=1)
+        queue.start()
+        queue.forward_publish(b"a/b", b"1", qos=0)
+        forwarder.release.set()
+        queue.stop()
+        assert forwarder.published == 1
+
+
+class TestQos0Publish:
+    def build(self, qos0_forwarder=None) -> gateway.MqttSnGateway:
+        gw = gateway.MqttSnGateway(
+            client_store=memory.MemoryClientStore(),
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+            qos0_forwarder=qos0_forwarder,
+        )
+        gw.client_store.add_client(b"C1", ("10.0.0.1", 1000))
+        gw.topic_store.add_topic_for_client(b"C1", "a/b")
+        return gw
+
+    def publish(self, qos: int, topic_id: int = 1) -> bytes:
+        return messages.Publish(
+            flags=messages.Flags(qos=qos), topic_id=topic_id, msg_id=b"\x00\x01", data=b"1"
+        ).to_bytes()
+
+    def test_no_puback_for_qos0(self):
+        gw = self.build()
+        assert gw.dispatch(self.publish(qos=0), ("10.0.0.1", 1000)) is None
+        assert gw.forwarder.published == 1
+
+    def test_errors_are_acknowledged_for_qos0(self):
+        gw = self.build()
+        assert gw.dispatch(self.publish(qos=0, topic_id=2), ("10.0.0.1", 1000)).return_code == messages.ReturnCode.INVALID_TOPIC
+
+    def test_qos0_goes_to_queue(self):
+        queue = QueuedForwarder(forwarder=memory.MemoryForwarder())
+        gw = self.build(qos0_forwarder=queue)
+        gw.dispatch(self.publish(qos=0), ("10.0.0.1", 1000))
+        assert gw.dispatch(self.publish(qos=1), ("10.0.0.1", 1000)).return_code == messages.ReturnCode.ACCEPTED
+        assert len(queue.queue) == 1
+        assert gw.forwarder.published == 1
@@ -0,0 +1,100 @@
+import pytest
+
+from mqtt_sn_gateway import client_store, gateway, memory, messages, topic_store
+
+
+class TestMemoryClientStore:
+    def test_add_and_get(self):
+        store = memory.MemoryClientStore(use_port_number=True)
+        store.add_client(b"client-1", remote_addr=("10.0.0.1", 1000))
+        assert store.get_client(("10.0.0.1", 1000)) == b"client-1"
+        with pytest.raises(client_store.ClientDoesNotExist):
+            store.get_client(("10.0.0.1", 1001))
+
+    def test_delete(self):
+        store = memory.MemoryClientStore()
+        store.add_client(b"client-1", remote_addr=("10.0.0.1", 1000))
+        store.delete_client(("10.0.0.1", 1000))
+        with pytest.raises(client_store.ClientDoesNotExist):
+            store.get_client(("10.0.0.1", 1000))
+
+
+class TestMemoryTopicStore:
+    def test_topic_ids_start_at_one(self):
+        store = memory.MemoryTopicStore()
+        assert store.add_topic_for_client(b"client-1", "a/b") == 1
+        assert store.add_topic_for_client(b"client-1", "a/c") == 2
+        assert store.get_topic_for_client(b"client-1", topic_id=2) == b"a/c"
+
+    def test_unknown_topic(self):
+        store = memory.MemoryTopicStore()
+        with pytest.raises(topic_store.TopicDoesNotExist):
+            store.get_topic_for_client(b"client-1", topic_id=1)
+
+
+class TestFaultProfile:
+    def test_from_spec(self):
+        profile = memory.FaultProfile.from_spec("latency=0.002, jitter=0.001,distribution=lognormal,seed=7")
+        assert profile.latency == 0.002
+        assert profile.distribution is memory.LatencyDistribution.LOGNORMAL
+
+    @pytest.mark.parametrize("spec", ["latency", "speed=1", "latency=fast", "distribution=pareto"])
+    def test_invalid_spec(self, spec):
+        with pytest.raises(memory.SimulationError):
+            memory.FaultProfile.from_spec(spec)
+
+    @pytest.mark.parametrize("distribution", ["uniform", "normal", "lognormal", "exponential"])
+    def test_latency_distribution(self, distribution):
+        profile = memory.FaultProfile(latency=0.01, jitter=0.002, distribution=distribution)
+        delays = [profile.delay() for _ in range(2000)]
+        assert min(delays) >= 0
+        assert sum(delays) / len(delays) == pytest.approx(0.01, rel=0.1)
+
+    def test_same_seed_same_delays(self):
+        delays = [
+            [memory.FaultProfile(latency=0.01, jitter=0.01, distribution="normal", seed=1).delay() for _ in range(5)]
+            for _ in range(2)
+        ]
+        assert delays[0] == delays[1]
+
+    def test_error_rate(self):
+        profile = memory.FaultProfile(error_rate=0.2)
+        for _ in range(1000):
+            try:
+                profile.call(ConnectionError)
+            except ConnectionError:
+                pass
+        assert 120 < profile.errors < 280
+
+    def test_outage_window(self):
+        profile = memory.FaultProfile(outage_every=10, outage_duration=2, started=0)
+        assert not profile.in_outage(7.9)
+        assert profile.in_outage(8.5)
+        assert not profile.in_outage(10.1)
+
+
+class TestSimulatedStores:
+    def test_store_errors_are_connection_errors(self):
+        profile = memory.FaultProfile(error_rate=1)
+        with pytest.raises(client_store.ConnectionError):
+            memory.SimulatedClientStore(profile=profile).get_client(("10.0.0.1", 1000))
+        with pytest.raises(topic_store.ConnectionError):
+            memory.SimulatedTopicStore(profile=profile).add_topic_for_client(b"C1", "a/b")
+
+    def test_gateway_answers_congestion_during_outage(self):
+        profile = memory.FaultProfile(outage_every=1000, outage_duration=1000)
+        gw = gateway.MqttSnGateway(
+            client_store=memory.SimulatedClientStore(profile=profile),
+            topic_store=memory.SimulatedTopicStore(profile=profile),
+            forwarder=memory.SimulatedForwarder(profile=memory.FaultProfile()),
+        )
+        connect = messages.Connect(flags=messages.Flags(), duration=60, client_id=b"C1")
+        response = gw.dispatch(connect.to_bytes(), ("10.0.0.1", 1000))
+        assert response.return_code == messages.ReturnCode.CONGESTION
+        assert profile.outage_errors == 1
+
+    def test_forwarder(self):
+        forwarder = memory.SimulatedForwarder(profile=memory.FaultProfile(latency=0.001))
+        forwarder.forward_publishes([(b"a/b", b"1", 1), (b"a/b", b"2", 1)])
+        assert forwarder.stats()["published"] == 2
+        assert forwarder.stats()["calls"] == 1
@@ -0,0 +1,24 @@
+import pytest
+
+from mqtt_sn_gateway import messages
+
+
+class TestParseHeader:
+    def test_short_length(self):
+        header = messages.parse_header(b"\x02\x18")
+        assert header == messages.Header(length=2, type=messages.MessageType.DISCONNECT)
+
+    def test_long_length(self):
+        data = b"\x01\x01\x09\x0c" + b"\x00" * 261
+        assert messages.parse_header(data).length == 265
+
+    @pytest.mark.parametrize("data", [b"", b"\x02", b"\x03\x18", b"\x02\xff", b"\x01\x00"])
+    def test_malformed(self, data):
+        with pytest.raises(messages.ParsingError):
+            messages.parse_header(data)
+
+
+class TestMessageFactory:
+    def test_unsupported_type(self):
+        with pytest.raises(messages.ParsingError):
+            messages.MessageFactory.from_bytes(b"\x02\x06")
@@ -0,0 +1,252 @@
+import pytest
+
+from mqtt_sn_gateway import client_store, gateway, memory, messages, nearcache, topic_store
+from mqtt_sn_gateway.nearcache import InvalidationListener, InvalidationSource, NearCache, invalidation_source
+
+
+class FakeValkey:
+    def __init__(self):
+        self.data = {}
+        self.gets = 0
+
+    def get(self, name):
+        self.gets += 1
+        return self.data.get(name)
+
+    def set(self, name, value, ex=None):
+        self.data[name] = value
+
+    def mget(self, keys):
+        self.gets += len(keys)
+        return [self.data.get(key) for key in keys]
+
+    def rpush(self, name, value):
+        self.data.setdefault(name, []).append(value.encode())
+        return len(self.data[name])
+
+    def lindex(self, name, index):
+        self.gets += 1
+        values = self.data.get(name, [])
+        return values[index] if index < len(values) else None
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, vk):
+        self.vk = vk
+        self.calls = []
+
+    def lindex(self, name, index):
+        self.calls.append((name, index))
+
+    def execute(self):
+        return [self.vk.lindex(name, index) for name, index in self.calls]
+
+
+def connected_cache(**kwargs) -> NearCache:
+    cache = NearCache(**kwargs)
+    cache.set_connected(True)
+    return cache
+
+
+class TestNearCache:
+    def test_hit_after_load(self):
+        cache = connected_cache()
+        assert cache.read_through("client:a", "GET", lambda: b"C1") == b"C1"
+        assert cache.read_through("client:a", "GET", lambda: b"other") == b"C1"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_bypassed_when_not_connected(self):
+        cache = NearCache()
+        cache.read_through("client:a", "GET", lambda: b"C1")
+        assert cache.read_through("client:a", "GET", lambda: b"C2") == b"C2"
+        assert cache.bypassed == 2
+
+    def test_invalidate_evicts(self):
+        cache = connected_cache()
+        cache.read_through("client:a", "GET", lambda: b"C1")
+        cache.invalidate("client:a")
+        assert cache.read_through("client:a", "GET", lambda: b"C2") == b"C2"
+
+    def test_invalidation_during_load_is_not_cached(self):
+        cache = connected_cache()
+
+        def load():
+            cache.invalidate("client:a")
+            return b"stale"
+
+        cache.read_through("client:a", "GET", load)
+        assert cache.read_through("client:a", "GET", lambda: b"fresh") == b"fresh"
+
+    def test_none_is_not_cached(self):
+        cache = connected_cache()
+        cache.read_through("client:a", "GET", lambda: None)
+        assert cache.read_through("client:a", "GET", lambda: b"C1") == b"C1"
+
+    def test_lag_measured_for_own_writes(self):
+        cache = connected_cache()
+        cache.written("client:a")
+        cache.invalidate("client:a")
+        assert cache.stats()["invalidation_lag_ms"]["count"] == 1
+
+    def test_max_size(self):
+        cache = connected_cache(max_size=2)
+        for key in ["a", "b", "c"]:
+            cache.read_through(key, "GET", lambda: b"1")
+        assert list(cache.entries) == ["b", "c"]
+
+
+class FakeConnection:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = []
+        self.disconnected = False
+
+    def send_command(self, *args):
+        self.sent.append(args)
+
+    def read_response(self):
+        return self.responses.pop(0)
+
+    def can_read(self, timeout=0):
+        return bool(self.responses)
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+        self.released = []
+
+    def get_connection(self, command_name):
+        return self.connection
+
+    def release(self, connection):
+        self.released.append(connection)
+
+
+class FakeTrackingClient:
+    def __init__(self, subscriber, listener):
+        self.connection_pool = FakePool(subscriber)
+        self.listener = listener
+        self.commands = []
+
+    def execute_command(self, *args):
+        self.commands.append(args)
+
+    def ping(self):
+        # Nothing left to read, end the listener.
+        self.listener.stop_event.set()
+
+    def close(self):
+        pass
+
+
+class TestInvalidationListener:
+    def test_tracking_redirects_to_subscriber(self, monkeypatch):
+        cache = NearCache()
+        listener = InvalidationListener(url="valkey://localhost", cache=cache, prefixes=["topic:"])
+        subscriber = FakeConnection(
+            [7, [b"subscribe", b"__redis__:invalidate", 1], [b"message", b"__redis__:invalidate", [b"topic:C1"]]]
+        )
+        client = FakeTrackingClient(subscriber, listener)
+        monkeypatch.setattr(nearcache.valkey.Valkey, "from_url", lambda url, **kwargs: client)
+        cache.set_connected(True)
+        cache.read_through("topic:C1", ("LINDEX", 0), lambda: b"a/b")
+        listener.listen_tracking()
+        assert subscriber.sent == [("CLIENT", "ID"), ("SUBSCRIBE", "__redis__:invalidate")]
+        assert client.commands == [("CLIENT", "TRACKING", "ON", "REDIRECT", 7, "BCAST", "PREFIX", "topic:")]
+        assert "topic:C1" not in cache.entries
+        assert subscriber.disconnected and client.connection_pool.released == [subscriber]
+
+    def test_tracking_invalidation(self):
+        cache = connected_cache()
+        cache.read_through("topic:C1", ("LINDEX", 0), lambda: b"a/b")
+        listener = InvalidationListener(url="valkey://localhost", cache=cache)
+        listener.handle_tracking([b"message", b"__redis__:invalidate", [b"topic:C1"]])
+        assert "topic:C1" not in cache.entries
+
+    def test_tracking_flush(self):
+        cache = connected_cache()
+        cache.read_through("topic:C1", ("LINDEX", 0), lambda: b"a/b")
+        listener = InvalidationListener(url="valkey://localhost", cache=cache)
+        listener.handle_tracking([b"message", b"__redis__:invalidate", None])
+        assert not cache.entries
+
+    def test_tracking_ignores_subscribe_confirmation(self):
+        cache = connected_cache()
+        cache.read_through("topic:C1", ("LINDEX", 0), lambda: b"a/b")
+        listener = InvalidationListener(url="valkey://localhost", cache=cache)
+        listener.handle_tracking([b"subscribe", b"__redis__:invalidate", 1])
+        assert "topic:C1" in cache.entries
+
+    @pytest.mark.parametrize(
+        "source, extend_ttl, expected",
+        [
+            ("tracking", True, InvalidationSource.KEYSPACE),
+            ("tracking", False, InvalidationSource.TRACKING),
+            ("keyspace", True, InvalidationSource.KEYSPACE),
+        ],
+    )
+    def test_tracking_not_used_when_ttls_are_extended(self, source, extend_ttl, expected):
+        assert invalidation_source(source, extend_ttl) is expected
+
+    def test_keyspace_ignores_expire(self):
+        cache = connected_cache()
+        cache.read_through("client:10.0.0.1:1000", "GET", lambda: b"C1")
+        listener = InvalidationListener(url="valkey://localhost", cache=cache, source="keyspace")
+        listener.handle_keyspace({"channel": b"__keyspace@0__:client:10.0.0.1:1000", "data": b"expire"})
+        assert "client:10.0.0.1:1000" in cache.entries
+        listener.handle_keyspace({"channel": b"__keyspace@0__:client:10.0.0.1:1000", "data": b"set"})
+        assert "client:10.0.0.1:1000" not in cache.entries
+
+
+class TestClientStoreWithNearCache:
+    def test_lookups_are_cached_and_own_writes_evict(self):
+        vk = FakeValkey()
+        store = client_store.ValKeyClientStore(valkey=vk, use_port_number=True, near_cache=connected_cache())
+        store.add_client(b"C1", ("10.0.0.1", 1000))
+        assert store.get_client(("10.0.0.1", 1000)) == b"C1"
+        assert store.get_client(("10.0.0.1", 1000)) == b"C1"
+        assert vk.gets == 1
+        store.add_client(b"C2", ("10.0.0.1", 1000))
+        assert store.get_client(("10.0.0.1", 1000)) == b"C2"
+
+
+class TestBulkReadsWithNearCache:
+    def test_only_misses_are_read(self):
+        vk = FakeValkey()
+        store = client_store.ValKeyClientStore(valkey=vk, use_port_number=True, near_cache=connected_cache())
+        store.add_client(b"C1", ("10.0.0.1", 1000))
+        store.add_client(b"C2", ("10.0.0.1", 1001))
+        store.get_client(("10.0.0.1", 1000))
+        vk.gets = 0
+        assert store.get_clients([("10.0.0.1", 1000), ("10.0.0.1", 1001), ("10.0.0.1", 1002)]) == [b"C1", b"C2", None]
+        assert vk.gets == 2
+        assert store.get_clients([("10.0.0.1", 1000), ("10.0.0.1", 1001)]) == [b"C1", b"C2"]
+        assert vk.gets == 2
+
+    def test_batch_against_warm_cache(self):
+        vk = FakeValkey()
+        cache = connected_cache()
+        clients = client_store.ValKeyClientStore(valkey=vk, use_port_number=True, near_cache=cache)
+        topics = topic_store.ValKeyTopicStore(valkey=vk, near_cache=cache)
+        gw = gateway.MqttSnGateway(client_store=clients, topic_store=topics, forwarder=memory.MemoryForwarder(),
+                                   extend_store_ttl_on_publish=False)
+        datagrams = []
+        for port in range(1000, 1005):
+            client_id = f"C{port}".encode()
+            clients.add_client(client_id, ("10.0.0.1", port))
+            topics.add_topic_for_client(client_id, "a/b")
+            publish = messages.Publish(flags=messages.Flags(qos=1), topic_id=1, msg_id=b"\x00\x01", data=b"1")
+            datagrams.append((publish.to_bytes(), ("10.0.0.1", port)))
+        gw.dispatch_batch(datagrams)
+        vk.gets = 0
+        responses = gw.dispatch_batch(datagrams)
+        assert [response.return_code for response in responses] == [messages.ReturnCode.ACCEPTED] * 5
+        assert vk.gets == 0
+        assert gw.forwarder.published == 10
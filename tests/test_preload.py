@@ -0,0 +1,117 @@
+from mqtt_sn_gateway import client_store
+from mqtt_sn_gateway.nearcache import NearCache
+from mqtt_sn_gateway.preload import Preloader
+
+
+class FakePipeline:
+    def __init__(self, valkey):
+        self.valkey = valkey
+        self.commands = []
+
+    def ttl(self, key):
+        self.commands.append(lambda: self.valkey.ttls.get(key, -2))
+
+    def get(self, key):
+        self.commands.append(lambda: self.valkey.data.get(key))
+
+    def lrange(self, key, start, end):
+        self.commands.append(lambda: self.valkey.data.get(key))
+
+    def execute(self):
+        self.valkey.before_execute()
+        return [command() for command in self.commands]
+
+
+class FakeValkey:
+    """Returns one key per SCAN call."""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.before_execute = lambda: None
+
+    def set(self, key, value, ttl=client_store.CLIENT_TTL):
+        self.data[key] = value
+        self.ttls[key] = ttl
+
+    def scan(self, cursor, match, count):
+        keys = sorted(key for key in self.data if key.startswith(match[:-1]))
+        if cursor >= len(keys):
+            return 0, []
+        return (cursor + 1) % len(keys), [keys[cursor].encode()]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+def connected_cache(**kwargs) -> NearCache:
+    cache = NearCache(**kwargs)
+    cache.set_connected(True)
+    return cache
+
+
+class TestPreloader:
+    def test_loads_clients_and_topics(self):
+        valkey = FakeValkey()
+        valkey.set("client:10.0.0.1:1000", b"C1")
+        valkey.set("topic:C1", [b"a/b", b"c/d"])
+        cache = connected_cache()
+        preloader = Preloader(valkey=valkey, cache=cache, rate=0)
+        preloader.preload()
+        assert cache.read_through("client:10.0.0.1:1000", "GET", lambda: None) == b"C1"
+        assert cache.read_through("topic:C1", ("LINDEX", 1), lambda: None) == b"c/d"
+        assert cache.misses == 0
+        assert preloader.stats()["loaded"] == 2
+
+    def test_skips_idle_keys(self):
+        valkey = FakeValkey()
+        valkey.set("client:a", b"C1", ttl=client_store.CLIENT_TTL - 10)
+        valkey.set("client:b", b"C2", ttl=client_store.CLIENT_TTL - 100)
+        cache = connected_cache()
+        preloader = Preloader(valkey=valkey, cache=cache, rate=0, active_window=50)
+        preloader.preload()
+        assert list(cache.entries) == ["client:a"]
+        assert preloader.skipped == 1
+
+    def test_bounded_by_max_keys_and_cache_size(self):
+        valkey = FakeValkey()
+        for index in range(5):
+            valkey.set(f"client:{index}", b"C")
+        cache = connected_cache(max_size=10)
+        Preloader(valkey=valkey, cache=cache, rate=0, max_keys=2).preload()
+        assert len(cache.entries) == 2
+        cache = connected_cache(max_size=3)
+        Preloader(valkey=valkey, cache=cache, rate=0).preload()
+        assert len(cache.entries) == 3
+
+    def test_does_not_replace_cached_entries(self):
+        valkey = FakeValkey()
+        valkey.set("client:a", b"old")
+        cache = connected_cache()
+        cache.read_through("client:a", "GET", lambda: b"new")
+        Preloader(valkey=valkey, cache=cache, rate=0).preload()
+        assert cache.read_through("client:a", "GET", lambda: None) == b"new"
+
+    def test_invalidation_during_preload_is_not_cached(self):
+        valkey = FakeValkey()
+        valkey.set("client:a", b"stale")
+        cache = connected_cache()
+        valkey.before_execute = lambda: cache.invalidate("client:a")
+        Preloader(valkey=valkey, cache=cache, rate=0).preload()
+        assert "client:a" not in cache.entries
+
+    def test_not_loaded_when_not_connected(self):
+        valkey = FakeValkey()
+        valkey.set("client:a", b"C1")
+        cache = NearCache()
+        Preloader(valkey=valkey, cache=cache, rate=0).preload()
+        assert len(cache.entries) == 0
+
+    def test_rate_limited(self):
+        valkey = FakeValkey()
+        for index in range(3):
+            valkey.set(f"client:{index}", b"C")
+        preloader = Preloader(valkey=valkey, cache=connected_cache(), rate=100)
+        preloader.preload()
+        # 3 keys at 100 keys per second.
+        assert preloader.stats()["seconds"] >= 0.03
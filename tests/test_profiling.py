@@ -0,0 +1,119 @@
+import json
+import pstats
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mqtt_sn_gateway import admin, gateway, memory, messages, metrics, profiling
+
+
+class TestStageTimings:
+    def test_record(self):
+        timings = profiling.StageTimings()
+        timings.record("parse", 0.001)
+        timings.record("parse", 0.003)
+        stage = timings.snapshot()["stages"]["parse"]
+        assert stage["count"] == 2
+        assert stage["total_ms"] == 4.0
+        assert stage["max_ms"] == 3.0
+
+    def test_dispatch_records_stages_when_enabled(self):
+        gw = gateway.MqttSnGateway(
+            client_store=memory.MemoryClientStore(),
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+        )
+        connect = messages.Connect(flags=messages.Flags(clean_session=True), duration=60, client_id=b"client-1")
+        gw.dispatch(connect.to_bytes(), ("10.0.0.1", 1000))
+        assert profiling.stage_timings is None
+
+        profiling.enable_stage_timings()
+        try:
+            gw.dispatch(connect.to_bytes(), ("10.0.0.1", 1000))
+        finally:
+            snapshot = profiling.disable_stage_timings()
+        assert set(snapshot["stages"]) == {"dispatch.parse", "dispatch.CONNECT"}
+
+
+class TestSamplingProfiler:
+    def test_sample_collects_stacks_of_other_threads(self):
+        stop = threading.Event()
+
+        def busy_worker():
+            while not stop.is_set():
+                time.sleep(0.001)
+
+        thread = threading.Thread(target=busy_worker)
+        thread.start()
+        try:
+            samples = profiling.SamplingProfiler(interval=0.001).sample(0.05)
+        finally:
+            stop.set()
+            thread.join()
+        assert any("busy_worker" in stack for stack in samples)
+
+
+class TestStartupProfile:
+    def test_phases(self):
+        startup = profiling.StartupProfile()
+        time.sleep(0.01)
+        startup.mark("imports")
+        startup.mark("bind")
+        assert list(startup.phases) == ["imports", "bind"]
+        assert startup.phases["imports"] >= 10
+        assert startup.total_ms() == pytest.approx(sum(startup.phases.values()), abs=0.01)
+
+    def test_write_profile(self, tmp_path):
+        startup = profiling.StartupProfile()
+        startup.start_profiler()
+        startup.mark("imports")
+        path = startup.write(str(tmp_path))
+        assert pstats.Stats(path).total_calls > 0
+
+
+class TestReady:
+    def test_not_ready_until_set(self):
+        ready = threading.Event()
+        server = admin.AdminServer(
+            ("127.0.0.1", 0),
+            metrics=metrics.MetricsRegistry(),
+            profiler=profiling.SamplingProfiler(),
+            profile_dir=".",
+            profile_seconds=1,
+            ready=ready,
+        )
+        server.start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/ready"
+        try:
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(url)
+            assert error.value.code == 503
+            ready.set()
+            assert json.load(urllib.request.urlopen(url)) == {"ready": True}
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+@pytest.mark.parametrize("seconds", ["-1", "0", "nan", "inf", "601", "ten"])
+def test_profile_seconds_out_of_range(seconds):
+    profiler = profiling.SamplingProfiler()
+    server = admin.AdminServer(
+        ("127.0.0.1", 0),
+        metrics=metrics.MetricsRegistry(),
+        profiler=profiler,
+        profile_dir=".",
+        profile_seconds=1,
+    )
+    server.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/profile?seconds={seconds}"
+    try:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(urllib.request.Request(url, method="POST"))
+        assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -12,3 +12,15 @@ class TestPublish:
         assert msg.topic_id == 1
         assert msg.flags == messages.Flags(dup=True, qos=1)
         assert msg.msg_id == b"\xc7\x92"
+
+    def test_to_bytes(self):
+        data = b'\x0c\x0c\x20\x00\x01\xc7\x92hello'
+        msg = messages.Publish(flags=messages.Flags(qos=1), topic_id=1, msg_id=b"\xc7\x92", data=b"hello")
+        assert msg.to_bytes() == data
+
+    def test_long_length_roundtrip(self):
+        msg = messages.Publish(flags=messages.Flags(qos=1), topic_id=1, msg_id=b"\xc7\x92", data=b"x" * 300)
+        data = msg.to_bytes()
+        assert data[:3] == b"\x01" + (309).to_bytes(2, "big")
+        assert msg.length == len(data)
+        assert messages.Publish.from_bytes(data) == msg
@@ -0,0 +1,53 @@
+from mqtt_sn_gateway import gateway, memory, messages, ratelimit
+
+
+class TestTokenBucketLimiter:
+    def test_burst_then_refill(self):
+        limiter = ratelimit.TokenBucketLimiter(rate=1.0, burst=2.0)
+        assert limiter.allow("a", now=0.0)
+        assert limiter.allow("a", now=0.0)
+        assert not limiter.allow("a", now=0.0)
+        assert limiter.allow("a", now=1.0)
+        assert limiter.top_offenders() == [("a", 1)]
+
+    def test_idle_buckets_expire(self):
+        limiter = ratelimit.TokenBucketLimiter(rate=1.0, burst=2.0)
+        limiter.allow("a", now=0.0)
+        limiter.allow("b", now=1.0)
+        limiter.allow("c", now=2.5)
+        assert list(limiter.buckets) == ["b", "c"]
+
+    def test_max_buckets(self):
+        limiter = ratelimit.TokenBucketLimiter(rate=1.0, burst=2.0, max_buckets=2)
+        for key in ["a", "b", "c"]:
+            limiter.allow(key, now=0.0)
+        assert list(limiter.buckets) == ["b", "c"]
+
+
+class TestRateLimiter:
+    def test_subnet(self):
+        limiter = ratelimit.RateLimiter(limiter=ratelimit.TokenBucketLimiter(rate=1, burst=1), key_type="subnet")
+        assert limiter.subnet("10.1.2.3") == "10.1.2.0/24"
+        assert limiter.subnet("2001:db8::1") == "2001:db8::/64"
+
+    def make_gateway(self, action: str) -> gateway.MqttSnGateway:
+        return gateway.MqttSnGateway(
+            client_store=memory.MemoryClientStore(),
+            topic_store=memory.MemoryTopicStore(),
+            forwarder=memory.MemoryForwarder(),
+            rate_limiter=ratelimit.RateLimiter(
+                limiter=ratelimit.TokenBucketLimiter(rate=0.001, burst=1), action=action
+            ),
+        )
+
+    def test_congestion_when_over_limit(self):
+        gw = self.make_gateway("congestion")
+        connect = messages.Connect(flags=messages.Flags(), duration=60, client_id=b"client-1").to_bytes()
+        assert gw.dispatch(connect, ("10.0.0.1", 1000)).return_code == messages.ReturnCode.ACCEPTED
+        assert gw.dispatch(connect, ("10.0.0.1", 1000)).return_code == messages.ReturnCode.CONGESTION
+
+    def test_drop_when_over_limit(self):
+        gw = self.make_gateway("drop")
+        connect = messages.Connect(flags=messages.Flags(), duration=60, client_id=b"client-1").to_bytes()
+        gw.dispatch(connect, ("10.0.0.1", 1000))
+        assert gw.dispatch(connect, ("10.0.0.1", 1000)) is None
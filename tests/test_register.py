@@ -12,3 +12,7 @@ class TestRegister:
         assert msg.msg_id == b"\xff\xcb"
         assert msg.topic_name == "mr/94193A04010020B8/standard/json"
 
+    def test_to_bytes(self):
+        data = b"'\n\x00\x00\xff\xcbmr/94193A04010020B8/standard/json"
+        msg = messages.Register(msg_id=b"\xff\xcb", topic_name="mr/94193A04010020B8/standard/json", topic_id=None)
+        assert msg.to_bytes() == data
@@ -0,0 +1,90 @@
+from valkey.exceptions import ConnectionError
+
+from mqtt_sn_gateway.replicas import Replica, ReplicaRouter, ReplicaSelection
+
+
+class FakeValkey:
+    """Holds keys in a dict and counts reads"""
+
+    def __init__(self, data=None, fail=False):
+        self.data = data or {}
+        self.fail = fail
+        self.reads = 0
+
+    def get(self, name):
+        self.reads += 1
+        if self.fail:
+            raise ConnectionError("down")
+        return self.data.get(name)
+
+
+def get(key):
+    return lambda vk: vk.get(name=key)
+
+
+def router(primary, *replicas, **kwargs):
+    return ReplicaRouter(
+        primary=primary, replicas=[Replica(name=f"r{i}", valkey=r) for i, r in enumerate(replicas)], **kwargs
+    )
+
+
+class TestReplicaRouter:
+    def test_reads_go_to_replicas_round_robin(self):
+        primary = FakeValkey({"a": b"1"})
+        first, second = FakeValkey({"a": b"1"}), FakeValkey({"a": b"1"})
+        r = router(primary, first, second)
+        for _ in range(4):
+            assert r.read("a", get("a")) == b"1"
+        assert (primary.reads, first.reads, second.reads) == (0, 2, 2)
+
+    def test_recently_written_key_is_read_from_primary(self):
+        primary = FakeValkey({"a": b"1"})
+        replica = FakeValkey()
+        r = router(primary, replica)
+        r.written("a")
+        assert r.read("a", get("a")) == b"1"
+        assert replica.reads == 0
+
+    def test_written_window_expires(self):
+        primary = FakeValkey({"a": b"1"})
+        replica = FakeValkey({"a": b"1"})
+        r = router(primary, replica, read_your_writes_window=-1)
+        r.written("a")
+        assert r.read("a", get("a")) == b"1"
+        assert replica.reads == 1
+
+    def test_miss_on_replica_falls_back_to_primary(self):
+        primary = FakeValkey({"a": b"1"})
+        r = router(primary, FakeValkey())
+        assert r.read("a", get("a")) == b"1"
+        assert r.primary_fallbacks == 1
+
+    def test_failing_replica_is_skipped(self):
+        primary = FakeValkey({"a": b"1"})
+        broken = FakeValkey(fail=True)
+        r = router(primary, broken)
+        assert r.read("a", get("a")) == b"1"
+        assert r.read("a", get("a")) == b"1"
+        assert broken.reads == 1
+        assert r.stats()["replicas"]["r0"]["down"]
+
+    def test_latency_selection_prefers_fastest(self):
+        primary = FakeValkey()
+        slow, fast = FakeValkey({"a": b"1"}), FakeValkey({"a": b"1"})
+        r = router(primary, slow, fast, selection="latency")
+        r.replicas[0].latency = 0.010
+        r.replicas[1].latency = 0.001
+        assert r.selection is ReplicaSelection.LATENCY
+        picks = [r.choose() for _ in range(200)]
+        assert picks.count(r.replicas[1]) > 150
+
+    def test_read_many_falls_back_for_written_and_missing_keys(self):
+        primary = FakeValkey({"a": b"1", "b": b"2", "c": b"3"})
+        replica = FakeValkey({"a": b"1"})
+        r = router(primary, replica)
+        r.written("b")
+        keys = ["a", "b", "c"]
+        values = r.read_many(keys, lambda vk, indexes: [vk.get(name=keys[i]) for i in indexes])
+        assert values == [b"1", b"2", b"3"]
+        assert replica.reads == 2
+        assert primary.reads == 2
@@ -0,0 +1,92 @@
+import pytest
+from kombu import Connection, Exchange, Queue
+import structlog.testing
+
+from mqtt_sn_gateway.forward import AmqpForwarder, ShardedAmqpForwarder
+from mqtt_sn_gateway.routing import DeliveryMode, RoutingError, RoutingTable, parse_rule
+
+DEFAULT = Exchange("mqtt-sn", type="topic")
+
+
+def build(*rules: str) -> RoutingTable:
+    return RoutingTable.from_rules(list(rules), default_exchange=DEFAULT)
+
+
+class TestParseRule:
+    def test_full_rule(self):
+        topic_filter, route = parse_rule("mr/+/alarm/#=alarms:persistent:9", {})
+        assert topic_filter == "mr/+/alarm/#"
+        assert route.exchange.name == "alarms"
+        assert route.properties == {"delivery_mode": DeliveryMode.PERSISTENT, "priority": 9}
+
+    def test_exchange_only(self):
+        _, route = parse_rule("mr/#=metering", {})
+        assert route.properties == {}
+
+    @pytest.mark.parametrize(
+        "rule", ["mr/#", "mr/#/a=x", "mr/#=", "mr/#=x:durable", "mr/#=x:transient:high", "mr/#=x:transient:300"]
+    )
+    def test_invalid(self, rule):
+        with pytest.raises(RoutingError):
+            parse_rule(rule, {})
+
+
+class TestRoutingTable:
+    def test_first_matching_rule_wins(self):
+        table = build("mr/+/alarm=alarms:persistent:9", "mr/#=metering:transient")
+        assert table.route(b"mr/1/alarm").exchange.name == "alarms"
+        assert table.route(b"mr/1/standard").exchange.name == "metering"
+        assert table.route(b"other") is table.default
+
+    def test_same_exchange_shared(self):
+        table = build("a=x", "b=x:persistent")
+        assert table.route(b"a").exchange is table.route(b"b").exchange
+
+    def test_cached(self):
+        table = RoutingTable.from_rules(["mr/#=metering"], default_exchange=DEFAULT, cache_size=2)
+        table.route(b"mr/1")
+        table.route(b"mr/1")
+        assert (table.hits, table.misses) == (1, 1)
+        table.route(b"mr/2")
+        table.route(b"mr/3")
+        assert len(table.cache) == 1
+
+
+def test_forwarder_publishes_on_routed_exchange():
+    alarms = Exchange("alarms", type="topic")
+    with Connection("memory://") as connection:
+        queue = Queue("alarms-test", exchange=alarms, routing_key="#")(connection.channel())
+        queue.declare()
+        forwarder = AmqpForwarder(
+            exchange=DEFAULT, connection=connection, routes=build("mr/+/alarm=alarms:transient:5")
+        )
+        forwarder.forward_publish(topic=b"mr/1/alarm", payload=b"1", qos=1)
+        forwarder.forward_publish(topic=b"mr/1/standard", payload=b"2", qos=1)
+        message = queue.get()
+        assert message.body == b"1"
+        assert message.properties["delivery_mode"] == 1
+        assert message.properties["priority"] == 5
+        assert queue.get() is None
+
+
+def test_sharded_forwarder_routes():
+    forwarder = ShardedAmqpForwarder.from_urls(
+        ["memory://"], exchange=DEFAULT, connections_per_url=2, routes=build("mr/+/alarm=alarms:persistent")
+    )
+    forwarder.forward_publishes([(b"mr/1/alarm", b"1", 1), (b"mr/1/standard", b"2", 1)])
+    assert sum(shard.published for shard in forwarder.shards) == 2
+
+
+def test_forwarder_logs_routed_exchanges_for_batch():
+    alarms = Exchange("alarms", type="topic")
+    with Connection("memory://") as connection:
+        queue = Queue("alarms-batch-test", exchange=alarms, routing_key="#")(connection.channel())
+        queue.declare()
+        forwarder = AmqpForwarder(
+            exchange=DEFAULT, connection=connection, routes=build("mr/+/alarm=alarms:transient:5")
+        )
+        with structlog.testing.capture_logs() as logs:
+            forwarder.forward_publishes([(b"mr/1/alarm", b"1", 1), (b"mr/1/standard", b"2", 1)])
+        batch_log = next(log for log in logs if log["event"] == "Forwarding batch to AMQP")
+        assert batch_log["exchanges"] == ["alarms", DEFAULT.name]
+        assert queue.get().body == b"1"
@@ -0,0 +1,86 @@
+import threading
+from typing import *
+
+import structlog
+
+from mqtt_sn_gateway import sentry
+from mqtt_sn_gateway.ratelimit import TokenBucketLimiter
+
+
+def raise_error(message: str = "error") -> Exception:
+    try:
+        raise ConnectionError(message)
+    except ConnectionError as e:
+        return e
+
+
+def build_reporter(**kwargs) -> Tuple[sentry.ErrorReporter, list]:
+    sent = []
+    kwargs.setdefault("limiter", TokenBucketLimiter(rate=0.001, burst=1))
+    return sentry.ErrorReporter(send=lambda *event: sent.append(event), **kwargs), sent
+
+
+class TestFingerprint:
+    def test_same_line_same_fingerprint(self):
+        assert sentry.fingerprint(raise_error("a")) == sentry.fingerprint(raise_error("b"))
+        assert sentry.fingerprint(raise_error()).startswith("builtins.ConnectionError@")
+
+    def test_different_type(self):
+        assert sentry.fingerprint(raise_error()) != sentry.fingerprint(ValueError())
+
+
+class TestErrorReporter:
+    def test_rate_limited_per_fingerprint_with_occurrences(self):
+        reporter, sent = build_reporter()
+        for _ in range(5):
+            reporter.report(raise_error())
+        reporter.report(ValueError())
+        reporter.start()
+        reporter.stop()
+        assert [(type(error), occurrences) for error, _, occurrences, _ in sent] == [
+            (ConnectionError, 1),
+            (ValueError, 1),
+        ]
+        assert reporter.occurrences[sentry.fingerprint(raise_error())] == 4
+        assert reporter.stats()["rate_limited"] == 4
+
+    def test_full_queue_drops_without_blocking(self):
+        reporter, _ = build_reporter(limiter=TokenBucketLimiter(rate=1000, burst=10), queue_size=2)
+        for _ in range(5):
+            reporter.report(raise_error())
+        assert reporter.dropped == 3
+
+    def test_sent_from_background_thread_with_log_context(self):
+        sent = threading.Event()
+        threads = []
+
+        def send(error, key, occurrences, context):
+            threads.append((threading.current_thread(), context))
+            sent.set()
+
+        reporter = sentry.ErrorReporter(limiter=TokenBucketLimiter(rate=1, burst=1), send=send)
+        reporter.start()
+        structlog.contextvars.bind_contextvars(remote_ip="10.0.0.1")
+        try:
+            reporter.report(raise_error())
+        finally:
+            structlog.contextvars.clear_contextvars()
+        assert sent.wait(2)
+        reporter.stop()
+        assert threads[0][0] is reporter.thread
+        assert threads[0][1]["remote_ip"] == "10.0.0.1"
+
+    def test_failing_send_is_counted(self):
+        def send(*event):
+            raise OSError("unreachable")
+
+        reporter = sentry.ErrorReporter(limiter=TokenBucketLimiter(rate=1, burst=1), send=send)
+        reporter.report(raise_error())
+        reporter.start()
+        reporter.stop()
+        assert reporter.failed == 1
+
+
+def test_capture_does_nothing_without_init():
+    assert sentry.reporter is None
+    sentry.capture_exception(raise_error())
@@ -0,0 +1,72 @@
+from kombu import Exchange
+
+from mqtt_sn_gateway import profiling
+from mqtt_sn_gateway.forward import ShardedAmqpForwarder
+
+
+class FailingProducer:
+    def publish(self, *args, **kwargs):
+        raise ConnectionError("Broker down")
+
+
+class FailAfterProducer:
+    def __init__(self, sent: int):
+        self.sent = sent
+
+    def publish(self, *args, **kwargs):
+        if self.sent == 0:
+            raise ConnectionError("Broker down")
+        self.sent -= 1
+
+
+def build(shards: int = 4) -> ShardedAmqpForwarder:
+    return ShardedAmqpForwarder.from_urls(
+        ["memory://"], exchange=Exchange("mqtt-sn", type="topic"), connections_per_url=shards
+    )
+
+
+class TestShardedAmqpForwarder:
+    def test_same_topic_same_shard(self):
+        forwarder = build()
+        for _ in range(5):
+            forwarder.forward_publish(topic=b"mr/1/standard/json", payload=b"1", qos=1)
+        index = forwarder.shard_index("mr.1.standard.json")
+        assert forwarder.shards[index].published == 5
+        assert sum(shard.published for shard in forwarder.shards) == 5
+
+    def test_topics_spread_over_shards(self):
+        forwarder = build()
+        forwarder.forward_publishes([(f"mr/{n}/standard/json".encode(), b"1", 1) for n in range(100)])
+        assert all(shard.published > 0 for shard in forwarder.shards)
+
+    def test_failover_to_next_shard(self):
+        forwarder = build(shards=2)
+        index = forwarder.shard_index("a.b")
+        failing = forwarder.shards[index]
+        failing.producer = FailingProducer()
+        forwarder.forward_publish(topic=b"a/b", payload=b"1", qos=1)
+        other = forwarder.shards[(index + 1) % 2]
+        assert other.published == 1
+        assert other.failovers_in == 1
+        assert failing.errors == 1
+        assert failing.stats()["down"]
+        # Skipped while down.
+        forwarder.forward_publish(topic=b"a/b", payload=b"2", qos=1)
+        assert failing.errors == 1
+        assert other.published == 2
+
+    def test_failover_only_resends_unsent(self):
+        forwarder = build(shards=2)
+        index = forwarder.shard_index("a.b")
+        failing = forwarder.shards[index]
+        failing.producer = FailAfterProducer(sent=2)
+        forwarder.forward_publishes([(b"a/b", str(n).encode(), 1) for n in range(5)])
+        assert failing.producer is None
+        assert failing.published == 2
+        assert forwarder.shards[(index + 1) % 2].published == 3
+
+    def test_stage_timings(self, monkeypatch):
+        timings = profiling.StageTimings()
+        monkeypatch.setattr(profiling, "stage_timings", timings)
+        build().forward_publish(topic=b"a/b", payload=b"1", qos=1)
+        assert {"forward.acquire", "forward.publish"} <= set(timings.snapshot()["stages"])
@@ -0,0 +1,138 @@
+import time
+
+import pytest
+
+from mqtt_sn_gateway.subscriptions import Subscription, SubscriptionIndex, TopicTrie, is_valid_filter
+
+
+class TestTopicTrie:
+    @pytest.mark.parametrize(
+        "topic_filter, topic, matches",
+        [
+            ("a/b/c", "a/b/c", True),
+            ("a/b/c", "a/b", False),
+            ("a/+/c", "a/b/c", True),
+            ("a/+/c", "a/b/d", False),
+            ("a/+", "a/b/c", False),
+            ("a/#", "a/b/c", True),
+            ("a/#", "a", True),
+            ("#", "a/b", True),
+            ("+/+", "a/b", True),
+            ("+/b", "$SYS/b", False),
+            ("#", "$SYS/b", False),
+            ("$SYS/#", "$SYS/b", True),
+        ],
+    )
+    def test_match(self, topic_filter, topic, matches):
+        trie = TopicTrie()
+        trie.add(topic_filter, "value")
+        assert (trie.match(topic) == {"value"}) is matches
+
+    def test_remove_prunes_nodes(self):
+        trie = TopicTrie()
+        trie.add("a/b/c", 1)
+        trie.add("a/+", 2)
+        assert trie.remove("a/b/c", 1)
+        assert not trie.remove("a/b/c", 1)
+        assert list(trie.root.children["a"].children) == ["+"]
+        assert len(trie) == 1
+
+
+@pytest.mark.parametrize(
+    "topic_filter, valid",
+    [("a/b", True), ("a/+/b", True), ("a/#", True), ("#", True), ("a/#/b", False), ("a/b#", False),
+     ("a+/b", False), ("", False)],
+)
+def test_is_valid_filter(topic_filter, valid):
+    assert is_valid_filter(topic_filter) is valid
+
+
+def subscription(port: int, topic_filter: str, topic_id: int = 0) -> Subscription:
+    return Subscription(
+        remote_address=("10.0.0.1", port), client_id=b"meter", topic_filter=topic_filter, topic_id=topic_id
+    )
+
+
+class TestSubscriptionIndex:
+    def test_one_match_per_address_preferring_exact(self):
+        index = SubscriptionIndex()
+        index.subscribe(subscription(1000, "config/#"))
+        index.subscribe(subscription(1000, "config/meter", topic_id=3))
+        index.subscribe(subscription(1001, "config/+"))
+        matched = {s.remote_address[1]: s for s in index.match("config/meter")}
+        assert matched[1000].topic_id == 3
+        assert matched[1001].topic_filter == "config/+"
+
+    def test_remove_address(self):
+        index = SubscriptionIndex()
+        index.subscribe(subscription(1000, "a/#"))
+        index.subscribe(subscription(1000, "b"))
+        index.subscribe(subscription(1001, "b"))
+        assert index.remove_address(("10.0.0.1", 1000)) == 2
+        assert [s.remote_address[1] for s in index.match("b")] == [1001]
+        assert index.stats() == {
+            "subscriptions": 1, "addresses": 1, "pending_registrations": 0, "expired": 0, "evicted": 0, "moved": 0
+        }
+
+    def test_unsubscribe(self):
+        index = SubscriptionIndex()
+        index.subscribe(subscription(1000, "a/b"))
+        assert index.unsubscribe(("10.0.0.1", 1000), "a/b")
+        assert not index.unsubscribe(("10.0.0.1", 1000), "a/b")
+        assert index.match("a/b") == []
+
+    def test_expired_address_is_not_matched(self):
+        index = SubscriptionIndex(ttl=60)
+        index.subscribe(subscription(1000, "a/b"))
+        index.subscribe(subscription(1001, "a/b"))
+        index.expires[("10.0.0.1", 1000)] = time.monotonic() - 1
+        assert [s.remote_address[1] for s in index.match("a/b")] == [1001]
+        assert index.stats()["expired"] == 1
+        assert index.stats()["addresses"] == 1
+
+    def test_touch_extends(self):
+        index = SubscriptionIndex(ttl=60)
+        index.subscribe(subscription(1000, "a/b"))
+        index.expires[("10.0.0.1", 1000)] = time.monotonic() - 1
+        index.touch(("10.0.0.1", 1000))
+        assert len(index.match("a/b")) == 1
+
+    def test_full_index_evicts_first_to_expire(self):
+        index = SubscriptionIndex(max_addresses=2)
+        index.subscribe(subscription(1000, "a/b"))
+        index.subscribe(subscription(1001, "a/b"))
+        index.touch(("10.0.0.1", 1000))
+        index.subscribe(subscription(1002, "a/b"))
+        assert sorted(s.remote_address[1] for s in index.match("a/b")) == [1000, 1002]
+        assert index.stats()["evicted"] == 1
+
+    def test_prune_removes_expired_in_order(self):
+        index = SubscriptionIndex(ttl=60)
+        for port in range(1000, 1003):
+            index.subscribe(subscription(port, "a/b"))
+        index.touch(("10.0.0.1", 1000))
+        assert list(index.expires) == [("10.0.0.1", 1001), ("10.0.0.1", 1002), ("10.0.0.1", 1000)]
+        index.prune(time.monotonic() + 61)
+        assert not index.expires
+        assert index.stats()["expired"] == 3
+
+    def test_move_client(self):
+        index = SubscriptionIndex()
+        index.subscribe(subscription(1000, "a/#"))
+        index.subscribe(subscription(1000, "b"))
+        assert index.move_client(b"meter", ("10.0.0.1", 2000)) == 2
+        assert [s.remote_address for s in index.match("a/c")] == [("10.0.0.1", 2000)]
+        assert index.move_client(b"meter", ("10.0.0.1", 2000)) == 0
+        assert index.stats()["addresses"] == 1
+
+    def test_rejected_registration_is_forgotten(self):
+        index = SubscriptionIndex()
+        sub = subscription(1000, "a/#")
+        index.subscribe(sub)
+        index.registering(sub, "a/b", 4, b"\x00\x01")
+        index.registering(sub, "a/c", 5, b"\x00\x02")
+        assert index.acknowledge(("10.0.0.1", 1000), b"\x00\x01", accepted=True)
+        assert index.acknowledge(("10.0.0.1", 1000), b"\x00\x02", accepted=False)
+        assert not index.acknowledge(("10.0.0.1", 1000), b"\x00\x02", accepted=True)
+        assert sub.registered == {"a/b": 4}
+        assert index.stats()["pending_registrations"] == 0
@@ -0,0 +1,58 @@
+import contextvars
+import time
+
+import pytest
+
+from mqtt_sn_gateway import gateway, memory, messages, tracing
+
+
+def run_in_new_context(fn):
+    return contextvars.Context().run(fn)
+
+
+class TestTracing:
+    def test_stage_without_trace_does_nothing(self):
+        def fn():
+            with tracing.stage("parse"):
+                pass
+            return tracing.current()
+
+        assert run_in_new_context(fn) is None
+
+    def test_stages_are_added_to_trace(self):
+        def fn():
+            trace = tracing.start(arrival=time.monotonic(), deadline=time.monotonic() + 5)
+            with tracing.stage("client_store"):
+                pass
+            with tracing.stage("client_store"):
+                pass
+            return trace
+
+        trace = run_in_new_context(fn)
+        assert list(trace.stages) == ["client_store"]
+
+    def test_check_deadline(self):
+        def fn():
+            tracing.start(arrival=time.monotonic() - 10, deadline=time.monotonic() - 5)
+            tracing.check_deadline()
+
+        with pytest.raises(tracing.DeadlineExceeded):
+            run_in_new_context(fn)
+
+    def test_expired_publish_is_not_forwarded(self):
+        clients = memory.MemoryClientStore()
+        topics = memory.MemoryTopicStore()
+        forwarder = memory.MemoryForwarder()
+        clients.add_client(b"client-1", ("10.0.0.1", 1000))
+        topic_id = topics.add_topic_for_client(b"client-1", "a/b")
+        gw = gateway.MqttSnGateway(client_store=clients, topic_store=topics, forwarder=forwarder)
+        publish = messages.Publish(flags=messages.Flags(qos=1), topic_id=topic_id, msg_id=b"\x00\x01", data=b"1")
+
+        def fn():
+            trace = tracing.start(arrival=time.monotonic() - 10, deadline=time.monotonic() - 5)
+            return gw.dispatch(publish.to_bytes(), ("10.0.0.1", 1000)), trace
+
+        response, trace = run_in_new_context(fn)
+        assert response is None
+        assert forwarder.published == 0
+        assert set(trace.stages) == {"parse", "client_store", "topic_store"}
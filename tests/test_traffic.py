@@ -0,0 +1,77 @@
+import random
+
+from mqtt_sn_gateway import gateway, memory, messages
+from mqtt_sn_gateway.traffic import CountMinSketch, HeavyHitters, TrafficStats
+
+
+class TestCountMinSketch:
+    def test_never_underestimates(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        counts = {}
+        for _ in range(5000):
+            key = f"topic/{random.randint(0, 500)}"
+            sketch.add(key)
+            counts[key] = counts.get(key, 0) + 1
+        for key, count in counts.items():
+            assert sketch.estimate(key) >= count
+
+    def test_exact_when_sparse(self):
+        sketch = CountMinSketch()
+        sketch.add(b"a", 10)
+        sketch.add(b"b", 3)
+        assert (sketch.estimate(b"a"), sketch.estimate(b"b"), sketch.estimate(b"c")) == (10, 3, 0)
+
+    def test_decay_halves(self):
+        sketch = CountMinSketch()
+        sketch.add(b"a", 10)
+        sketch.decay()
+        assert sketch.estimate(b"a") == 5
+
+
+class TestHeavyHitters:
+    def test_finds_heavy_keys_among_many(self):
+        hitters = HeavyHitters(k=3, sketch=CountMinSketch(width=256, depth=4))
+        for index in range(20_000):
+            hitters.add(f"device-{index % 2000}")
+            if index % 10 == 0:
+                hitters.add("noisy-1")
+                hitters.add("noisy-2", 2)
+        assert [key for key, _ in hitters.most_common()[:2]] == ["noisy-2", "noisy-1"]
+        assert len(hitters.top) == 3
+        assert hitters.total == 20_000 + 2000 * 3
+
+
+class TestTrafficStats:
+    def test_snapshot(self):
+        stats = TrafficStats(k=2)
+        stats.record(b"C1", b"a/b", 100)
+        stats.record(b"C1", b"a/b", 100)
+        stats.record(b"C2", b"c/d", 1000)
+        snapshot = stats.snapshot()
+        assert snapshot["publishes"] == 3
+        assert snapshot["bytes"] == 1200
+        assert snapshot["top_publishes_by_topic"][0] == ["a/b", 2]
+        assert snapshot["top_bytes_by_client"][0] == ["C2", 1000]
+
+    def test_decays_after_window(self):
+        stats = TrafficStats(window=0)
+        stats.record(b"C1", b"a/b", 100)
+        stats.record(b"C1", b"a/b", 100)
+        assert stats.windows == 2
+        assert stats.estimate("bytes_by_client", b"C1") == 150
+
+
+def test_gateway_records_publishes():
+    stats = TrafficStats()
+    gw = gateway.MqttSnGateway(
+        client_store=memory.MemoryClientStore(),
+        topic_store=memory.MemoryTopicStore(),
+        forwarder=memory.MemoryForwarder(),
+        traffic=stats,
+    )
+    gw.client_store.add_client(b"C1", ("10.0.0.1", 1000))
+    topic_id = gw.topic_store.add_topic_for_client(b"C1", "a/b")
+    publish = messages.Publish(flags=messages.Flags(qos=1), topic_id=topic_id, msg_id=b"\x00\x01", data=b"1234")
+    gw.dispatch(publish.to_bytes(), ("10.0.0.1", 1000))
+    assert stats.estimate("bytes_by_client", b"C1") == 4
+    assert stats.snapshot()["top_publishes_by_topic"] == [["a/b", 1]]
@@ -0,0 +1,66 @@
+import os
+import socket
+
+import pytest
+
+from mqtt_sn_gateway import udp
+
+PROC_NET_UDP = """\
+   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  123: 00000000:0AFC 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 1111 2 0000000000000000 0
+  124: 00000000:0AFD 00000000:0000 07 00000010:00002400 00:00000000 00000000     0        0 2222 2 0000000000000000 37
+"""
+
+
+@pytest.fixture
+def sock():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    yield sock
+    sock.close()
+
+
+class TestBufferSizes:
+    def test_granted_size_returned(self, sock):
+        granted = udp.set_buffer_sizes(sock, rcvbuf=65536)
+        assert granted["rcvbuf"] >= 65536
+        assert granted["sndbuf"] > 0
+
+    def test_kernel_default_when_not_set(self, sock):
+        assert udp.set_buffer_sizes(sock)["rcvbuf"] == sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+class TestProcNetUdp:
+    def test_parse(self):
+        assert udp.parse_proc_net_udp(PROC_NET_UDP.splitlines(), 2222) == {
+            "tx_queue": 0x10, "rx_queue": 0x2400, "drops": 37
+        }
+
+    def test_unknown_inode(self):
+        assert udp.parse_proc_net_udp(PROC_NET_UDP.splitlines(), 3333) is None
+
+
+class TestSocketMonitor:
+    def test_drops_from_file(self, sock, tmp_path):
+        path = tmp_path / "udp"
+        path.write_text(PROC_NET_UDP)
+        monitor = udp.SocketMonitor(sock=sock, paths=[str(path)])
+        monitor.inode = 2222
+        stats = monitor.stats()
+        assert stats["drops"] == 37
+        assert stats["max_rx_queue_bytes"] == 0x2400
+
+    def test_not_available(self, sock, tmp_path):
+        monitor = udp.SocketMonitor(sock=sock, paths=[str(tmp_path / "missing")])
+        monitor.start()
+        assert monitor.thread is None
+        assert monitor.stats() == {"available": False, "rcvbuf": 0}
+
+    @pytest.mark.skipif(not os.path.exists("/proc/net/udp"), reason="Linux only")
+    def test_receive_queue_of_real_socket(self, sock):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.sendto(b"x" * 100, sock.getsockname())
+        sender.close()
+        stats = udp.SocketMonitor(sock=sock).stats()
+        assert stats["available"]
+        assert stats["rx_queue_bytes"] > 0
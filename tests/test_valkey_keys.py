@@ -0,0 +1,14 @@
+from mqtt_sn_gateway import client_store, topic_store
+
+
+class TestKeys:
+    def test_client_key(self):
+        store = client_store.ValKeyClientStore(valkey=None, use_port_number=True)
+        assert store.key_from_remote_addr(("10.0.0.1", 1000)) == "client:10.0.0.1:1000"
+
+    def test_client_key_without_port(self):
+        store = client_store.ValKeyClientStore(valkey=None, use_port_number=False)
+        assert store.key_from_remote_addr(("10.0.0.1", 1000)) == "client:10.0.0.1"
+
+    def test_topic_key(self):
+        assert topic_store.ValKeyTopicStore(valkey=None).build_key(b"client-1") == "topic:client-1"